@@ -13,7 +13,6 @@
 #  1) In direct mode, make limiting the download speed to disk speed optional
 #  2) Make the disk speed check a function and call it periodically to adjust
 #     for I/O load
-#  3) Build in logic for handling more than one file per CGHub UUID
 #
 
 import time
@@ -21,13 +20,30 @@ import sys
 import os
 import getopt
 import subprocess
+import threading
+import Queue
+import json
+import re
+import signal
+import hashlib
+import fcntl
+import socket
+import select
+import errno
+import gzip
 from datetime import datetime
+from collections import deque
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 verbose     = 0
 gt_debug    = 0
 Bytes2MB    = 1048576
 Bytes2GB    = 1073741824
 TimeFormat  = '%m/%d/%y %I:%M %p'
+FICLONE     = 0x40049409        # ioctl for a reflink copy (Btrfs, XFS)
 final_dest  = "/supercell/tcga"
 exit_code   = 0
 debug       = 1
@@ -39,9 +55,51 @@ CGQueryExecutable     = "/usr/bin/cgquery"
 CredentialFile        = "/arc/users/omedvede/bams_private/cghub.key"
 # These values were optimized for firehose6 @ PSC
 MAX_WAIT              = 10
+MAX_REFETCHES         = 2
 num_children          = 24
 max_bandwidth         = 10000
 do_speedtest          = 0
+num_jobs              = 1
+checkpoint_updates    = 50
+checkpoint_interval   = 300
+preflight_batch       = 50
+preflight_workers     = 4
+preflight_ttl         = 3600
+copy_buffer           = 16777216
+copy_readahead        = 4
+pipeline_mode         = 0
+pipeline_depth        = 1
+stall_rate            = 0.1
+stall_time            = 900
+stall_progress        = 600
+adaptive              = 0
+adapt_interval        = 60
+probe_interval        = 600
+probe_size            = 64
+queue_order           = ['tsv']
+distributed           = 0
+worker_id             = "%s:%d" % (socket.gethostname(),os.getpid())
+lease_ttl             = 600
+list_only             = 0
+history_file          = ""
+report_only           = 0
+digest_file           = ""
+audit_only            = 0
+reconcile_only        = 0
+ingest_file           = None
+refresh_metadata      = 0
+dedupe                = 1
+cache_size            = 0
+events_file           = None
+metrics_file          = None
+metrics_interval      = 15
+verify_workers        = 0
+verify_rate           = 100
+cgquery_timeout       = 300
+dest_roots            = list()
+link_farm             = ""
+job_log_dir           = ""
+progress_interval     = 30
 local_dir             = "/tmp"
 request_file_dir      = "/supercell/bam_requests"
 request_file_name     = "bam_status.tsv"
@@ -65,10 +123,32 @@ if debug:
 
 # Parse the command line options
 options, trailing_opts = getopt.getopt(sys.argv[1:],
-                                      'e:q:C:w:t:b:d:l:n:vhD', [])
+                                      'e:q:C:w:t:b:d:l:n:j:o:vhDSPA',
+                                      ['checkpoint-updates=','checkpoint-interval=',
+                                       'preflight-batch=','preflight-workers=','preflight-ttl=',
+                                       'copy-buffer=','readahead=','pipeline-depth=',
+                                       'stall-rate=','stall-time=','stall-progress=',
+                                       'adapt-interval=','probe-interval=','probe-size=',
+                                       'distributed','worker-id=','lease-ttl=','list',
+                                       'history=','no-history','report',
+                                       'events=','metrics-file=','metrics-interval=',
+                                       'verify-workers=','verify-rate=','cgquery-timeout=',
+                                       'link-farm=','job-logs=','no-job-logs','progress-interval=',
+                                       'digest-cache=','no-digest-cache','no-dedupe','audit','reconcile',
+                                       'cache-size=','ingest=','refresh-metadata'])
 
 
-class BAMinfo:
+class BAMinfo(object):
+    # One pending download.  There can be a great many of these, so they have
+    # no per-instance __dict__, and the start and end times from the requests
+    # file are only parsed from their TimeFormat strings if they are used.
+    # name, size and checksum describe the file named in the requests file;
+    # files is the full manifest of the analysis once cgquery has told us it.
+    # root is the target directory (-t) it goes under, once one is chosen.
+    __slots__ = ('name','uuid','size','checksum','_start_time','_end_time','status','disease',
+                 'barcode','library','platform','copy_time','hash_time','progress_history',
+                 'bytes_saved','center','attempts','priority','localname','files','root')
+
     def __init__(self,filename,bamID,filesize,bamsum,start,end,stat,disease_str,barcode_str,library_type,platform_name):
         self.name        = filename
         self.uuid        = bamID
@@ -81,14 +161,70 @@ class BAMinfo:
         self.barcode     = barcode_str
         self.library     = library_type
         self.platform    = platform_name
-        self.localname   = disease_str.lower() + '/' + '-'.join(barcode.split('-')[0:3]) + '/' \
-                           + '-'.join(barcode.split('-')[0:4])[:-1] + '/' + library_type + '/' \
+        self.copy_time   = 0.0
+        self.hash_time   = 0.0
+        self.progress_history = list()
+        self.bytes_saved = 0
+        self.center      = ""
+        self.attempts    = 0
+        self.priority    = 0
+        self.files       = None
+        self.root        = None
+        self.localname   = disease_str.lower() + '/' + '-'.join(barcode_str.split('-')[0:3]) + '/' \
+                           + '-'.join(barcode_str.split('-')[0:4])[:-1] + '/' + library_type + '/' \
                            + "CGHub_" + platform_name + '/' + bamID + '/' + filename
+
+    def _parse_time(self,value):
+        # A time from the requests file; blank means "now"
+        if isinstance(value,datetime):
+            return value
+        if value != '':
+            return datetime.strptime(value,TimeFormat)
+        return datetime.now()
+
+    def _get_start_time(self):
+        self._start_time = self._parse_time(self._start_time)
+        return self._start_time
+
+    def _set_start_time(self,value):
+        self._start_time = value
+
+    def _get_end_time(self):
+        self._end_time = self._parse_time(self._end_time)
+        return self._end_time
+
+    def _set_end_time(self,value):
+        self._end_time = value
+
+    start_time = property(_get_start_time,_set_start_time)
+    end_time   = property(_get_end_time,_set_end_time)
+
+    def manifest(self):
+        # (name,size,checksum) for every file in the analysis.  Until cgquery
+        # has been asked, this is just the one file in the requests file.
+        if self.files is None:
+            return [(self.name,self.size,self.checksum)]
+        return self.files
+
+    def set_manifest(self,files):
+        # Take the file list from cgquery.  The requests file stays the
+        # reference for the checksum of the file it names.
+        manifest = list()
+        for name,size,checksum in files:
+            if name == self.name and self.checksum:
+                checksum = self.checksum
+            manifest.append((name,size,checksum))
+        if manifest:
+            self.files = manifest
+            self.size  = sum(size for name,size,_ in manifest)
+
     def bamprint(self):
         print ("\n___________________________________________________________________________________")
         print ("BAM info for %s") % self.name
         print ("CGHub UUID        = %s")     % self.uuid
         print ("Size (Bytes)      = %d")     % self.size
+        if self.files is not None and len(self.files) > 1:
+            print ("Files             = %s")     % ', '.join([name for name,size,checksum in self.files])
         print ("Disease type      = %s")     % self.disease
         print ("Barcode           = %s")     % self.barcode
         print ("Library type      = %s")     % self.library
@@ -101,92 +237,3805 @@ class BAMinfo:
         print ("\n")
 
 
-def usage():
-    print "\nUsage: GT_Download.py [OPTION] [REQUESTS_FILE]"
-    print "\nThis script parses a tab-delimited REQUESTS_FILE containing a list of files to be"
-    print "downloaded from CGHub, downloads each file to temporary storage, copies it to a"
-    print "destination directory specified by REQUESTS_FILE, and then updates the"
-    print "REQUESTS_FILE.\n"
-    print "  REQUESTS_FILE    is an optional filename containing the download requests (default = %s)" % \
-          request_file_name
-    print "  -e NAME          full path to alternate gtdownload executable (default = %s)" % GeneTorrentExecutable
-    print "  -q NAME          full path to alternate cgquery executable (default = %s)" % CGQueryExecutable
-    print "  -C FILE          Credential file to use for CGHub access (default = %s)" % CredentialFile
-    print "  -w TIME          wait TIME (in minutes) before assuming a download has stalled (default = %d)" % MAX_WAIT
-    print "  -n NUM           Use NUM threads when downloading (default = %d)" % num_children
-    print "  -b NUM           Limit download bandwidth to NUM Mb/s (default = %d)" % max_bandwidth
-    print "  -d DIR           Look for request file in DIR (default = %s)" % request_file_dir
-    print "  -l DIR           local directory to use for initial download (default = %s)" % local_dir
-    print "  -t DIR           Target DIR for downloaded files (default = %s)" % final_dest
-    print "  -D               Turn off DIRECT download mode (i.e. - cache to local directory first)"
-    print "  -S               Automatically adjust download speed to match disk speed"
-    print "  -v               Verbose mode"
-    print "  -h               Show this help message\n\n"
+def usage():
+    print "\nUsage: GT_Download.py [OPTION] [REQUESTS_FILE]"
+    print "\nThis script parses a tab-delimited REQUESTS_FILE containing a list of files to be"
+    print "downloaded from CGHub, downloads each file to temporary storage, copies it to a"
+    print "destination directory specified by REQUESTS_FILE, and then updates the"
+    print "REQUESTS_FILE.\n"
+    print "  REQUESTS_FILE    is an optional filename containing the download requests (default = %s)" % \
+          request_file_name
+    print "  -e NAME          full path to alternate gtdownload executable (default = %s)" % GeneTorrentExecutable
+    print "  -q NAME          full path to alternate cgquery executable (default = %s)" % CGQueryExecutable
+    print "  -C FILE          Credential file to use for CGHub access (default = %s)" % CredentialFile
+    print "  -w TIME          wait TIME (in minutes) before assuming a download has stalled (default = %d)" % MAX_WAIT
+    print "  -n NUM           Use NUM threads when downloading (default = %d)" % num_children
+    print "  -b NUM           Limit download bandwidth to NUM Mb/s (default = %d)" % max_bandwidth
+    print "  -j NUM           Run NUM gtdownload jobs at once; -n and -b are split between them (default = %d)" % num_jobs
+    print "  -o ORDER         Download order: a comma separated list of %s" % ', '.join(sorted(OrderPolicies.keys()))
+    print "                   applied first to last, e.g. priority,failed-last,shortest (default = %s)" % \
+          ','.join(queue_order)
+    print "  -d DIR           Look for request file in DIR (default = %s)" % request_file_dir
+    print "  -l DIR           local directory to use for initial download (default = %s)" % local_dir
+    print "  -t DIR           Target DIR for downloaded files (default = %s).  Give -t more than once, or a" % final_dest
+    print "                   comma separated list, to spread the downloads over several filesystems"
+    print "  -D               Turn off DIRECT download mode (i.e. - cache to local directory first)"
+    print "  --cache-size=GB  With -D, keep verified copies in the local directory, up to GB GB in all, to"
+    print "                   copy again if the target's copy goes bad; least recently used go first"
+    print "                   (default = %g: remove each copy once it is verified)" % cache_size
+    print "  --checkpoint-updates=NUM"
+    print "                   Rewrite REQUESTS_FILE after NUM journaled status updates (default = %d)" % \
+          checkpoint_updates
+    print "  --checkpoint-interval=SEC"
+    print "                   Rewrite REQUESTS_FILE at least every SEC seconds (default = %d)" % \
+          checkpoint_interval
+    print "  --preflight-batch=NUM"
+    print "                   Check NUM UUIDs per cgquery call before downloading; 0 disables (default = %d)" % \
+          preflight_batch
+    print "  --preflight-workers=NUM"
+    print "                   Run NUM pre-flight cgquery calls at once (default = %d)" % preflight_workers
+    print "  --preflight-ttl=SEC"
+    print "                   Reuse cached cgquery states for SEC seconds; 0 disables the cache (default = %d)" % \
+          preflight_ttl
+    print "  --copy-buffer=MB Copy and checksum cached files MB megabytes at a time (default = %d)" % \
+          (copy_buffer / Bytes2MB)
+    print "  --readahead=NUM  Keep NUM copy buffers read ahead in a separate thread; 0 disables (default = %d)" % \
+          copy_readahead
+    print "  --verify-workers=NUM"
+    print "                   Copy and checksum up to NUM files at once; in direct mode, the number of"
+    print "                   background checksum threads (default = one per CPU)"
+    print "  --verify-rate=MB Read at most MB MB/s for direct mode checksums while gtdownload is running;"
+    print "                   0 for no limit (default = %d)" % verify_rate
+    print "  --link-farm=DIR  With several -t directories, keep DIR/disease/.../UUID symlinks to every"
+    print "                   finished download so the archive can be browsed as one tree"
+    print "  --cgquery-timeout=SEC"
+    print "                   Give up on a cgquery that hasn't answered in SEC seconds; 0 waits forever (default = %d)" % \
+          cgquery_timeout
+    print "  --pipeline-depth=NUM"
+    print "                   Let NUM files wait between pipeline stages (default = %d)" % pipeline_depth
+    print "  --stall-rate=MB  Restart a download that averages under MB MB/s for --stall-time; 0 disables (default = %g)" % \
+          stall_rate
+    print "  --stall-time=SEC Window for --stall-rate (default = %d)" % stall_time
+    print "  --stall-progress=SEC"
+    print "                   Restart a download whose byte count has not moved in SEC seconds; 0 disables (default = %d)" % \
+          stall_progress
+    print "  --adapt-interval=SEC"
+    print "                   Sample disk and network throughput every SEC seconds in adaptive mode (default = %d)" % \
+          adapt_interval
+    print "  --probe-interval=SEC"
+    print "                   Re-measure the target filesystem every SEC seconds in adaptive mode (default = %d)" % \
+          probe_interval
+    print "  --probe-size=MB  Write MB megabytes for each filesystem probe (default = %d)" % probe_size
+    print "  --distributed    Share REQUESTS_FILE with GT_Download.py runs on other nodes; each UUID is"
+    print "                   leased to one run at a time"
+    print "  --worker-id=NAME Name this run in the lease file (default = %s)" % worker_id
+    print "  --lease-ttl=SEC  A lease not renewed for SEC seconds is taken over by another run (default = %d)" % \
+          lease_ttl
+    print "  --list           Print the download queue for REQUESTS_FILE and exit"
+    print "  --history=FILE   Record every download attempt in the SQLite database FILE"
+    print "                   (default = gt_history.db next to REQUESTS_FILE)"
+    print "  --no-history     Do not record download attempts"
+    print "  --report         Print throughput percentiles from the --history database and exit"
+    print "  --digest-cache=FILE"
+    print "                   Remember the MD5 of each verified file, by path, size, mtime and inode, in the"
+    print "                   SQLite database FILE (default = .gt_digests.db in the target directory)"
+    print "  --no-digest-cache"
+    print "                   Always read files to checksum them"
+    print "  --no-dedupe      Download every BAM, even if the digest cache knows of an identical copy that"
+    print "                   could be hard linked (or reflinked) into place instead"
+    print "  --audit          Check every Finished or Live file in REQUESTS_FILE against its checksum and"
+    print "                   exit; only files that are new to the digest cache or have changed are read"
+    print "  --reconcile      Set the status of every row in REQUESTS_FILE from what is in the target"
+    print "                   directory, without downloading anything, and exit"
+    print "  --ingest=CSV     Add the analysis_ids listed in CSV (label,uuid lines) to REQUESTS_FILE, creating"
+    print "                   it if need be, with their metadata from cgquery, and exit.  Metadata is kept in"
+    print "                   .cgquery_metadata next to REQUESTS_FILE, so only new UUIDs are looked up"
+    print "  --refresh-metadata"
+    print "                   With --ingest, look every UUID up again and update rows that have changed"
+    print "  --job-logs=DIR   Write each UUID's gtdownload output to DIR/UUID.log.gz instead of the console,"
+    print "                   which gets a table of the running downloads instead (default = gt_logs next"
+    print "                   to REQUESTS_FILE)"
+    print "  --no-job-logs    Copy every line of gtdownload output to the console, as it comes"
+    print "  --progress-interval=SEC"
+    print "                   Print the table of running downloads every SEC seconds (default = %d)" % \
+          progress_interval
+    print "  --events=FILE    Append a JSON line for each phase (cgquery, download, copy, md5, tsv,"
+    print "                   prune) of each BAM to FILE"
+    print "  --metrics-file=FILE"
+    print "                   Keep Prometheus metrics for the run in FILE (for the node_exporter"
+    print "                   textfile collector)"
+    print "  --metrics-interval=SEC"
+    print "                   Rewrite --metrics-file every SEC seconds (default = %d)" % metrics_interval
+    print "  -P               Pipeline mode (with -D): download the next file while the last is copied and verified"
+    print "  -S               Automatically adjust download speed to match disk speed"
+    print "  -A               Adaptive mode: keep re-measuring disk and network speed and adjust -n and -b"
+    print "                   for each new download (-n and -b become the upper limits)"
+    print "  -v               Verbose mode"
+    print "  -h               Show this help message\n\n"
+
+
+
+class FileLock:
+    # An exclusive flock() on a lock file, re-entrant and shared by all the
+    # threads of this process.  Used in place of the table's RLock when
+    # several processes share a requests file (--distributed).
+    def __init__(self,filename):
+        self.filename = filename
+        self.lock     = threading.RLock()
+        self.depth    = 0
+        self.f        = open(filename,'a')
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            fcntl.flock(self.f.fileno(),fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self,*exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.f.fileno(),fcntl.LOCK_UN)
+        self.lock.release()
+
+
+# The columns of a requests file, in order, for files made by --ingest
+RequestColumns = ['study','barcode','disease','disease_name','sample_type','sample_type_name','analyte_type',
+                  'library_type','center','center_name','platform','platform_name','assembly','filename',
+                  'files_size','checksum','analysis_id','aliquot_id','participant_id','sample_id','tss_id',
+                  'sample_accession','published','uploaded','modified','state','side','start_time','end_time',
+                  'download_attempt_num','status','overall_rate_(MB/s)','pgrr_file_path']
+
+
+class RequestTable:
+    # The requests file, loaded once and indexed by analysis_id.  Updates are
+    # applied in memory and appended to a journal (one fsync'd JSON record per
+    # update() call), and the .tsv itself is only rewritten at checkpoints.  If
+    # we die between checkpoints the journal is replayed on the next start.
+    #
+    # With shared=1 the table, journal and checkpoints are guarded by a lock
+    # file, and every update first picks up the journal records (or the new
+    # .tsv) written by the other processes, so they never overwrite each other.
+    def __init__(self,filename,checkpoint_updates=50,checkpoint_interval=300,shared=0):
+        self.filename            = filename
+        self.backup_name         = os.path.join(os.path.dirname(filename),"." + os.path.basename(filename))
+        self.journal_name        = os.path.join(os.path.dirname(filename),"." + os.path.basename(filename) + ".journal")
+        self.checkpoint_updates  = checkpoint_updates
+        self.checkpoint_interval = checkpoint_interval
+        self.shared              = shared
+        if shared:
+            self.lock = FileLock(os.path.join(os.path.dirname(filename),"." + os.path.basename(filename) + ".lock"))
+        else:
+            self.lock = threading.RLock()
+        self.pending             = 0
+        self.last_checkpoint     = time.time()
+        # I/O counters for the run summary (and bench/run_bench.py)
+        self.updates             = 0
+        self.checkpoints         = 0
+        self.fsyncs              = 0
+        self.journal             = None
+        self.journal_offset      = 0
+        self.column_names        = list()
+        self.tsv                 = None
+
+        with self.lock:
+            self.load()
+            if os.path.exists(self.journal_name):
+                self.replay()
+            self.journal = open(self.journal_name,'a')
+
+    def load(self):
+        # (Re)read the .tsv itself.  The file is held open so that its inode
+        # cannot be reused, which is how sync() spots a checkpoint.
+        if self.tsv is not None:
+            self.tsv.close()
+        f = open(self.filename,'r')
+        self.tsv          = f
+        self.header       = f.readline()
+        self.column_names[:] = self.header.strip().split('\t')
+        self.num_columns  = len(self.column_names)
+        self.uuid_col     = self.column_names.index('analysis_id')
+        self.lines        = list()
+        self.index        = dict()
+        # Only the raw lines are kept; rows are split again when they are used
+        uuid_col = self.uuid_col
+        lines    = self.lines
+        index    = self.index
+        for line in f:
+            data = line.strip().split('\t')
+            if len(data) > uuid_col:
+                index.setdefault(data[uuid_col],list()).append(len(lines))
+            lines.append(line)
+
+    def read_journal(self):
+        # Apply the journal records past journal_offset; returns how many
+        count = 0
+        f = open(self.journal_name,'r')
+        f.seek(self.journal_offset)
+        while 1:
+            line = f.readline()
+            if not line.endswith('\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn final record from a crash; everything before it is good
+                break
+            self.apply(record['analysis_id'],record['fields'])
+            self.journal_offset = f.tell()
+            count += 1
+        f.close()
+        return count
+
+    def replay(self):
+        # Re-apply updates that were journaled but never checkpointed
+        self.journal_offset = 0
+        replayed = self.read_journal()
+        if replayed:
+            print ("Replayed %d journaled update(s) for %s") % (replayed,self.filename)
+            sys.stdout.flush()
+            self.checkpoint()
+        elif not self.shared:
+            os.remove(self.journal_name)
+
+    def sync(self):
+        # Catch up with the updates made by the other processes sharing the
+        # table.  A checkpoint by one of them shows up as a new .tsv inode.
+        if not self.shared:
+            return
+        with self.lock:
+            if os.stat(self.filename).st_ino != os.fstat(self.tsv.fileno()).st_ino:
+                self.load()
+                self.journal_offset = 0
+            if os.path.exists(self.journal_name):
+                self.read_journal()
+
+    def get(self,uuid,name):
+        # Current value of one column for an analysis_id
+        with self.lock:
+            if name not in self.column_names or uuid not in self.index:
+                return None
+            return self.row(self.index[uuid][0])[self.column_names.index(name)]
+
+    def row(self,row_index):
+        # The fields of one row, padded out to the full width of the table
+        data = self.lines[row_index].strip().split('\t')
+        # Fix data for truncated lines
+        if len(data) < self.num_columns:
+            data.extend([""] * (self.num_columns - len(data)))
+        return data
+
+    def iterrows(self):
+        # Stream the rows of the table, one freshly split row at a time
+        num_columns = self.num_columns
+        for line in self.lines:
+            data = line.strip().split('\t')
+            if len(data) < num_columns:
+                data.extend([""] * (num_columns - len(data)))
+            yield data
+
+    def apply(self,uuid,fields):
+        for name in fields:
+            if name not in self.column_names:
+                self.add_column(name)
+        for row_index in self.index.get(uuid,[]):
+            data = self.row(row_index)
+            for name,value in fields.items():
+                col_index = self.column_names.index(name)
+                if debug:
+                    print ("DEBUG: from RequestTable: Updating column %d in %s") % (col_index,self.filename)
+                    print ("DEBUG: from RequestTable: column heading = %s") % name
+                    print ("DEBUG: from RequestTable: old value      = %s") % data[col_index]
+                    print ("DEBUG: from RequestTable: new value      = %s") % value
+                data[col_index] = value
+            self.lines[row_index] = '\t'.join(data) + '\n'
+
+    def add_column(self,name):
+        # Append a new (empty) column to the table
+        with self.lock:
+            self.column_names.append(name)
+            self.num_columns = len(self.column_names)
+            self.header = '\t'.join(self.column_names) + '\n'
+            for row_index in range(len(self.lines)):
+                self.lines[row_index] = '\t'.join(self.row(row_index)) + '\n'
+
+    def update(self,uuid,fields):
+        # Commit all of the column changes in fields (a dict of column name to
+        # new value) for one analysis_id as a single journal record
+        with self.lock, RunMetrics.span('tsv',uuid) as span:
+            self.sync()
+            self.apply(uuid,fields)
+            record = json.dumps({'analysis_id': uuid, 'fields': fields}) + '\n'
+            span.bytes = len(record)
+            self.journal.write(record)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_offset = os.fstat(self.journal.fileno()).st_size
+            self.pending += 1
+            self.updates += 1
+            self.fsyncs  += 1
+            if (self.pending >= self.checkpoint_updates or
+                time.time() - self.last_checkpoint >= self.checkpoint_interval):
+                self.checkpoint()
+
+    def update_many(self,updates):
+        # Apply a list of (uuid,fields) changes and write them all out with a
+        # single checkpoint rather than a journal record each
+        with self.lock:
+            self.sync()
+            for uuid,fields in updates:
+                self.apply(uuid,fields)
+            self.updates += len(updates)
+            self.checkpoint()
+
+    def add_rows(self,rows):
+        # Append rows (dicts of column name to value, with an analysis_id) to
+        # the table, adding any new columns, and checkpoint them all at once
+        with self.lock:
+            self.sync()
+            for fields in rows:
+                for name in fields:
+                    if name not in self.column_names:
+                        self.add_column(name)
+                self.index.setdefault(fields['analysis_id'],list()).append(len(self.lines))
+                self.lines.append('\t'.join([fields.get(name,"") for name in self.column_names]) + '\n')
+            self.updates += len(rows)
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Atomically replace the .tsv with the in-memory table.  The previous
+        # version is kept as .<filename> as before.
+        import shutil
+        with self.lock:
+            self.sync()
+            tmp_name = self.backup_name + ".tmp"
+            f = open(tmp_name,'w')
+            f.write(self.header)
+            for line in self.lines:
+                f.write(line)
+            # Use flush + fsync to ensure that we have committed the update to disk
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            if os.path.exists(self.backup_name):
+                os.remove(self.backup_name)
+            try:
+                os.link(self.filename,self.backup_name)
+            except OSError:
+                shutil.copy2(self.filename,self.backup_name)
+            os.rename(tmp_name,self.filename)
+            self.checkpoints += 1
+            self.fsyncs      += 1
+            self.tsv.close()
+            self.tsv = open(self.filename,'r')
+            self.journal_offset = 0
+            if self.journal is not None:
+                self.journal.seek(0)
+                self.journal.truncate()
+            elif self.shared:
+                open(self.journal_name,'w').close()
+            elif os.path.exists(self.journal_name):
+                os.remove(self.journal_name)
+            self.pending = 0
+            self.last_checkpoint = time.time()
+            if debug:
+                print ("DEBUG: Checkpointed %s") % self.filename
+
+    def close(self):
+        with self.lock:
+            if self.pending:
+                self.checkpoint()
+            self.journal.close()
+            self.journal = None
+            self.tsv.close()
+            # Other runs may still be appending to a shared journal
+            if not self.shared:
+                os.remove(self.journal_name)
+
+
+class LeaseTable:
+    # Claims on analysis_ids for --distributed runs.  The claims are kept in
+    # .<filename>.leases next to the requests file, under the same lock as the
+    # shared RequestTable.  A claim is good for lease_ttl seconds and is
+    # renewed by a heartbeat thread while we work on it, so the claims of a
+    # run that dies simply expire and another run takes the work over.
+    def __init__(self,requests,worker_id,lease_ttl):
+        self.requests  = requests
+        self.filename  = os.path.join(os.path.dirname(requests.filename),
+                                      "." + os.path.basename(requests.filename) + ".leases")
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.started   = time.time()
+        self.held      = set()
+        self.deferred  = list()
+        self.lock      = threading.Lock()
+        self.stopping  = threading.Event()
+        self.thread    = None
+
+    def load(self):
+        try:
+            f = open(self.filename,'r')
+            leases = json.load(f)
+            f.close()
+        except (IOError,ValueError):
+            leases = dict()
+        return leases
+
+    def save(self,leases):
+        tmp_name = self.filename + ".tmp"
+        f = open(tmp_name,'w')
+        json.dump(leases,f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp_name,self.filename)
+
+    def claim(self,uuid):
+        # Returns "claimed", "busy" (another run holds a live lease) or "done"
+        # (another run has finished with it since we started)
+        with self.requests.lock:
+            self.requests.sync()
+            if self.requests.get(uuid,'status') in ("Finished","Live"):
+                return "done"
+            leases = self.load()
+            lease  = leases.get(uuid)
+            now    = time.time()
+            if lease is not None and lease['worker'] != self.worker_id:
+                if 'done' in lease:
+                    if lease['done'] >= self.started:
+                        return "done"
+                elif lease['expires'] > now:
+                    return "busy"
+                else:
+                    print ("Taking over the expired lease on %s from %s") % (uuid,lease['worker'])
+                    sys.stdout.flush()
+            leases[uuid] = {'worker': self.worker_id, 'expires': now + self.lease_ttl}
+            self.save(leases)
+        with self.lock:
+            self.held.add(uuid)
+        return "claimed"
+
+    def release(self,uuid):
+        # Mark our lease on uuid as done; its status is in the requests file
+        with self.lock:
+            self.held.discard(uuid)
+        with self.requests.lock:
+            leases = self.load()
+            if leases.get(uuid,{}).get('worker') == self.worker_id:
+                leases[uuid] = {'worker': self.worker_id, 'done': time.time()}
+                self.save(leases)
+
+    def renew(self):
+        # Heartbeat: push out the expiry of every lease we still hold
+        with self.lock:
+            held = list(self.held)
+        if not held:
+            return
+        with self.requests.lock:
+            leases = self.load()
+            now = time.time()
+            for uuid in held:
+                lease = leases.get(uuid,{})
+                if lease.get('worker') != self.worker_id:
+                    print ("WARNING: Lost the lease on %s to %s") % (uuid,lease.get('worker'))
+                    sys.stdout.flush()
+                    continue
+                lease['expires'] = now + self.lease_ttl
+            self.save(leases)
+
+    def defer(self,item):
+        # Hold on to a queue entry leased by another run and try it again later
+        with self.lock:
+            self.deferred.append(item)
+
+    def requeue(self,work_queue):
+        # Put the deferred entries back on work_queue; returns how many
+        with self.lock:
+            items = self.deferred
+            self.deferred = list()
+        for item in items:
+            work_queue.put(item)
+        return len(items)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,name="leases")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopping.wait(self.lease_ttl / 4.0):
+            try:
+                self.renew()
+            except Exception, err:
+                print ("ERROR: Lease heartbeat failed: %s") % err
+                sys.stdout.flush()
+
+
+class Span:
+    # One timed phase of the work on a BAM; see Metrics.span().  The clock
+    # starts when the span is made and stops at finish() or at the end of a
+    # with block.  Set bytes and status before then to have them recorded.
+    def __init__(self,metrics,phase,uuid):
+        self.metrics  = metrics
+        self.phase    = phase
+        self.uuid     = uuid
+        self.bytes    = 0
+        self.status   = "ok"
+        self.extra    = dict()
+        self.start    = time.time()
+        self.seconds  = None
+
+    def finish(self,seconds=None):
+        # seconds overrides the clock for work timed elsewhere
+        if self.seconds is None:
+            if seconds is None:
+                seconds = time.time() - self.start
+            self.seconds = seconds
+            self.metrics.record(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is not None:
+            self.status = "error"
+        self.finish()
+        return False
+
+
+class Metrics:
+    # Instrumentation for the run.  Each phase of each BAM (cgquery, download,
+    # copy, md5, tsv, prune) is timed as a Span, which is appended to a
+    # JSON-lines event log and added to per-phase totals.  The totals, along
+    # with live gauges, are written out for the Prometheus node_exporter
+    # textfile collector every interval seconds.
+    phases = ('cgquery','download','copy','md5','tsv','prune')
+
+    def __init__(self,events_file=None,prom_file=None,interval=15):
+        self.lock      = threading.Lock()
+        self.prom_file = prom_file
+        self.interval  = interval
+        self.totals    = dict((phase,[0,0.0,0]) for phase in self.phases)
+        self.gauges    = list()
+        self.stopping  = threading.Event()
+        self.thread    = None
+        if events_file:
+            self.events = open(events_file,'a')
+        else:
+            self.events = None
+
+    def span(self,phase,uuid=None):
+        return Span(self,phase,uuid)
+
+    def event(self,name,**fields):
+        if self.events is None:
+            return
+        fields['event'] = name
+        fields['time']  = round(time.time(),3)
+        with self.lock:
+            self.events.write(json.dumps(fields,sort_keys=True) + '\n')
+            self.events.flush()
+
+    def record(self,span):
+        with self.lock:
+            totals = self.totals.setdefault(span.phase,[0,0.0,0])
+            totals[0] += 1
+            totals[1] += span.seconds
+            totals[2] += span.bytes
+        fields = dict(span.extra)
+        fields.update(phase=span.phase,uuid=span.uuid,start=round(span.start,3),
+                      seconds=round(span.seconds,6),bytes=span.bytes,status=span.status)
+        self.event('span',**fields)
+
+    def gauge(self,name,help_text,function):
+        # A value sampled each time the textfile is written
+        with self.lock:
+            self.gauges.append((name,help_text,function))
+
+    def write_textfile(self):
+        if not self.prom_file:
+            return
+        with self.lock:
+            totals = dict((phase,list(values)) for phase,values in self.totals.items())
+            gauges = list(self.gauges)
+        lines = list()
+        for name,index,help_text in (('gt_download_phase_spans_total',0,'Phases completed'),
+                                     ('gt_download_phase_seconds_total',1,'Wall time spent in each phase'),
+                                     ('gt_download_phase_bytes_total',2,'Bytes handled in each phase')):
+            lines.append("# HELP %s %s" % (name,help_text))
+            lines.append("# TYPE %s counter" % name)
+            for phase in sorted(totals.keys()):
+                lines.append('%s{phase="%s"} %s' % (name,phase,repr(totals[phase][index])))
+        for name,help_text,function in gauges:
+            try:
+                value = function()
+            except Exception:
+                continue
+            lines.append("# HELP gt_download_%s %s" % (name,help_text))
+            lines.append("# TYPE gt_download_%s gauge" % name)
+            lines.append("gt_download_%s %s" % (name,repr(value)))
+        lines.append("# HELP gt_download_metrics_updated_seconds When this file was written")
+        lines.append("# TYPE gt_download_metrics_updated_seconds gauge")
+        lines.append("gt_download_metrics_updated_seconds %.3f" % time.time())
+        # The collector may read the file at any moment, so replace it whole
+        tmp_name = self.prom_file + ".%d.tmp" % os.getpid()
+        f = open(tmp_name,'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        os.rename(tmp_name,self.prom_file)
+
+    def start(self):
+        if not self.prom_file:
+            return
+        self.thread = threading.Thread(target=self.run,name="metrics")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write_textfile()
+        if self.events is not None:
+            with self.lock:
+                self.events.close()
+                self.events = None
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.write_textfile()
+            except (IOError,OSError), err:
+                print ("ERROR: Failed to write %s: %s") % (self.prom_file,err)
+                sys.stdout.flush()
+
+
+def FormatElapsed(seconds):
+    # Seconds as the "D days H hours M minutes S seconds" used in the log
+    (days,seconds)    = divmod(seconds,(3600 * 24))
+    (hours,seconds)   = divmod(seconds,3600)
+    (minutes,seconds) = divmod(seconds,60)
+    return "%d days %2d hours %2d minutes %4.1f seconds" % (days,hours,minutes,seconds)
+
+
+class DownloadProgress:
+    # Time series of the "Status:" lines that gtdownload prints every few
+    # seconds for one download attempt, e.g.
+    #
+    #   Status: 1.09 GB downloaded (13.606% complete) current rate:  157 MB/s
+    #
+    # Each sample is (time, bytes downloaded, percent complete, current rate in
+    # bytes/s).  gtdownload's "current rate" can collapse to a few kB/s while
+    # the byte count is still climbing, so the stall checks go by the byte
+    # count rather than the reported rate.
+    status_re = re.compile(r'Status:\s*([\d.]+)\s*(bytes|B|kB|MB|GB|TB)\s+downloaded\s+'
+                           r'\(([\d.]+)% complete\)\s+current rate:\s*(?:([\d.]+)\s*(bytes|B|kB|MB|GB|TB))?/s')
+    units = {'bytes': 1, 'B': 1, 'kB': 1024, 'MB': Bytes2MB, 'GB': Bytes2GB, 'TB': 1024 * Bytes2GB}
+
+    def __init__(self,uuid,attempt):
+        self.uuid    = uuid
+        self.attempt = attempt
+        self.start   = time.time()
+        self.samples = list()
+        self.killed  = 0
+
+    def add(self,line):
+        # Parse a line of gtdownload output; returns the new sample, if any
+        match = self.status_re.search(line)
+        if match is None:
+            return None
+        downloaded = int(float(match.group(1)) * self.units[match.group(2)])
+        percent    = float(match.group(3))
+        if match.group(4):
+            rate = float(match.group(4)) * self.units[match.group(5)]
+        else:
+            rate = 0.0
+        sample = (time.time(),downloaded,percent,rate)
+        self.samples.append(sample)
+        return sample
+
+    def latest(self):
+        if len(self.samples) == 0:
+            return None
+        return self.samples[-1]
+
+    def stalled(self):
+        # Returns a description of the problem if a stall policy has tripped
+        if len(self.samples) < 2:
+            return None
+        now,downloaded = self.samples[-1][0],self.samples[-1][1]
+        if stall_progress > 0 and now - self.start >= stall_progress:
+            # No change in the byte count for stall_progress seconds
+            for sample in reversed(self.samples):
+                if sample[1] != downloaded:
+                    break
+                if now - sample[0] >= stall_progress:
+                    return "no progress for %d seconds" % stall_progress
+        if stall_rate > 0 and stall_time > 0 and now - self.start >= stall_time:
+            # Average rate over the last stall_time seconds below stall_rate
+            for sample in reversed(self.samples):
+                if now - sample[0] >= stall_time:
+                    rate = float(downloaded - sample[1]) / (now - sample[0])
+                    if rate < stall_rate * Bytes2MB:
+                        return "%.3f MB/s over the last %d seconds" % (rate / Bytes2MB,stall_time)
+                    break
+        return None
+
+
+class JobLog:
+    # gtdownload's output for one UUID, gzipped, in job_log_dir/UUID.log.gz.
+    # Each attempt is appended to the file as a gzip member of its own, which
+    # zcat and gzip.open() read back as one log.  Lines go through the
+    # compressor and a 64 kB file buffer, so they cost no system calls of
+    # their own.
+    def __init__(self,uuid,attempt,command):
+        self.filename = os.path.join(job_log_dir,uuid + ".log.gz")
+        self.raw      = open(self.filename,'ab',65536)
+        self.gz       = gzip.GzipFile(uuid + ".log",'ab',6,self.raw)
+        self.write("=== %s attempt %d: %s\n" % (datetime.now().strftime(TimeFormat),attempt,command))
+
+    def write(self,line):
+        self.gz.write(line)
+
+    def close(self):
+        self.gz.close()
+        self.raw.close()
+
+
+class ProgressTable:
+    # With the gtdownload output in the job logs, the console gets a table of
+    # the running downloads every progress_interval seconds instead: bytes so
+    # far, the rate over the last interval and the time left at that rate.
+    def __init__(self,interval):
+        self.interval = interval
+        self.done     = threading.Event()
+        self.thread   = threading.Thread(target=self.run,name="progress")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.show()
+
+    def show(self):
+        with StatusLock:
+            trackers = sorted(ActiveProgress.values(),key=lambda progress: progress.start)
+        if not trackers:
+            return
+        now   = time.time()
+        rows  = list()
+        total = 0.0
+        for progress in trackers:
+            sample = progress.latest()
+            if sample is None:
+                rows.append("    %-36s %3d %13s %6s %8s %7s" % (progress.uuid,progress.attempt,"-","-","-","-"))
+                continue
+            recent = [s for s in progress.samples if now - s[0] <= self.interval]
+            if len(recent) > 1 and recent[-1][0] > recent[0][0]:
+                rate = float(recent[-1][1] - recent[0][1]) / (recent[-1][0] - recent[0][0])
+            else:
+                rate = sample[3]
+            total += rate
+            if rate > 0 and sample[2] > 0:
+                eta = FormatETA(sample[1] * (100.0 - sample[2]) / sample[2] / rate)
+            else:
+                eta = "-"
+            rows.append("    %-36s %3d %10.1f MB %5.1f%% %8.1f %7s" % \
+                        (progress.uuid,progress.attempt,float(sample[1]) / Bytes2MB,sample[2],
+                         rate / Bytes2MB,eta))
+        lines = [" --- %s: %d download(s) running, %.1f MB/s in all" % \
+                 (datetime.now().strftime(TimeFormat),len(trackers),total / Bytes2MB),
+                 "    %-36s %3s %13s %6s %8s %7s" % ("UUID","Try","Downloaded","Done","MB/s","ETA")]
+        sys.stdout.write('\n'.join(lines + rows) + '\n')
+        sys.stdout.flush()
+
+
+class ChildTask:
+    # One child process run by the Supervisor.  Output lines are handed to
+    # on_line(task,line) as they arrive if it is given, and are kept in
+    # stdout otherwise; stderr is kept separately unless merged into stdout.
+    def __init__(self,argv,on_line=None,timeout=None,idle_timeout=None):
+        self.argv          = argv
+        self.on_line       = on_line
+        self.timeout       = timeout
+        self.idle_timeout  = idle_timeout
+        self.process       = None
+        self.streams       = dict()
+        self.stdout        = ""
+        self.stderr        = ""
+        self.partial       = ""
+        self.started       = time.time()
+        self.last_output   = self.started
+        self.returncode    = None
+        self.cancelled     = None
+        self.kill_deadline = None
+        self.done          = threading.Event()
+
+    def command(self):
+        return ' '.join(self.argv)
+
+    def cancel(self,reason):
+        # Ask the child (and its process group, if it has one) to stop; the
+        # Supervisor follows up with SIGKILL if it hasn't within 5 seconds
+        if self.cancelled is None:
+            self.cancelled = reason
+        if self.returncode is None and self.kill_deadline is None:
+            self.kill_deadline = time.time() + 5
+            self.signal(signal.SIGTERM)
+
+    def signal(self,signum):
+        try:
+            if self.process.pid == os.getpgid(self.process.pid):
+                os.killpg(self.process.pid,signum)
+            else:
+                os.kill(self.process.pid,signum)
+        except OSError:
+            pass
+
+    def wait(self):
+        # Wait in short steps so that Ctrl-C still reaches the main thread
+        while not self.done.wait(1):
+            pass
+        return self.returncode
+
+
+class Supervisor:
+    # Runs the child processes (gtdownload, cgquery, dd) for every job from a
+    # single thread: their pipes are non-blocking and watched with poll(), so
+    # any number of children cost one thread between them.  The same loop
+    # enforces each task's overall and idle timeouts and finishes off the
+    # children that were cancelled.  Commands are argv lists; no shell is run.
+    def __init__(self,tick=0.5):
+        self.tick     = tick
+        self.lock     = threading.Lock()
+        self.new      = list()
+        self.running  = list()
+        self.fds      = dict()
+        self.poller   = select.poll()
+        self.wake_r,self.wake_w = os.pipe()
+        self.poller.register(self.wake_r,select.POLLIN)
+        self.thread   = None
+
+    def spawn(self,argv,on_line=None,timeout=None,idle_timeout=None,merge_stderr=1,new_session=0):
+        # Start argv and return its ChildTask.  A command that can't be run
+        # at all finishes straight away with exit code 127, as under a shell.
+        task = ChildTask(argv,on_line,timeout,idle_timeout)
+        try:
+            task.process = subprocess.Popen(argv,stdout=subprocess.PIPE,close_fds=True,
+                                            stderr=merge_stderr and subprocess.STDOUT or subprocess.PIPE,
+                                            preexec_fn=new_session and os.setsid or None)
+        except OSError, err:
+            task.stderr     = "%s: %s\n" % (argv[0],err)
+            task.returncode = 127
+            task.done.set()
+            return task
+        for name,stream in (('stdout',task.process.stdout),('stderr',task.process.stderr)):
+            if stream is not None:
+                flags = fcntl.fcntl(stream.fileno(),fcntl.F_GETFL)
+                fcntl.fcntl(stream.fileno(),fcntl.F_SETFL,flags | os.O_NONBLOCK)
+                task.streams[stream.fileno()] = (name,stream)
+        with self.lock:
+            self.new.append(task)
+        os.write(self.wake_w,'x')
+        return task
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,name="supervisor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while 1:
+            # A child that has closed its output is usually about to exit, so
+            # look for it again soon rather than at the next tick
+            timeout = self.tick
+            for task in self.running:
+                if not task.streams:
+                    timeout = 0.01
+            try:
+                events = self.poller.poll(timeout * 1000)
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd,event in events:
+                if fd == self.wake_r:
+                    os.read(self.wake_r,4096)
+                else:
+                    self.read(fd)
+            with self.lock:
+                new = self.new
+                self.new = list()
+            for task in new:
+                for fd in task.streams:
+                    self.fds[fd] = task
+                    self.poller.register(fd,select.POLLIN | select.POLLHUP | select.POLLERR)
+                self.running.append(task)
+            self.check_timers()
+
+    def read(self,fd):
+        task = self.fds[fd]
+        name,stream = task.streams[fd]
+        try:
+            data = os.read(fd,65536)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return
+            data = ""
+        if data:
+            task.last_output = time.time()
+            if name == 'stderr':
+                task.stderr += data
+            else:
+                self.output(task,data)
+            return
+        # End of file on this stream
+        self.poller.unregister(fd)
+        del self.fds[fd]
+        del task.streams[fd]
+        stream.close()
+        if name == 'stdout' and task.partial:
+            self.output(task,"\n")
+
+    def output(self,task,data):
+        if task.on_line is None:
+            task.stdout += data
+            return
+        lines = (task.partial + data).split('\n')
+        task.partial = lines.pop()
+        for line in lines:
+            try:
+                task.on_line(task,line + '\n')
+            except Exception, err:
+                print ("ERROR: Output handler for %s died: %s") % (task.argv[0],err)
+                sys.stdout.flush()
+
+    def check_timers(self):
+        now = time.time()
+        for task in list(self.running):
+            if task.returncode is None and task.process.poll() is not None and not task.streams:
+                task.returncode = task.process.returncode
+                self.running.remove(task)
+                task.done.set()
+            elif task.kill_deadline is not None:
+                if now > task.kill_deadline:
+                    task.signal(signal.SIGKILL)
+                    task.kill_deadline = now + 5
+            elif task.timeout and now - task.started > task.timeout:
+                task.cancel("no result after %d s" % task.timeout)
+            elif task.idle_timeout and now - task.last_output > task.idle_timeout:
+                task.cancel("no output for %d s" % task.idle_timeout)
+
+
+def disk_speedtest(target_dir,count=75000):
+    # Write count 4k blocks to target_dir with dd and return the MB/s it
+    # reports, or None if dd failed
+    if verbose:
+        print ("Running filesystem speed test for target directory (%s)") % target_dir
+        sys.stdout.flush()
+    test_bandwidth = None
+    speedcmd = ["dd","if=/dev/zero","of=%s/GT_Download.speedtest" % target_dir,"bs=4k",
+                "count=%d" % count,"conv=fdatasync"]
+    if debug:
+        print ("DEBUG: speedcmd = %s") % ' '.join(speedcmd)
+        sys.stdout.flush()
+    cmd = Processes.spawn(speedcmd,merge_stderr=0,timeout=600)
+    cmd.wait()
+    speederr = cmd.stderr
+    if os.path.exists(target_dir + "/GT_Download.speedtest"):
+        os.remove(target_dir + "/GT_Download.speedtest")
+    if cmd.returncode != 0:
+        print ("ERROR: Failed on command '%s'") % cmd.command()
+        sys.stdout.flush()
+    else:
+        test_bandwidth = int(float(speederr.split()[len(speederr.split())-2]))
+        speed_units = speederr.split()[len(speederr.split())-1]
+        if speed_units == "GB/s":
+            test_bandwidth = test_bandwidth * 1000
+        if debug:
+            print ("DEBUG: speederr = %s") % speederr
+            print ("DEBUG: filesystem bandwidth = %s") % test_bandwidth
+    return test_bandwidth
+
+
+def DiskSectorsWritten(path):
+    # Sectors written so far to the block device holding path, from
+    # /proc/diskstats.  None if the device is not listed there (NFS, Lustre).
+    dev = os.stat(path).st_dev
+    try:
+        f = open("/proc/diskstats",'r')
+    except IOError:
+        return None
+    for line in f:
+        fields = line.split()
+        if len(fields) > 9 and int(fields[0]) == os.major(dev) and int(fields[1]) == os.minor(dev):
+            f.close()
+            return int(fields[9])
+    f.close()
+    return None
+
+
+class BandwidthController:
+    # Feedback controller for the gtdownload --rate-limit and --max-children
+    # settings (-A).  A background thread samples the write throughput of the
+    # download target (/proc/diskstats, plus a short dd probe every
+    # probe_interval seconds for the capacity) and the network rate of the
+    # running downloads.  Each new sample moves the settings one step towards
+    # whichever of the disk and the network is slower, and each gtdownload
+    # launch reads them with limits().
+    # With several target directories their writes and capacities are summed.
+    def __init__(self,target_dirs,max_children,max_rate):
+        self.target_dirs    = target_dirs
+        self.max_children   = max_children
+        self.max_rate       = max_rate
+        self.children       = max_children
+        self.rate           = max_rate
+        self.disk_capacity  = None
+        self.disk_write     = None
+        self.network_rate   = None
+        self.last_probe     = 0
+        self.lock           = threading.Lock()
+        self.done           = threading.Event()
+        self.thread         = threading.Thread(target=self.run,name="controller")
+        self.thread.daemon  = True
+
+    def log(self,message):
+        print ("%s --- Adaptive: %s") % (datetime.now().strftime(TimeFormat),message)
+        sys.stdout.flush()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def sectors_written(self):
+        # Sectors written to the devices holding the target directories, each
+        # device counted once; None if any of them is not in /proc/diskstats
+        devices = dict()
+        for target_dir in self.target_dirs:
+            devices.setdefault(os.stat(target_dir).st_dev,target_dir)
+        total = 0
+        for target_dir in devices.values():
+            sectors = DiskSectorsWritten(target_dir)
+            if sectors is None:
+                return None
+            total += sectors
+        return total
+
+    def run(self):
+        last_sectors = self.sectors_written()
+        last_time    = time.time()
+        while not self.done.wait(adapt_interval):
+            now = time.time()
+            sectors = self.sectors_written()
+            if sectors is not None and last_sectors is not None:
+                disk_write = float(sectors - last_sectors) * 512 / (now - last_time) / Bytes2MB
+            else:
+                disk_write = None
+            last_sectors,last_time = sectors,now
+
+            network_rate = 0.0
+            with StatusLock:
+                trackers = ActiveProgress.values()
+            for progress in trackers:
+                samples = [sample for sample in progress.samples if now - sample[0] <= adapt_interval]
+                if len(samples) > 1 and samples[-1][0] > samples[0][0]:
+                    network_rate += float(samples[-1][1] - samples[0][1]) / \
+                                    (samples[-1][0] - samples[0][0]) / Bytes2MB
+
+            disk_capacity = None
+            if now - self.last_probe >= probe_interval:
+                for target_dir in self.target_dirs:
+                    capacity = disk_speedtest(target_dir,probe_size * 256)
+                    if capacity is not None:
+                        disk_capacity = (disk_capacity or 0) + capacity
+                self.last_probe = now
+
+            with self.lock:
+                self.disk_write   = disk_write
+                self.network_rate = network_rate
+                if disk_capacity is not None:
+                    self.disk_capacity = disk_capacity
+                old_children,old_rate = self.children,self.rate
+                reason = self.adjust()
+                children,rate = self.children,self.rate
+            if verbose:
+                if disk_write is None:
+                    disk_str = "n/a"
+                else:
+                    disk_str = "%.1f MB/s" % disk_write
+                self.log("sample: network %.1f MB/s, disk writes %s, disk capacity %s MB/s" % \
+                         (network_rate,disk_str,self.disk_capacity))
+            if reason is not None and (children,rate) != (old_children,old_rate):
+                self.log("%s: --max-children %d -> %d, --rate-limit %d -> %d (total, %d job(s))" % \
+                         (reason,old_children,children,old_rate,rate,num_jobs))
+
+    def adjust(self):
+        # One step of the controller for a new sample, with self.lock held.
+        # The disk writes in /proc/diskstats are mostly the downloads' own
+        # bytes, so only what they write beyond the network rate counts as
+        # outside contention; the downloads have the probed capacity less
+        # that.  Returns the reason for the step, or None before there is
+        # anything to go on.
+        if self.disk_capacity is None:
+            return None
+        outside = max(0.0,(self.disk_write or 0.0) - (self.network_rate or 0.0))
+        disk = max(0.0,self.disk_capacity - outside)
+        self.rate = max(1,min(self.max_rate,int(self.disk_capacity)))
+        if not self.network_rate:
+            return "disk capacity %.1f MB/s" % self.disk_capacity
+        if self.network_rate >= 0.8 * disk:
+            # The disk is the bottleneck; more streams only add contention
+            self.children = max(1,self.children * 3 / 4)
+            return "disk-bound (network %.1f MB/s, disk %.1f MB/s)" % (self.network_rate,disk)
+        # The network is the bottleneck; try more streams
+        self.children = min(self.max_children,self.children + 2)
+        return "network-bound (network %.1f MB/s, disk %.1f MB/s)" % (self.network_rate,disk)
+
+    def limits(self):
+        # Settings for the next gtdownload launch, split across num_jobs jobs
+        with self.lock:
+            children,rate = self.children,self.rate
+        return max(1,children / num_jobs),max(1,rate / num_jobs)
+
+
+class Placement:
+    # Picks the target directory (-t) each BAM is written to when there are
+    # several.  A BAM that already has data under one of them stays there, so
+    # resumed and re-fetched downloads find their partial files.  Otherwise
+    # each directory with room for the BAM (free space less the bytes already
+    # promised to it) is scored by how long its queue of in-flight bytes would
+    # take at the write rate recently seen there, and the quickest one wins;
+    # ties (say, before anything has been measured) go to the most free space.
+    def __init__(self,roots):
+        self.roots    = roots
+        self.lock     = threading.Lock()
+        self.inflight = dict((root,0) for root in roots)
+        self.rates    = dict()
+        self.placed   = dict()
+
+    def free_bytes(self,root):
+        try:
+            st = os.statvfs(root)
+        except OSError:
+            return 0
+        return st.f_bavail * st.f_frsize
+
+    def existing_root(self,bam):
+        for root in self.roots:
+            if os.path.exists(os.path.join(root,os.path.dirname(bam.localname))):
+                return root
+        return None
+
+    def choose(self,bam):
+        # Set bam.root and count its bytes against that directory until
+        # release() is called for it
+        if len(self.roots) == 1:
+            bam.root = self.roots[0]
+            return bam.root
+        if bam.root not in self.roots:
+            bam.root = self.existing_root(bam)
+        reason = "has the existing data"
+        free = dict((root,self.free_bytes(root)) for root in self.roots)
+        with self.lock:
+            if bam.root is None:
+                known = self.rates.values()
+                default_rate = known and sum(known) / len(known) or 1.0
+                candidates = list()
+                for root in self.roots:
+                    room = free[root] - self.inflight[root]
+                    busy = float(self.inflight[root] + bam.size) / self.rates.get(root,default_rate)
+                    candidates.append((room < bam.size,busy,-room,root))
+                candidates.sort()
+                bam.root = candidates[0][3]
+                if candidates[0][0]:
+                    reason = "none has room; most free space"
+                else:
+                    reason = "%.0f s queued, %.1f GB free" % (candidates[0][1],-candidates[0][2] / 1e9)
+            if bam.uuid not in self.placed:
+                self.placed[bam.uuid] = bam.size
+                self.inflight[bam.root] += bam.size
+        if verbose:
+            print ("Placing %s on %s (%s)") % (bam.uuid,bam.root,reason)
+            sys.stdout.flush()
+        RunMetrics.event('placement',uuid=bam.uuid,root=bam.root,reason=reason)
+        return bam.root
+
+    def release(self,bam,nbytes=0,seconds=0):
+        # The BAM's data is on its directory.  nbytes written in seconds
+        # updates that directory's write rate (in bytes/s).
+        with self.lock:
+            if bam.uuid in self.placed:
+                self.inflight[bam.root] -= self.placed.pop(bam.uuid)
+            if nbytes > 0 and seconds > 0:
+                rate = float(nbytes) / seconds
+                if bam.root in self.rates:
+                    rate = 0.7 * self.rates[bam.root] + 0.3 * rate
+                self.rates[bam.root] = rate
+
+
+def TargetRoot(bam):
+    # The target directory a BAM is (or is to be) written under
+    return bam.root or final_dest
+
+
+def PgrrPath(bam):
+    # The pgrr_file_path for a BAM: its directory under the target directory,
+    # or the full path to it when there are several to choose from
+    if len(dest_roots) > 1:
+        return os.path.join(TargetRoot(bam),os.path.dirname(bam.localname))
+    return os.path.dirname(bam.localname)
+
+
+def RootFromPgrr(bam,pgrr_path):
+    # The target directory a full pgrr_file_path puts a BAM under, if any
+    suffix = '/' + os.path.dirname(bam.localname)
+    if os.path.isabs(pgrr_path) and pgrr_path.endswith(suffix):
+        root = pgrr_path[:-len(suffix)]
+        if root in dest_roots:
+            return root
+    return None
+
+
+def LinkFarm(bam):
+    # Point link_farm/disease/.../UUID at the BAM's directory on whichever
+    # target directory it is on
+    if not link_farm:
+        return
+    link   = os.path.join(link_farm,os.path.dirname(bam.localname))
+    target = os.path.join(TargetRoot(bam),os.path.dirname(bam.localname))
+    if os.path.realpath(link) == os.path.realpath(target):
+        return
+    try:
+        if not os.path.isdir(os.path.dirname(link)):
+            try:
+                os.makedirs(os.path.dirname(link))
+            except OSError:
+                # Another job may have just made it
+                if not os.path.isdir(os.path.dirname(link)):
+                    raise
+        if os.path.islink(link):
+            os.remove(link)
+        elif os.path.exists(link):
+            print ("WARNING: %s is in the way of the link to %s") % (link,target)
+            sys.stdout.flush()
+            return
+        os.symlink(target,link)
+    except OSError, err:
+        print ("ERROR: Failed to link %s to %s: %s") % (link,target,err)
+        sys.stdout.flush()
+
+
+def ReadAhead(src,chunks,stop):
+    # Reader thread for CopyAndHash: keep up to copy_readahead buffers queued
+    # until the file ends or stop is set
+    while not stop.is_set():
+        try:
+            buf = src.read(copy_buffer)
+        except (IOError,ValueError), err:
+            chunks.put(err)
+            return
+        chunks.put(buf)
+        if not buf:
+            return
+
+
+def CopyAndHash(src_name,dest_name):
+    # Copy one file, computing its MD5 from the same buffers that are written
+    # so that the data is only read once.  The destination is fsync'd once at
+    # the end and keeps the source's timestamps (as rsync -t would).  Returns
+    # (md5,copy_seconds,hash_seconds).
+    md5 = hashlib.md5()
+    copy_seconds = 0.0
+    hash_seconds = 0.0
+    src  = open(src_name,'rb')
+    dest = open(dest_name,'wb')
+    reader = None
+    try:
+        if copy_readahead > 0:
+            chunks = Queue.Queue(copy_readahead)
+            stop   = threading.Event()
+            reader = threading.Thread(target=ReadAhead,args=(src,chunks,stop))
+            reader.daemon = True
+            reader.start()
+            next_chunk = chunks.get
+        else:
+            next_chunk = lambda: src.read(copy_buffer)
+        while 1:
+            t0 = time.time()
+            buf = next_chunk()
+            if isinstance(buf,Exception):
+                raise buf
+            if not buf:
+                break
+            dest.write(buf)
+            t1 = time.time()
+            md5.update(buf)
+            t2 = time.time()
+            copy_seconds += t1 - t0
+            hash_seconds += t2 - t1
+        t0 = time.time()
+        dest.flush()
+        os.fsync(dest.fileno())
+        copy_seconds += time.time() - t0
+    finally:
+        # If the copy failed part way (a full disk, say) the reader may be
+        # blocked on a full queue: stop it and take what it has queued
+        if reader is not None:
+            stop.set()
+            while reader.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            reader.join()
+        dest.close()
+        src.close()
+    src_stat = os.stat(src_name)
+    os.utime(dest_name,(src_stat.st_atime,src_stat.st_mtime))
+    return md5.hexdigest(),copy_seconds,hash_seconds
+
+
+def InParallel(function,items):
+    # map() over items with up to verify_workers threads.  hashlib and file
+    # reads let go of the GIL, so copying and hashing several files this way
+    # keeps several cores busy.
+    from multiprocessing.pool import ThreadPool
+
+    if len(items) < 2 or verify_workers < 2:
+        return map(function,items)
+    pool = ThreadPool(min(verify_workers,len(items)))
+    try:
+        return pool.map(function,items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def CopyFiles(pairs):
+    # Copy and hash a list of (src_name,dest_name,key) in parallel.  Returns
+    # (digests,copy_seconds,hash_seconds) with digests keyed by key; the
+    # times are summed over the files.
+    def copy_one(pair):
+        src_name,dest_name,key = pair
+        if verbose:
+            print ("Copying %s") % src_name
+            sys.stdout.flush()
+        result = CopyAndHash(src_name,dest_name)
+        # The copy is exactly what was hashed on the way through, and so is
+        # the source (the staging cache's copy)
+        if Digests is not None:
+            Digests.store_many([(dest_name,StatSignature(dest_name),result[0]),
+                                (src_name,StatSignature(src_name),result[0])])
+        return (key,) + result
+
+    digests = dict()
+    copy_seconds = 0.0
+    hash_seconds = 0.0
+    for key,file_md5,file_copy,file_hash in InParallel(copy_one,pairs):
+        digests[key] = file_md5
+        copy_seconds += file_copy
+        hash_seconds += file_hash
+    return digests,copy_seconds,hash_seconds
+
+
+def CopyTreeAndHash(src_dir,dest_parent):
+    # Replacement for "rsync -rt src_dir dest_parent" followed by md5sum: copy
+    # the directory tree and hash every file on the way through.  Returns
+    # (digests,copy_seconds,hash_seconds) with digests keyed by the path
+    # relative to src_dir.
+    pairs = list()
+    dest_dir = os.path.join(dest_parent,os.path.basename(src_dir))
+    for current_dir,dirnames,filenames in os.walk(src_dir):
+        rel_dir = os.path.relpath(current_dir,src_dir)
+        target_dir = os.path.normpath(os.path.join(dest_dir,rel_dir))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for filename in filenames:
+            pairs.append((os.path.join(current_dir,filename),os.path.join(target_dir,filename),
+                          os.path.normpath(os.path.join(rel_dir,filename))))
+    return CopyFiles(pairs)
+
+
+def HashFile(filename,budget=None):
+    # MD5 of a file already in place, read in copy_buffer sized pieces and
+    # paced by an IOBudget if one is given
+    md5 = hashlib.md5()
+    f = open(filename,'rb')
+    while 1:
+        buf = f.read(copy_buffer)
+        if not buf:
+            break
+        md5.update(buf)
+        if budget is not None:
+            budget.consume(len(buf))
+    f.close()
+    return md5.hexdigest()
+
+
+def StatSignature(filename):
+    # (size,mtime in ns,inode) of a file: if any of these change, so may its MD5
+    st = os.stat(filename)
+    return (st.st_size,int(st.st_mtime * 1000000000),st.st_ino)
+
+
+def CachedHashFile(filename,budget=None):
+    # HashFile, unless the digest cache knows this file and its stat signature
+    # hasn't changed since
+    if Digests is None:
+        return HashFile(filename,budget)
+    signature = StatSignature(filename)
+    digest = Digests.lookup(filename,signature)
+    if digest is None:
+        digest = HashFile(filename,budget)
+        Digests.store(filename,signature,digest)
+    return digest
+
+
+class DigestCache:
+    # The MD5 of every file we have checksummed, with the stat signature it
+    # had at the time, in a SQLite database.  An entry is only used while the
+    # file's size, mtime and inode are unchanged.  The files of each verified
+    # analysis are listed in a second table, so the database doubles as an
+    # index of the archive by analysis_id and by content (md5 and size).
+    schema = """CREATE TABLE IF NOT EXISTS digests (
+                    path     TEXT PRIMARY KEY,
+                    size     INTEGER,
+                    mtime_ns INTEGER,
+                    inode    INTEGER,
+                    md5      TEXT,
+                    checked  REAL);
+                CREATE INDEX IF NOT EXISTS digests_md5 ON digests (md5);
+                CREATE TABLE IF NOT EXISTS analyses (
+                    analysis_id TEXT,
+                    name        TEXT,
+                    path        TEXT,
+                    PRIMARY KEY (analysis_id,name))"""
+
+    # Tries at creating the tables before giving up on the cache
+    connect_attempts = 5
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.lock     = threading.Lock()
+        self.db       = self.connect()
+        self.hits     = 0
+        self.misses   = 0
+        self.uuids    = None            # analysis_ids and md5s in the database,
+        self.md5s     = None            # loaded by contents() the first time
+
+    def connect(self):
+        # Two runs started together both create the tables.  The write lock
+        # is taken before the schema is read, but the loser of the race can
+        # still see "database schema has changed" or a lock, so try again on
+        # a fresh connection rather than run without the cache.
+        for attempt in range(self.connect_attempts):
+            db = sqlite3.connect(self.filename,timeout=60,check_same_thread=False)
+            try:
+                db.executescript("BEGIN IMMEDIATE;\n%s;\nCOMMIT;" % self.schema)
+                return db
+            except sqlite3.OperationalError:
+                db.close()
+                if attempt == self.connect_attempts - 1:
+                    raise
+                time.sleep(0.1 * (attempt + 1))
+
+    def lookup(self,path,signature):
+        with self.lock:
+            row = self.db.execute("SELECT size,mtime_ns,inode,md5 FROM digests WHERE path = ?",
+                                  (path,)).fetchone()
+            if row is not None and tuple(row[:3]) == signature:
+                self.hits += 1
+                return row[3]
+            self.misses += 1
+            return None
+
+    def load(self,prefix):
+        # {path: (signature,md5)} for everything under prefix, for --audit
+        with self.lock:
+            under = prefix.rstrip('/') + '/'
+            rows = self.db.execute("SELECT path,size,mtime_ns,inode,md5 FROM digests "
+                                   "WHERE path = ? OR substr(path,1,?) = ?",(prefix,len(under),under))
+            return dict((row[0],(tuple(row[1:4]),row[4])) for row in rows)
+
+    def store(self,path,signature,md5):
+        self.store_many([(path,signature,md5)])
+
+    def store_many(self,entries):
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO digests (path,size,mtime_ns,inode,md5,checked) "
+                                "VALUES (?,?,?,?,?,?)",
+                                [(path,) + tuple(signature) + (md5,now) for path,signature,md5 in entries])
+            self.db.commit()
+            if self.md5s is not None:
+                self.md5s.update([md5 for path,signature,md5 in entries])
+
+    def evict(self,paths):
+        # Forget files (or whole directories) that have been removed
+        with self.lock:
+            for path in paths:
+                under = path.rstrip('/') + '/'
+                for table in ("digests","analyses"):
+                    self.db.execute("DELETE FROM %s WHERE path = ? OR substr(path,1,?) = ?" % table,
+                                    (path,len(under),under))
+            self.db.commit()
+
+    def record(self,uuid,files):
+        # Note where the (name,path) files of a verified analysis are
+        with self.lock:
+            self.db.execute("DELETE FROM analyses WHERE analysis_id = ?",(uuid,))
+            self.db.executemany("INSERT OR REPLACE INTO analyses (analysis_id,name,path) VALUES (?,?,?)",
+                                [(uuid,name,path) for name,path in files])
+            self.db.commit()
+            if self.uuids is not None:
+                self.uuids.add(uuid)
+
+    def contents(self):
+        # (analysis_ids,md5s): every analysis recorded and every MD5 stored,
+        # read in two queries and then kept up to date in memory.  Entries
+        # are not dropped on evict(), so these only rule things out.
+        with self.lock:
+            if self.uuids is None:
+                self.uuids = set([row[0] for row in self.db.execute("SELECT DISTINCT analysis_id FROM analyses")])
+                self.md5s  = set([row[0] for row in self.db.execute("SELECT DISTINCT md5 FROM digests")])
+            return self.uuids,self.md5s
+
+    def analysis(self,uuid):
+        # [(name,path,signature,md5)] for the files recorded for uuid; a file
+        # that is no longer in the digests table has a signature of Nones
+        with self.lock:
+            rows = self.db.execute("SELECT a.name,a.path,d.size,d.mtime_ns,d.inode,d.md5 "
+                                   "FROM analyses a LEFT JOIN digests d ON d.path = a.path "
+                                   "WHERE a.analysis_id = ?",(uuid,)).fetchall()
+        return [(row[0],row[1],tuple(row[2:5]),row[5]) for row in rows]
+
+    def find(self,md5,size):
+        # [(path,signature)] for the files known to have this content
+        with self.lock:
+            rows = self.db.execute("SELECT path,size,mtime_ns,inode FROM digests WHERE md5 = ? AND size = ?",
+                                   (md5,size)).fetchall()
+        return [(row[0],tuple(row[1:4])) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class IOBudget:
+    # Paces the reads of several threads to a shared rate in MB/s, but only
+    # while busy() says there is something (gtdownload) to make room for
+    def __init__(self,rate,busy):
+        self.rate      = rate * Bytes2MB
+        self.busy      = busy
+        self.lock      = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self,count):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            if not self.busy():
+                self.next_time = now
+                return
+            self.next_time = max(now,self.next_time) + float(count) / self.rate
+            delay = self.next_time - now
+        time.sleep(delay)
+
+
+def HashFiles(uuid,file_dir,names):
+    # MD5 of the named files in file_dir, in parallel, with an md5 span for
+    # each.  Returns a dict of name -> md5 (None if the file can't be read).
+    def hash_one(name):
+        filename = os.path.join(file_dir,name)
+        with RunMetrics.span('md5',uuid) as span:
+            span.extra['file'] = name
+            try:
+                digest = CachedHashFile(filename)
+                span.bytes = os.path.getsize(filename)
+            except (IOError,OSError), err:
+                print ("ERROR: Failed to read %s: %s") % (filename,err)
+                sys.stdout.flush()
+                digest = None
+                span.status = "failed"
+        return name,digest
+
+    return dict(InParallel(hash_one,names))
+
+
+def CGQuery(uuids,manifests=None):
+    # Ask CGHub for the state of one or more analysis_ids.  Returns a dict of
+    # analysis_id -> state ("live" means downloadable), or None if cgquery
+    # failed.  UUIDs that cgquery says nothing about are left out.  If a
+    # manifests dict is given, the (filename,filesize,checksum) of each file
+    # in each analysis is added to it.
+    if len(uuids) == 1:
+        cgquery_cmd = [CGQueryExecutable,"analysis_id=%s" % uuids[0],"-a"]
+    else:
+        cgquery_cmd = [CGQueryExecutable,"analysis_id=(%s)" % " OR ".join(uuids),"-a"]
+    if debug:
+        print ("\n>>>>>> cgquery command = %s") % ' '.join(cgquery_cmd)
+        sys.stdout.flush()
+    with RunMetrics.span('cgquery',len(uuids) == 1 and uuids[0] or None) as span:
+        cgquery_process = Processes.spawn(cgquery_cmd,merge_stderr=0,timeout=cgquery_timeout)
+        cgquery_process.wait()
+        cgquery_out,cgquery_err = cgquery_process.stdout,cgquery_process.stderr
+        span.bytes = len(cgquery_out)
+        span.extra['uuids'] = len(uuids)
+        if cgquery_process.returncode != 0:
+            span.status = "failed"
+    if gt_debug:
+        print (">>>>>> cgquery stdout:\n%s\n\ncgquery stderr:\n%s") % (cgquery_out,cgquery_err)
+    if cgquery_process.returncode != 0:
+        if cgquery_process.cancelled:
+            print ("ERROR: Stopped cgquery (%s)") % cgquery_process.cancelled
+        print ("ERROR: Failed on command '%s'") % cgquery_process.command()
+        sys.stdout.flush()
+        return None
+
+    # Pick up the state of each analysis, and the files listed under it
+    states = dict()
+    files  = dict()
+    current_uuid = None
+    in_files     = 0
+    for line in cgquery_out.splitlines():
+        if line.strip() == "files":
+            in_files = 1
+            continue
+        fields = line.split(':',1)
+        if len(fields) != 2:
+            continue
+        key   = fields[0].strip()
+        value = fields[1].strip()
+        if key == "analysis_id":
+            current_uuid = value
+            in_files     = 0
+        elif current_uuid not in uuids or value == '':
+            continue
+        elif key == "state" and current_uuid not in states:
+            states[current_uuid] = value.split()[0]
+        elif in_files and key == "filename":
+            files.setdefault(current_uuid,list()).append([value,0,""])
+        elif in_files and key == "filesize" and current_uuid in files and value.isdigit():
+            files[current_uuid][-1][1] = int(value)
+        elif in_files and key == "checksum" and current_uuid in files:
+            files[current_uuid][-1][2] = value.split()[0]
+    if manifests is not None:
+        for uuid,manifest in files.items():
+            manifests[uuid] = [tuple(entry) for entry in manifest]
+
+    success_string = "All matching objects are in a downloadable state."
+    if (cgquery_out.find(success_string) != -1):
+        if len(uuids) == 1:
+            found = uuids
+        else:
+            found = [uuid for uuid in uuids if cgquery_out.find(uuid) != -1]
+        return dict((uuid,"live") for uuid in found)
+    if len(uuids) == 1 and len(states) == 0:
+        state_loc = cgquery_out.find("state_count")
+        if state_loc != -1:
+            states[uuids[0]] = cgquery_out[state_loc:].split()[1]
+    return states
+
+
+def LoadCGQueryCache(filename,ttl):
+    # Read the cgquery cache of (state,time,files) by UUID, dropping anything
+    # older than ttl seconds
+    cache = dict()
+    if ttl <= 0 or not os.path.exists(filename):
+        return cache
+    try:
+        f = open(filename,'r')
+        entries = json.load(f)
+        f.close()
+    except (IOError,ValueError):
+        return cache
+    now = time.time()
+    for uuid,entry in entries.items():
+        # Caches written before the file lists were kept have no files
+        if now - entry[1] < ttl:
+            cache[uuid] = (entry[0],entry[1],len(entry) > 2 and entry[2] or None)
+    return cache
+
+
+def SaveCGQueryCache(filename,cache):
+    # The cache may be shared with other runs (--distributed)
+    tmp_name = filename + ".%d.tmp" % os.getpid()
+    f = open(tmp_name,'w')
+    json.dump(cache,f)
+    f.close()
+    os.rename(tmp_name,filename)
+
+
+def CGQueryPreflight(uuids):
+    # Look up the CGHub state and file list of every UUID in the queue before
+    # downloading.  Fresh answers come from the cache; the rest are queried in
+    # batches of preflight_batch UUIDs, preflight_workers batches at a time.
+    # Returns (states,manifests).
+    from multiprocessing.pool import ThreadPool
+
+    cache     = LoadCGQueryCache(CGQueryCacheName,preflight_ttl)
+    states    = dict()
+    manifests = dict()
+    pending   = list()
+    for uuid in uuids:
+        if uuid in cache:
+            states[uuid] = cache[uuid][0]
+            if cache[uuid][2]:
+                manifests[uuid] = [tuple(entry) for entry in cache[uuid][2]]
+        elif uuid not in pending:
+            pending.append(uuid)
+    if verbose:
+        print ("cgquery pre-flight: %d UUID(s) cached, %d to query") % (len(states),len(pending))
+        sys.stdout.flush()
+
+    batches = [pending[i:i+preflight_batch] for i in range(0,len(pending),preflight_batch)]
+    if len(batches) > 0:
+        pool = ThreadPool(min(preflight_workers,len(batches)))
+        results = pool.map(lambda batch: CGQuery(batch,manifests),batches)
+        pool.close()
+        pool.join()
+        now = time.time()
+        for batch_states in results:
+            if batch_states is None:
+                continue
+            for uuid,state in batch_states.items():
+                states[uuid] = state
+                cache[uuid]  = (state,now,manifests.get(uuid))
+        if preflight_ttl > 0:
+            SaveCGQueryCache(CGQueryCacheName,cache)
+    return states,manifests
+
+
+def CGQueryMetadata(uuids):
+    # Everything CGHub knows about one or more analysis_ids, from the XML that
+    # cgquery -o writes.  Returns a dict of analysis_id -> {'fields': the
+    # simple elements of its Result, 'files': [(filename,filesize,checksum)]},
+    # or None if cgquery failed.
+    import tempfile
+    from xml.etree import cElementTree as ElementTree
+
+    fd,xml_name = tempfile.mkstemp(prefix=".cgquery.",suffix=".xml",dir=os.path.dirname(MetadataCacheName))
+    os.close(fd)
+    if len(uuids) == 1:
+        query = "analysis_id=%s" % uuids[0]
+    else:
+        query = "analysis_id=(%s)" % " OR ".join(uuids)
+    cgquery_cmd = [CGQueryExecutable,query,"-a","-o",xml_name]
+    if debug:
+        print ("\n>>>>>> cgquery command = %s") % ' '.join(cgquery_cmd)
+        sys.stdout.flush()
+    try:
+        with RunMetrics.span('cgquery') as span:
+            cgquery_process = Processes.spawn(cgquery_cmd,merge_stderr=0,timeout=cgquery_timeout)
+            cgquery_process.wait()
+            span.bytes = os.path.getsize(xml_name)
+            span.extra.update(uuids=len(uuids),metadata=1)
+            if cgquery_process.returncode != 0:
+                span.status = "failed"
+        if cgquery_process.returncode != 0:
+            if cgquery_process.cancelled:
+                print ("ERROR: Stopped cgquery (%s)") % cgquery_process.cancelled
+            print ("ERROR: Failed on command '%s'") % cgquery_process.command()
+            sys.stdout.flush()
+            return None
+
+        results = dict()
+        try:
+            for event,elem in ElementTree.iterparse(xml_name):
+                if elem.tag != "Result":
+                    continue
+                fields = dict((child.tag,(child.text or "").strip()) for child in elem if len(child) == 0)
+                files  = list()
+                for entry in elem.iter("file"):
+                    size = (entry.findtext("filesize") or "").strip()
+                    files.append(((entry.findtext("filename") or "").strip(),size.isdigit() and int(size) or 0,
+                                  (entry.findtext("checksum") or "").strip()))
+                if fields.get("analysis_id") in uuids:
+                    results[fields["analysis_id"]] = {'fields': fields, 'files': files}
+                elem.clear()
+        except SyntaxError, err:
+            print ("ERROR: Can't parse the cgquery output for %d UUID(s): %s") % (len(uuids),err)
+            sys.stdout.flush()
+            return None
+        return results
+    finally:
+        os.remove(xml_name)
+
+
+def LoadMetadataCache(filename):
+    # The cgquery metadata kept by --ingest, by analysis_id
+    if not os.path.exists(filename):
+        return dict()
+    try:
+        f = open(filename,'r')
+        cache = json.load(f)
+        f.close()
+    except (IOError,ValueError):
+        return dict()
+    return cache
+
+
+# Names used in the requests files for some of CGHub's codes
+StudyNames    = {'phs000178': 'TCGA', 'TCGA': 'TCGA'}
+PlatformNames = {'ILLUMINA': 'Illumina', 'ABI_SOLID': 'ABI SOLiD', 'LS454': '454',
+                 'COMPLETE_GENOMICS': 'Complete Genomics', 'ION_TORRENT': 'Ion Torrent',
+                 'PACBIO_SMRT': 'PacBio'}
+
+# The columns a row needs before it can be downloaded
+RequiredColumns = ('filename','files_size','checksum','disease','barcode','library_type','platform_name')
+
+
+def CGHubDate(value):
+    # 2012-06-22T10:41:04Z as 6/22/2012, the way the requests files have it
+    try:
+        date = datetime.strptime(value[:10],'%Y-%m-%d')
+    except ValueError:
+        return value
+    return "%d/%d/%d" % (date.month,date.day,date.year)
+
+
+def MetadataRow(uuid,label,metadata):
+    # The requests file columns for an analysis from its cgquery metadata.
+    # The row is for the first BAM of the analysis (the other files come with
+    # it, from the manifest).
+    fields = metadata['fields']
+    files  = [entry for entry in metadata['files'] if entry[0].endswith('.bam')] or metadata['files']
+    get    = lambda name: fields.get(name,"")
+    row = {'study':            StudyNames.get(get('study'),get('study')),
+           'barcode':          get('legacy_sample_id'),
+           'disease':          get('disease_abbr'),
+           'sample_type':      get('sample_type'),
+           'analyte_type':     get('analyte_code'),
+           'library_type':     get('library_strategy'),
+           'center':           get('center_name'),
+           'center_name':      get('center_name'),
+           'platform':         get('platform'),
+           'platform_name':    PlatformNames.get(get('platform'),get('platform').title()),
+           'assembly':         get('refassem_short_name'),
+           'analysis_id':      uuid,
+           'aliquot_id':       get('aliquot_id'),
+           'participant_id':   get('participant_id'),
+           'sample_id':        get('sample_id'),
+           'tss_id':           get('tss_id'),
+           'sample_accession': get('sample_accession'),
+           'published':        CGHubDate(get('published_date')),
+           'uploaded':         CGHubDate(get('upload_date')),
+           'modified':         CGHubDate(get('last_modified')),
+           'state':            get('state').capitalize()}
+    if files:
+        row['filename']   = files[0][0]
+        row['files_size'] = str(files[0][1])
+        row['checksum']   = (files[0][2].split() or [""])[0]
+    if label:
+        row['label'] = label
+    # Tabs and newlines would break the file
+    for name,value in row.items():
+        if isinstance(value,unicode):
+            value = value.encode('utf-8')
+        row[name] = ' '.join(value.split())
+    return row
+
+
+def ReadUUIDList(filename):
+    # [(label,analysis_id)] from a CSV of label,uuid lines (or any CSV with a
+    # UUID in each row; the first other non-empty cell is taken as the
+    # label).  Header lines and repeated UUIDs are skipped.
+    import csv
+    uuid_re = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+    entries = list()
+    seen    = set()
+    f = open(filename,'rU')
+    for cells in csv.reader(f):
+        cells = [cell.strip() for cell in cells]
+        uuids = [cell for cell in cells if uuid_re.match(cell)]
+        if not uuids:
+            continue
+        uuid = uuids[0].lower()
+        if uuid in seen:
+            continue
+        seen.add(uuid)
+        labels = [cell for cell in cells if cell and cell != uuids[0]]
+        entries.append((labels and labels[0] or "",uuid))
+    f.close()
+    return entries
+
+
+def IngestManifest(csv_name,requests_name):
+    # Turn a bare list of UUIDs into rows of the requests file (--ingest).
+    # The metadata comes from cgquery, preflight_batch UUIDs per query and
+    # preflight_workers queries at a time, and is kept in MetadataCacheName
+    # so that ingesting a longer list later only looks up the new UUIDs.
+    # Rows already in the file are only filled in where they are missing
+    # something they need, unless --refresh-metadata is given.  Returns how
+    # many UUIDs could not be added.
+    from multiprocessing.pool import ThreadPool
+
+    entries = ReadUUIDList(csv_name)
+    print ("\n                                  MANIFEST INGEST")
+    print ("====================================================================================")
+    print ("UUID list         = %s (%d UUIDs)") % (csv_name,len(entries))
+    print ("BAM requests file = %s") % requests_name
+    sys.stdout.flush()
+    ingest_start = time.time()
+
+    if not os.path.exists(requests_name):
+        f = open(requests_name,'w')
+        f.write('\t'.join(RequestColumns) + '\n')
+        f.close()
+    requests = RequestTable(requests_name,checkpoint_updates,checkpoint_interval,distributed)
+
+    # Which UUIDs need anything, and which of those cgquery has to be asked about
+    needed   = list()
+    complete = 0
+    for label,uuid in entries:
+        if (uuid in requests.index and not refresh_metadata and
+            all([requests.get(uuid,name) for name in RequiredColumns])):
+            complete += 1
+        else:
+            needed.append((label,uuid))
+    cache   = LoadMetadataCache(MetadataCacheName)
+    pending = [uuid for label,uuid in needed if refresh_metadata or uuid not in cache]
+    cached  = len(needed) - len(pending)
+    if verbose:
+        print ("%d UUID(s) already complete, %d in the metadata cache, %d to look up") % \
+              (complete,cached,len(pending))
+        sys.stdout.flush()
+
+    batches = [pending[i:i+preflight_batch] for i in range(0,len(pending),preflight_batch)]
+    failed  = set()
+    if batches:
+        pool = ThreadPool(min(preflight_workers,len(batches)))
+        results = pool.map(CGQueryMetadata,batches)
+        pool.close()
+        pool.join()
+        now = time.time()
+        for batch,metadata in zip(batches,results):
+            if metadata is None:
+                failed.update(batch)
+                continue
+            for uuid,entry in metadata.items():
+                entry['fetched'] = now
+                cache[uuid] = entry
+        SaveCGQueryCache(MetadataCacheName,cache)
+
+    new_rows   = list()
+    updates    = list()
+    not_found  = list()
+    incomplete = list()
+    for label,uuid in needed:
+        if uuid in failed:
+            continue
+        if uuid not in cache:
+            not_found.append((label,uuid))
+            continue
+        row = MetadataRow(uuid,label,cache[uuid])
+        missing = [name for name in RequiredColumns if not row.get(name)]
+        if missing:
+            incomplete.append((label,uuid,missing))
+            continue
+        if uuid not in requests.index:
+            row['status'] = ""
+            new_rows.append(row)
+            continue
+        # Only what has changed, and never the download columns
+        fields = dict((name,value) for name,value in row.items()
+                      if value and requests.get(uuid,name) != value and
+                      (name != 'label' or not requests.get(uuid,name)))
+        if fields:
+            updates.append((uuid,fields))
+    if new_rows:
+        requests.add_rows(new_rows)
+    if updates:
+        requests.update_many(updates)
+    requests.close()
+
+    for label,uuid in not_found:
+        print ("NOT FOUND    %s %s") % (uuid,label)
+    for label,uuid,missing in incomplete:
+        print ("INCOMPLETE   %s %s (no %s)") % (uuid,label,', '.join(missing))
+    print ("------------------------------------------------------------------------------------")
+    print ("%7d UUIDs listed (%d already complete in the requests file)") % (len(entries),complete)
+    print ("%7d looked up with cgquery (%d from the metadata cache)") % (len(pending),cached)
+    print ("%7d rows added") % len(new_rows)
+    print ("%7d rows updated") % len(updates)
+    print ("%7d not found") % len(not_found)
+    if failed:
+        print ("%7d not looked up (cgquery failed)") % len(failed)
+    print ("%7d without the metadata needed to download them") % len(incomplete)
+    print ("Ingest took %s\n") % FormatElapsed(time.time() - ingest_start)
+    return len(not_found) + len(incomplete) + len(failed)
+
+
+class RunHistory:
+    # Every gtdownload attempt, with the limits it ran under and how long each
+    # stage took, kept in a SQLite database across runs for --report
+    schema = """CREATE TABLE IF NOT EXISTS attempts (
+                    id           INTEGER PRIMARY KEY,
+                    uuid         TEXT,
+                    center       TEXT,
+                    platform     TEXT,
+                    size         INTEGER,
+                    attempt      INTEGER,
+                    host         TEXT,
+                    worker       TEXT,
+                    started      REAL,
+                    bytes        INTEGER,
+                    download_s   REAL,
+                    copy_s       REAL,
+                    md5_s        REAL,
+                    max_children INTEGER,
+                    rate_limit   INTEGER,
+                    exit_code    INTEGER,
+                    status       TEXT)"""
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.lock     = threading.Lock()
+        self.db       = sqlite3.connect(filename,timeout=60,check_same_thread=False)
+        self.db.execute(self.schema)
+        self.db.commit()
+
+    def record(self,**fields):
+        # Add one attempt; returns its id for update()
+        names = sorted(fields.keys())
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO attempts (%s) VALUES (%s)" % \
+                                     (','.join(names),','.join(['?'] * len(names))),
+                                     [fields[name] for name in names])
+            self.db.commit()
+            return cursor.lastrowid
+
+    def update(self,attempt_id,**fields):
+        names = sorted(fields.keys())
+        with self.lock:
+            self.db.execute("UPDATE attempts SET %s WHERE id = ?" % \
+                            ','.join(["%s = ?" % name for name in names]),
+                            [fields[name] for name in names] + [attempt_id])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def HistoryReport(filename):
+    # Throughput percentiles of the successful attempts in a --history
+    # database, by center, platform, hour of day and gtdownload child count
+    db = sqlite3.connect(filename)
+    rows = db.execute("SELECT center,platform,started,max_children,bytes,download_s,exit_code "
+                      "FROM attempts").fetchall()
+    db.close()
+    print ("\n                                 THROUGHPUT REPORT")
+    print ("====================================================================================")
+    print ("History file = %s") % filename
+    if not rows:
+        print ("No download attempts recorded yet.\n")
+        return
+    print ("%d attempts since %s\n") % \
+          (len(rows),datetime.fromtimestamp(min([row[2] for row in rows])).strftime(TimeFormat))
+    groupings = (('Center',       lambda row: row[0] or "?"),
+                 ('Platform',     lambda row: row[1] or "?"),
+                 ('Hour of day',  lambda row: "%02d:00" % datetime.fromtimestamp(row[2]).hour),
+                 ('Children',     lambda row: row[3]))
+    for title,key in groupings:
+        attempts = dict()
+        rates    = dict()
+        for row in rows:
+            group = key(row)
+            attempts[group] = attempts.get(group,0) + 1
+            if row[6] == 0 and row[5] > 0:
+                rates.setdefault(group,list()).append(float(row[4]) / Bytes2MB / row[5])
+        print ("%-24s %9s %9s %10s %10s %10s") % (title,'Attempts','Failed','p10 MB/s','p50 MB/s','p90 MB/s')
+        print ("------------------------------------------------------------------------------------")
+        for group in sorted(attempts.keys()):
+            group_rates = rates.get(group,[])
+            if group_rates:
+                percentiles = "%10.1f %10.1f %10.1f" % (Percentile(group_rates,10),Percentile(group_rates,50),
+                                                        Percentile(group_rates,90))
+            else:
+                percentiles = "%10s %10s %10s" % ('-','-','-')
+            print ("%-24s %9d %9d %s") % (group,attempts[group],attempts[group] - len(group_rates),percentiles)
+        print ("")
+
+
+def AuditArchive(filename):
+    # Check every Finished or Live file in the requests file against its
+    # checksum.  Files the digest cache knows, with an unchanged size, mtime
+    # and inode, are not read again, so an audit costs a stat() per file plus
+    # a read of whatever is new or has changed.  Digests of files that have
+    # gone are evicted.  Returns the number of problems found.
+    f = open(filename,'r')
+    column_names = f.readline().strip().split('\t')
+    col = dict((name,column_names.index(name)) for name in
+               ('filename','analysis_id','checksum','status','disease','barcode','library_type','platform_name'))
+    entries = list()
+    for line in f:
+        data = line.rstrip('\n').split('\t')
+        if len(data) < len(column_names):
+            data.extend([""] * (len(column_names) - len(data)))
+        if data[col['status']] not in ("Finished","Live"):
+            continue
+        bam = BAMinfo(data[col['filename']],data[col['analysis_id']],0,data[col['checksum']],"","",
+                      data[col['status']],data[col['disease']],data[col['barcode']],data[col['library_type']],
+                      data[col['platform_name']])
+        entries.append(([os.path.join(root,bam.localname) for root in dest_roots],bam.checksum))
+    f.close()
+
+    print ("\n                                   ARCHIVE AUDIT")
+    print ("====================================================================================")
+    print ("BAM requests file = %s") % filename
+    print ("Target directory  = %s") % ', '.join(dest_roots)
+    print ("Digest cache      = %s") % (Digests is not None and Digests.filename or "none")
+    sys.stdout.flush()
+    audit_start = time.time()
+
+    def stat_one(entry):
+        # (path,signature) of the file on whichever target directory has it
+        for path in entry[0]:
+            try:
+                return path,StatSignature(path)
+            except OSError:
+                pass
+        return entry[0][0],None
+
+    def hash_one(entry):
+        path,checksum,signature = entry
+        try:
+            return path,signature,HashFile(path)
+        except (IOError,OSError), err:
+            print ("ERROR: Failed to read %s: %s") % (path,err)
+            sys.stdout.flush()
+            return path,signature,None
+
+    # stat() everything (in parallel, for network filesystems), then read
+    # only the files without an up to date digest
+    located    = InParallel(stat_one,entries)
+    entries    = [(path,checksum) for (path,signature),(paths,checksum) in zip(located,entries)]
+    signatures = [signature for path,signature in located]
+    known = dict()
+    if Digests is not None:
+        for root in dest_roots:
+            known.update(Digests.load(root))
+    missing  = list()
+    digests  = dict()
+    to_hash  = list()
+    for (path,checksum),signature in zip(entries,signatures):
+        if signature is None:
+            missing.append(path)
+        elif path in known and known[path][0] == signature:
+            digests[path] = known[path][1]
+        else:
+            to_hash.append((path,checksum,signature))
+    cached = len(digests)
+    hashed = InParallel(hash_one,to_hash)
+    fresh  = list()
+    for path,signature,digest in hashed:
+        digests[path] = digest
+        if digest is not None:
+            fresh.append((path,signature,digest))
+    if Digests is not None and fresh:
+        Digests.store_many(fresh)
+
+    unreadable = list()
+    bad        = list()
+    for path,checksum in entries:
+        if path not in digests:
+            continue
+        if digests[path] is None:
+            unreadable.append(path)
+        elif digests[path] != checksum:
+            bad.append((path,checksum,digests[path]))
+    for path in missing:
+        print ("MISSING      %s") % path
+    for path in unreadable:
+        print ("UNREADABLE   %s") % path
+    for path,checksum,digest in bad:
+        print ("BAD CHECKSUM %s (expected %s, found %s)") % (path,checksum,digest)
+
+    # Forget the files that have gone, whether or not this requests file lists them
+    gone    = set(missing)
+    evicted = [path for path in known if path in gone or (path not in digests and not os.path.exists(path))]
+    if Digests is not None and evicted:
+        Digests.evict(evicted)
+
+    print ("------------------------------------------------------------------------------------")
+    print ("%7d files checked (%d from the digest cache, %d read)") % (len(entries),cached,len(to_hash))
+    print ("%7d OK") % (len(entries) - len(missing) - len(unreadable) - len(bad))
+    print ("%7d missing") % len(missing)
+    print ("%7d unreadable") % len(unreadable)
+    print ("%7d bad checksums") % len(bad)
+    if evicted:
+        print ("%7d digest cache entries evicted") % len(evicted)
+    print ("Audit took %s\n") % FormatElapsed(time.time() - audit_start)
+    return len(missing) + len(unreadable) + len(bad)
+
+
+def ReconcileArchive(requests):
+    # Rebuild the status of every row from the target directory, without
+    # downloading.  Only the path each row's localname says its file should
+    # be at is looked at (stat()ed in parallel), so the cost is a few system
+    # calls per row however big the archive is.  A file of files_size bytes
+    # is Finished, or Staged if its .gto is still next to it (direct mode
+    # downloads keep it until they are verified).  A smaller one is Partial,
+    # and a Finished or Live row with nothing on disk is Missing; both will be
+    # downloaded again (with a warning for each Live row, as that loses the
+    # record of its delivery).  All of the changes go into one rewrite of the
+    # file.
+    # With several target directories, the one pgrr_file_path names is looked
+    # at first, then the others.
+    column_names = requests.column_names
+    col = dict((name,column_names.index(name)) for name in
+               ('filename','analysis_id','files_size','checksum','status','disease','barcode','library_type',
+                'platform_name'))
+    pgrr_col = 'pgrr_file_path' in column_names and column_names.index('pgrr_file_path') or None
+    rows = list()
+    for data in requests.iterrows():
+        bam = BAMinfo(data[col['filename']],data[col['analysis_id']],0,data[col['checksum']],"","",
+                      data[col['status']],data[col['disease']],data[col['barcode']],data[col['library_type']],
+                      data[col['platform_name']])
+        pgrr_path = pgrr_col is not None and data[pgrr_col] or ""
+        rows.append((bam,data[col['files_size']],pgrr_path))
+
+    print ("\n                                ARCHIVE RECONCILIATION")
+    print ("====================================================================================")
+    print ("BAM requests file = %s") % requests.filename
+    print ("Target directory  = %s") % ', '.join(dest_roots)
+    sys.stdout.flush()
+    reconcile_start = time.time()
+
+    def inspect(row):
+        # (bytes on disk for the UUID, .gto files found) for one row, and
+        # the target directory they were found under
+        bam = row[0]
+        recorded = RootFromPgrr(bam,row[2])
+        roots = [root for root in [recorded] + dest_roots if root is not None]
+        for root in roots:
+            file_name = os.path.join(root,bam.localname)
+            uuid_dir  = os.path.dirname(file_name)
+            if os.path.exists(uuid_dir) or root is roots[-1]:
+                break
+        gtos = [name for name in (os.path.join(os.path.dirname(uuid_dir),bam.uuid + ".gto"),
+                                  os.path.join(local_dir,bam.uuid + ".gto")) if os.path.exists(name)]
+        try:
+            size = os.path.getsize(file_name)
+        except OSError:
+            return None,gtos,root
+        if row[1].isdigit() and size < int(row[1]):
+            # files_size may be the total for an analysis with several files
+            try:
+                size = sum([os.path.getsize(os.path.join(uuid_dir,name)) for name in os.listdir(uuid_dir)])
+            except OSError:
+                pass
+        return size,gtos,root
+
+    results = InParallel(inspect,rows)
+    updates = list()
+    counts  = dict()
+    leftover_gtos = list()
+    for (bam,files_size,pgrr_path),(size,gtos,root) in zip(rows,results):
+        status = bam.status
+        bam.root = root
+        pgrr_file_path = PgrrPath(bam)
+        leftover_gtos.extend([(bam,name) for name in gtos])
+        if size is None:
+            if status in ("Finished","Live","Staged"):
+                status = "Missing"
+            state = "missing"
+        elif not files_size.isdigit():
+            state = "unknown size"
+        elif size >= int(files_size):
+            if size > int(files_size):
+                print ("WARNING: %s is %d bytes; the requests file says %s") % (bam.localname,size,files_size)
+            state = "complete"
+            if gtos:
+                if status not in ("Finished","Live"):
+                    status = "Staged"
+            elif status != "Live":
+                status = "Finished"
+            if status in ("Finished","Live"):
+                LinkFarm(bam)
+        else:
+            state = "partial"
+            status = "Partial"
+        counts[state] = counts.get(state,0) + 1
+
+        fields = dict()
+        if status != bam.status:
+            fields['status'] = status
+            if bam.status == "Live":
+                # The requests file loses its record that this was delivered
+                print ("WARNING: %s was Live but is %s on disk; it is now %s") % (bam.uuid,state,status)
+        if size is not None and pgrr_path != pgrr_file_path:
+            fields['pgrr_file_path'] = pgrr_file_path
+        if fields:
+            updates.append((bam.uuid,fields))
+            if verbose or 'status' in fields:
+                print ("%-10s %s (%s -> %s)") % (state,bam.uuid,bam.status or "Unknown",status or "Unknown")
+
+    for bam,name in leftover_gtos:
+        print ("Leftover .gto for %s (status %s): %s") % (bam.uuid,bam.status or "Unknown",name)
+    if updates:
+        requests.update_many(updates)
+
+    print ("------------------------------------------------------------------------------------")
+    for state in ("complete","partial","missing","unknown size"):
+        print ("%7d %s") % (counts.get(state,0),state)
+    print ("%7d leftover .gto files") % len(leftover_gtos)
+    print ("%7d rows updated") % len(updates)
+    print ("Reconciliation took %s\n") % FormatElapsed(time.time() - reconcile_start)
+
+
+class DownloadJob:
+    # Per-BAM state handed from one stage of DownloadBAM to the next
+    def __init__(self,bam,bam_count):
+        self.bam            = bam
+        self.count          = bam_count
+        self.final_location = os.path.join(TargetRoot(bam),bam.localname)
+        self.start_time     = datetime.now()
+        self.copy_digests   = None
+        self.verified       = 0
+        self.data_rate      = 0
+        self.history_id     = None
+
+
+def DownloadBAM(bam,bam_count):
+    # Download, stage and verify a single BAM.  This is the body of the main
+    # download loop; it is called directly in serial mode and from the
+    # DownloadWorker threads when running several jobs at once (-j).  In
+    # pipeline mode (-P) the stages run in separate threads instead.
+    job = DownloadJob(bam,bam_count)
+    DownloadStage(job)
+    CopyStage(job)
+    VerifyStage(job)
+    CleanupStage(job)
+
+
+def PartialBytes(bam,download_dir):
+    # Bytes of an interrupted download of this BAM left in download_dir.
+    # gtdownload resumes from these as long as the .gto file is still there.
+    gto_name  = os.path.join(download_dir,bam.uuid + ".gto")
+    if not os.path.exists(gto_name):
+        return 0
+    return ManifestBytes(bam,os.path.join(download_dir,bam.uuid))
+
+
+def ManifestBytes(bam,uuid_dir):
+    # Bytes on disk in uuid_dir for the files in the BAM's manifest
+    total = 0
+    for name,size,checksum in bam.manifest():
+        try:
+            total += os.path.getsize(os.path.join(uuid_dir,name))
+        except OSError:
+            pass
+    return total
+
+
+def MissingFiles(bam,uuid_dir):
+    # The files in the BAM's manifest that are not in uuid_dir
+    return [name for name,size,checksum in bam.manifest()
+            if not os.path.exists(os.path.join(uuid_dir,name))]
+
+
+def RemovePartial(bam,download_dir):
+    # Throw away what is left of a download so the next attempt starts afresh
+    import shutil
+    if verbose:
+        print ("Removing partial download of %s from %s") % (bam.uuid,download_dir)
+        sys.stdout.flush()
+    gto_name = os.path.join(download_dir,bam.uuid + ".gto")
+    if os.path.exists(gto_name):
+        os.remove(gto_name)
+    if os.path.isdir(os.path.join(download_dir,bam.uuid)):
+        shutil.rmtree(os.path.join(download_dir,bam.uuid),ignore_errors=True)
+    if Digests is not None:
+        Digests.evict([os.path.join(download_dir,bam.uuid)])
+
+
+def FindDuplicate(bam):
+    # [(name,path)] of files already in the archive that are identical to
+    # every file of the BAM, or None.  Until cgquery has given us the file
+    # list only a verified copy of the same analysis will do, as the digest
+    # cache knows all of its files; after that any file with the same MD5
+    # and size will.  Only files whose stat signature is unchanged since they
+    # were checksummed count, and not those in the staging cache (local_dir),
+    # which come and go.
+    if Digests is None or not dedupe:
+        return None
+    # Most BAMs have no copy anywhere; rule them out without a query each
+    uuids,md5s = Digests.contents()
+    if bam.files is None:
+        if bam.uuid not in uuids:
+            return None
+    elif [1 for name,size,checksum in bam.manifest() if checksum not in md5s]:
+        return None
+
+    def current(path,signature):
+        try:
+            return StatSignature(path) == signature
+        except OSError:
+            return 0
+
+    if bam.files is None:
+        recorded = Digests.analysis(bam.uuid)
+        if not recorded or not [1 for name,path,signature,md5 in recorded
+                                if name == bam.name and md5 == bam.checksum]:
+            return None
+        for name,path,signature,md5 in recorded:
+            if not current(path,signature):
+                return None
+        bam.set_manifest([(name,signature[0],md5) for name,path,signature,md5 in recorded])
+        return [(name,path) for name,path,signature,md5 in recorded]
+
+    duplicates = list()
+    for name,size,checksum in bam.manifest():
+        if not checksum:
+            return None
+        for path,signature in Digests.find(checksum,size):
+            if not path.startswith(os.path.join(local_dir,'')) and current(path,signature):
+                duplicates.append((name,path))
+                break
+        else:
+            return None
+    return duplicates
+
+
+def LinkOrClone(src,dest):
+    # Make dest the same file as src: a hard link, or a reflink clone if they
+    # are on different filesystems (or hard links are not allowed).  Returns
+    # how it was done, or None if neither works.
+    if os.path.exists(dest):
+        if os.path.samefile(src,dest):
+            return "same file"
+        os.remove(dest)
+    try:
+        os.link(src,dest)
+        return "hard link"
+    except OSError:
+        pass
+    try:
+        src_file  = open(src,'rb')
+        dest_file = open(dest,'wb')
+        try:
+            fcntl.ioctl(dest_file.fileno(),FICLONE,src_file.fileno())
+        finally:
+            dest_file.close()
+            src_file.close()
+        st = os.stat(src)
+        os.utime(dest,(st.st_atime,st.st_mtime))
+        return "reflink"
+    except (IOError,OSError):
+        if os.path.exists(dest):
+            os.remove(dest)
+        return None
+
+
+def LinkDuplicate(bam,uuid_dir,duplicates):
+    # Put the BAM's files into uuid_dir as links to the identical copies in
+    # duplicates.  Their digests carry over, so verifying them reads nothing.
+    # If any file can't be linked the others are removed again: gtdownload
+    # must never write into a file that is shared with another analysis.
+    if not os.path.isdir(uuid_dir):
+        os.makedirs(uuid_dir)
+    md5s    = dict((name,checksum) for name,size,checksum in bam.manifest())
+    linked  = list()
+    entries = list()
+    for name,src in duplicates:
+        dest = os.path.join(uuid_dir,name)
+        how  = LinkOrClone(src,dest)
+        if how is None:
+            print ("Can't link %s to %s; downloading %s instead") % (dest,src,bam.uuid)
+            for dest in linked:
+                os.remove(dest)
+            sys.stdout.flush()
+            return 0
+        if how != "same file":
+            linked.append(dest)
+        if verbose:
+            print ("Linked %s to %s (%s)") % (dest,src,how)
+        entries.append((dest,StatSignature(dest),md5s[name]))
+    Digests.store_many(entries)
+    sys.stdout.flush()
+    return 1
+
+
+def IndexBAM(bam,file_dir):
+    # Record the files of a verified BAM under its analysis_id.  Only a file
+    # list from cgquery is complete enough for FindDuplicate to trust.
+    if Digests is not None and bam.files is not None:
+        Digests.record(bam.uuid,[(name,os.path.join(file_dir,name)) for name,size,checksum in bam.manifest()])
+
+
+# Sort keys for the download queue (-o).  Python's sort is stable, so a list
+# of policies is applied right to left and the first one named wins ties last.
+OrderPolicies = {
+    'tsv':         None,
+    'shortest':    lambda bam: bam.size,
+    'largest':     lambda bam: -bam.size,
+    'failed-last': lambda bam: (bam.status == "Failed", bam.attempts),
+    'priority':    lambda bam: -bam.priority,
+}
+
+
+def OrderQueue(bams,policies):
+    ordered = list(bams)
+    for policy in reversed(policies):
+        if OrderPolicies[policy] is not None:
+            ordered.sort(key=OrderPolicies[policy])
+    return ordered
+
+
+def ParseRate(value):
+    # An overall_rate_(MB/s) cell as a float, or None if it holds no rate
+    try:
+        rate = float(value)
+    except ValueError:
+        return None
+    if rate <= 0:
+        return None
+    return rate
+
+
+def Percentile(values,percent):
+    # Nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    rank = int(round(percent / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0,min(len(ordered) - 1,rank))]
+
+
+def Median(values):
+    ordered = sorted(values)
+    middle  = len(ordered) / 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle-1] + ordered[middle]) / 2.0
+
+
+def FormatETA(seconds):
+    (hours,minutes) = divmod(int(seconds) / 60,60)
+    return "%d:%02d" % (hours,minutes)
+
+
+def LoadRequests(requests):
+    # Build the list of pending downloads from a RequestTable, along with the
+    # past overall rates (by center, and for the whole file under None) used
+    # for the ETAs.  Column positions are looked up once, and the status of a
+    # row is checked before anything else about it is parsed, so the rows
+    # that are already done cost little more than a split.
+    source_list      = list()
+    historical_rates = dict()
+    all_rates        = historical_rates.setdefault(None,list())
+    column_names     = requests.column_names
+    col              = dict((name,column_names.index(name)) for name in
+                            ('filename','analysis_id','files_size','checksum','start_time','end_time',
+                             'status','disease','barcode','library_type','platform_name','center',
+                             'download_attempt_num','overall_rate_(MB/s)'))
+    status_col   = col['status']
+    rate_col     = col['overall_rate_(MB/s)']
+    center_col   = col['center']
+    filename_col = col['filename']
+    end_col      = col['end_time']
+    if 'priority' in column_names:
+        priority_col = column_names.index('priority')
+    else:
+        priority_col = None
+    if len(dest_roots) > 1 and 'pgrr_file_path' in column_names:
+        pgrr_col = column_names.index('pgrr_file_path')
+    else:
+        pgrr_col = None
+
+    for data in requests.iterrows():
+        # Past transfer rates feed the ETA estimates
+        if data[rate_col]:
+            rate = ParseRate(data[rate_col])
+            if rate is not None:
+                historical_rates.setdefault(data[center_col],list()).append(rate)
+                all_rates.append(rate)
+        stat = data[status_col]
+        if stat == "Finished":
+            if verbose:
+                print "%-51s: downloaded on %s" % (data[filename_col],data[end_col])
+            continue
+        elif stat == "Live":
+            if verbose:
+                print "%-51s: downloaded on %s and is now live." % (data[filename_col],data[end_col])
+            continue
+        elif stat == "":
+            stat = "Unknown"
+        if debug:
+            print "TSV Column Name       :"
+            print "------------------------------------------------------------------"
+            for i in range(len(column_names)):
+                print ("%-22s:  %s") % (column_names[i],data[i])
+            print ""
+        current = BAMinfo(data[filename_col],data[col['analysis_id']],int(float(data[col['files_size']])),
+                          data[col['checksum']],data[col['start_time']],data[end_col],stat,
+                          data[col['disease']],data[col['barcode']],data[col['library_type']],
+                          data[col['platform_name']])
+        current.center = data[center_col]
+        attempts = data[col['download_attempt_num']]
+        if attempts.isdigit():
+            current.attempts = int(attempts)
+        if priority_col is not None:
+            try:
+                current.priority = float(data[priority_col])
+            except ValueError:
+                current.priority = 0
+        if pgrr_col is not None and data[pgrr_col]:
+            current.root = RootFromPgrr(current,data[pgrr_col])
+        source_list.append(current)
+    if not all_rates:
+        del historical_rates[None]
+    return source_list,historical_rates
+
+
+def DownloadStage(job):
+    # Check the CGHub state of the BAM and run gtdownload until it succeeds
+    global total_download_size, total_bytes_saved, total_bytes_linked
+
+    bam       = job.bam
+    bam_count = job.count
+
+    source_uuid = bam.uuid
+    # An identical copy already in the archive is linked rather than fetched,
+    # and then it should go on the same filesystem
+    duplicates = None
+    if bam.status not in ("Cached","Staged","Finished","Live"):
+        duplicates = FindDuplicate(bam)
+    if duplicates and bam.root is None:
+        for root in dest_roots:
+            if duplicates[0][1].startswith(os.path.join(root,'')):
+                bam.root = root
+                break
+    # Where is this thing finally going to end up?
+    Placer.choose(bam)
+    final_location = os.path.join(TargetRoot(bam),bam.localname)
+
+    # Create the gtdownload command
+    gt_command = [GeneTorrentExecutable]
+    gt_command += ["-t"]            # Timestamp log messages
+    if verbose:
+        gt_command += ["-v"]
+    if gt_debug:
+        gt_command += ["-l","stdout:full"] # Full logging to stdout
+        gt_command += ["-vv"]              # Detailed progress information
+    gt_command += ["-k",str(MAX_WAIT)]
+    gt_command += ["-c",CredentialFile]
+    if direct_mode:
+        direct_mode_path = os.path.dirname(bam.localname)
+        direct_mode_path = os.path.join(os.path.split(direct_mode_path)[:1])[0]
+        direct_mode_path = os.path.join(TargetRoot(bam),direct_mode_path)
+        if debug:
+            print "DEBUG: direct_mode_path = ",direct_mode_path
+        gt_command += ["-p",direct_mode_path]
+        final_location = direct_mode_path + "/" + bam.name
+        download_dir = direct_mode_path
+    else:
+        gt_command += ["-p",local_dir]
+        download_dir = local_dir
+    gt_command += ["-d",source_uuid]
+
+    if debug:
+        print ("DEBUG: final_location = %s") % final_location
+
+    # Tag gtdownload output with the UUID when several jobs share the console
+    if num_jobs > 1:
+        job_tag = ">>>>>> [%s] " % source_uuid[:8]
+    else:
+        job_tag = ">>>>>> "
+
+    # Print the run parameters
+    print ("\nCurrent download (%d of %d): %s") % (bam_count,num_bams,bam.name)
+    print ("====================================================================================")
+    print ("CGHub data source = %s") % source_uuid
+    if direct_mode:
+        print ("Destination       = %s") % (os.path.dirname(final_location) + "/" + bam.uuid)
+    else:
+        print ("Destination       = %s") % os.path.dirname(final_location)
+    sys.stdout.flush()
+
+    # Keep the pruning done by other jobs away from this target directory
+    with StatusLock:
+        ActiveDirs.add(os.path.normpath(os.path.dirname(final_location)))
+
+    # Check to see if the target directory exists and create if necessary.
+    # Remember every level mkdir makes so a failed download can prune just those.
+    target_dir = os.path.normpath(os.path.dirname(final_location))
+    with PruneLock:
+        if not(os.path.exists(target_dir)):
+            if verbose:
+                print ("Creating directory %s") % target_dir
+                sys.stdout.flush()
+            missing = list()
+            path = target_dir
+            while path and not os.path.exists(path):
+                missing.append(path)
+                path = os.path.dirname(path)
+            try:
+                os.makedirs(target_dir)
+            except OSError, err:
+                print ("ERROR: Failed to create %s: %s") % (target_dir,err)
+                sys.stdout.flush()
+            CreatedDirs.update(missing)
+        else:
+            if verbose:
+                print ("Target directory (%s) exists.") % target_dir
+                sys.stdout.flush()
+
+    start_time = datetime.now()
+    do_download=1
+    linked=0
+    attempt=0
+    MAX_ATTEMPTS=5
+    done_fields = dict()
+
+    # If the status is Cached, Staged, Finished, or Live, skip this step
+    if (bam.status == "Cached" or bam.status == "Staged" or bam.status == "Finished" or bam.status == "Live"):
+        print ("This file has already been downloaded. Status = %s") % bam.status
+        do_download = 0
+
+    # The staging cache can't drop what this job is about to use
+    if do_download and not direct_mode:
+        Staging.admit(bam,wait=0)
+
+    uuid_dir = os.path.dirname(os.path.join(TargetRoot(bam),bam.localname))
+    if duplicates and LinkDuplicate(bam,uuid_dir,duplicates):
+        do_download = 0
+        linked = 1
+
+    # Check that the source is downloadable on the CGHub side.  The pre-flight
+    # stage has usually answered this already; otherwise ask cgquery now.
+    # Linked files are already here, whatever CGHub says about them now.
+    if linked:
+        cgquery_state = None
+    elif bam.uuid in PreflightStates:
+        cgquery_state = PreflightStates[bam.uuid]
+    else:
+        manifests = dict()
+        cgquery_states = CGQuery([bam.uuid],manifests)
+        if cgquery_states is None:
+            cgquery_state = None
+        else:
+            cgquery_state = cgquery_states.get(bam.uuid,"Unknown")
+        if bam.uuid in manifests:
+            bam.set_manifest(manifests[bam.uuid])
+            # Now that all of its files are known they may be found elsewhere
+            if do_download and cgquery_state == "live" and duplicates is None:
+                duplicates = FindDuplicate(bam)
+                if duplicates and LinkDuplicate(bam,uuid_dir,duplicates):
+                    do_download = 0
+                    linked = 1
+    if cgquery_state is not None:
+        if cgquery_state != "live":
+            print ("UUID %s is not in a downloadable state. Skipping this entry.") % bam.uuid
+            bam.status = cgquery_state
+            if debug:
+                print ("DEBUG: bam.status = %s") % bam.status
+            Requests.update(bam.uuid,{'status': bam.status, 'state': bam.status})
+            do_download = 0
+        else:
+            Requests.update(bam.uuid,{'state': "Live"})
+            if verbose:
+                print ("UUID %s is in a downloadable state.") % bam.uuid
+
+    # A whole copy still in the staging cache only has to be copied again
+    if do_download and not direct_mode and Staging.reuse(bam):
+        do_download = 0
+        bam.status = "Cached"
+        bam.start_time = bam.end_time = datetime.now()
+        bam.size = ManifestBytes(bam,os.path.join(local_dir,bam.uuid))
+        print (" --- Using the copy of %s in %s") % (bam.uuid,local_dir)
+        done_fields = {'end_time':   bam.end_time.strftime(TimeFormat),
+                       'files_size': str(bam.size),
+                       'status':     bam.status}
+
+    if linked:
+        # Staged like a download, so it is still verified (from the digest cache)
+        bam.status = "Staged"
+        bam.start_time = bam.end_time = datetime.now()
+        bam.size = ManifestBytes(bam,uuid_dir)
+        with StatusLock:
+            total_bytes_linked += bam.size
+        print (" --- Linked %.1f MB from identical files already in the archive") % \
+              (float(bam.size)/Bytes2MB)
+        done_fields = {'end_time':       bam.end_time.strftime(TimeFormat),
+                       'files_size':     str(bam.size),
+                       'status':         bam.status,
+                       'pgrr_file_path': PgrrPath(bam)}
+
+    # Dump some debugging output
+    if debug:
+        print ("DEBUG: Info after cgquery check")
+        bam.bamprint()
+        print ("DEBUG: do_download = %d") % do_download
+        sys.stdout.flush()
+
+    # Start the actual download here.  The do_download variable is used to
+    # short-circuit the download process if necessary (see above)
+    while (do_download and attempt < MAX_ATTEMPTS):
+        # The adaptive controller may change the limits between attempts
+        if Controller is not None:
+            children,bandwidth = Controller.limits()
+        else:
+            children,bandwidth = job_children,job_bandwidth
+        gt_launch = gt_command + ["--max-children",str(children),"--rate-limit",str(bandwidth)]
+        if debug:
+            print ("\nDEBUG: gtdownload command = %s\n") % ' '.join(gt_launch)
+            sys.stdout.flush()
+
+        attempt += 1
+        bam.status = "InProcess"
+        bam.start_time = datetime.now()
+        # A little user output for the log file
+        print (" --- Starting download at %s") % (bam.start_time.strftime(TimeFormat))
+        # Leave any partial data from an earlier attempt in place; gtdownload
+        # picks up from it rather than starting from zero
+        partial_bytes = PartialBytes(bam,download_dir)
+        if partial_bytes > 0:
+            print (" --- Resuming with %.1f MB already on disk") % (float(partial_bytes)/Bytes2MB)
+            bam.bytes_saved += partial_bytes
+        Requests.update(bam.uuid,{'download_attempt_num': str(attempt),
+                                  'status':               bam.status,
+                                  'start_time':           bam.start_time.strftime(TimeFormat),
+                                  'partial_bytes':        str(partial_bytes)})
+        attempt_start = time.time()
+        span = RunMetrics.span('download',bam.uuid)
+        span.extra.update(attempt=attempt,max_children=children,rate_limit=bandwidth)
+        # gtdownload's output goes to the UUID's job log if there is one, with
+        # only its errors (and the progress table) on the console
+        log = None
+        if job_log_dir:
+            try:
+                log = JobLog(bam.uuid,attempt,' '.join(gt_launch))
+            except IOError, err:
+                print ("WARNING: Can't write to the log for %s (%s); its output goes to the console") % \
+                      (bam.uuid,err)
+        last_lines = deque(maxlen=10)
+        if log is not None:
+            print (" --- %s output in %s") % (GeneTorrentExecutable,log.filename)
+        elif verbose:
+            print (">>>>>> %s output:") % GeneTorrentExecutable
+            # A little user output for the log file
+        # The supervisor feeds each line of gtdownload's output to the progress
+        # tracker, which may decide the transfer has stalled.  A gtdownload that
+        # says nothing at all for twice its own -k inactivity limit is stopped too.
+        progress = DownloadProgress(bam.uuid,attempt)
+        progress.children = children
+        with StatusLock:
+            ActiveProgress[bam.uuid] = progress
+        bam.progress_history.append(progress)
+
+        def watch_output(task,out):
+            if log is None:
+                sys.stdout.write(job_tag + out)
+                sys.stdout.flush()
+            else:
+                log.write(out)
+                last_lines.append(out)
+                if "Error:" in out:
+                    sys.stdout.write(job_tag + out)
+                    sys.stdout.flush()
+            if progress.add(out) and not progress.killed:
+                stall_reason = progress.stalled()
+                if stall_reason:
+                    print ("\nERROR: Download of %s has stalled (%s).  Restarting gtdownload.") % \
+                          (bam.uuid,stall_reason)
+                    sys.stdout.flush()
+                    progress.killed = 1
+                    task.cancel(stall_reason)
+
+        gt_process = Processes.spawn(gt_launch,on_line=watch_output,idle_timeout=MAX_WAIT*60*2,new_session=1)
+        if gt_process.process is None:
+            sys.stdout.write(job_tag + gt_process.stderr)
+        gt_process.wait()
+        if log is not None:
+            log.close()
+        if gt_process.cancelled and not progress.killed:
+            print ("\nERROR: Download of %s has stalled (%s).  Restarting gtdownload.") % \
+                  (bam.uuid,gt_process.cancelled)
+            progress.killed = 1
+        if debug:
+            print ("DEBUG: gt_process.poll() != None, the gtdownload process has terminated")
+            sys.stdout.flush()
+        if direct_mode:
+            cached_name = final_dest
+        else:
+            cached_name = "%s/%s/%s" % (local_dir,bam.uuid,bam.name)
+        if debug:
+            print ("DEUBG: cached_name                 = %s") % cached_name
+            print ("DEBUG: os.path.exists(cached_name) = %d") % os.path.exists(cached_name)
+            print ("DEBUG: gt_process.returncode       = %d") % gt_process.returncode
+            sys.stdout.flush()
+        # Every file of the analysis has to be there, not just the BAM
+        missing = MissingFiles(bam,os.path.join(download_dir,bam.uuid))
+        if debug and missing:
+            print ("DEBUG: Missing from %s: %s") % (os.path.join(download_dir,bam.uuid),', '.join(missing))
+        if (gt_process.returncode == 0 and os.path.exists(cached_name) and not missing):
+            if debug:
+                print ("DEBUG: The gtdownload process terminated normally and the file exists on disk")
+            do_download = 0
+            bam.end_time = datetime.now()
+            bam.size = ManifestBytes(bam,os.path.join(download_dir,bam.uuid))
+            with StatusLock:
+                total_download_size += bam.size
+            if debug:
+                print ("DEBUG: Getting size of %s (%d)") % (os.path.join(download_dir,bam.uuid),bam.size)
+            # Either way it is only Finished once it has been verified
+            if direct_mode:
+                bam.status = "Staged"
+            else:
+                bam.status = "Cached"
+            # Written along with the data rate below
+            done_fields = {'end_time':   bam.end_time.strftime(TimeFormat),
+                           'files_size': str(bam.size),
+                           'status':     bam.status}
+        else:
+            if log is not None and last_lines:
+                print ("Last lines of %s output (all of it is in %s):") % (GeneTorrentExecutable,log.filename)
+                sys.stdout.write(''.join([job_tag + line for line in last_lines]))
+            print ("\nERROR: Download process failed with exit code %d.  Retrying.  (Attempt %d of %d)\n\n") % \
+                  (gt_process.returncode,(attempt+1),MAX_ATTEMPTS)
+            bam.end_time = datetime.now()
+            bam.status = "Failed"
+            Requests.update(bam.uuid,{'end_time': bam.end_time.strftime(TimeFormat),
+                                      'status':   bam.status})
+        with StatusLock:
+            if ActiveProgress.get(bam.uuid) is progress:
+                del ActiveProgress[bam.uuid]
+        if bam.status == "Failed":
+            sample = progress.latest()
+            attempt_bytes = sample and sample[1] or 0
+        else:
+            attempt_bytes = bam.size - partial_bytes
+        span.bytes  = attempt_bytes
+        span.status = progress.killed and "stalled" or bam.status.lower()
+        span.extra['exit_code'] = gt_process.returncode
+        span.finish()
+        if History is not None:
+            job.history_id = History.record(uuid=bam.uuid,center=bam.center,platform=bam.platform,
+                                            size=bam.size,attempt=attempt,host=socket.gethostname(),
+                                            worker=worker_id,started=attempt_start,bytes=attempt_bytes,
+                                            download_s=time.time() - attempt_start,
+                                            max_children=children,rate_limit=bandwidth,
+                                            exit_code=gt_process.returncode,
+                                            status=progress.killed and "Stalled" or bam.status)
+
+    # Partial data is only worth keeping while there are attempts left
+    if bam.status == "Failed":
+        RemovePartial(bam,download_dir)
+    if bam.bytes_saved > 0:
+        print (" --- Resumed transfers saved re-downloading %.1f MB") % (float(bam.bytes_saved)/Bytes2MB)
+        with StatusLock:
+            total_bytes_saved += bam.bytes_saved
+
+    # A little user output for the log file
+    print (" --- Finished download at %s") % (bam.end_time.strftime(TimeFormat))
+
+    # How long did this take?
+    elapsed_time = (bam.end_time - bam.start_time).total_seconds()
+    print (" --- Elapsed time for download operation = %s") % FormatElapsed(elapsed_time)
+    sys.stdout.flush()
+
+    # The .gto file is kept until the download has been verified, so that a
+    # file that fails its checksum can be fetched again on its own
+
+    # What was our data rate?
+    if elapsed_time <= 0:
+        data_rate = 0
+    else:
+        data_rate = float(bam.size) / Bytes2MB / elapsed_time
+    if verbose:
+        print (" --- Calculated data rate = %.1f MB/s") % data_rate
+    rate_fields = {'overall_rate_(MB/s)': "%.2f" % data_rate}
+    if direct_mode:
+        rate_fields['pgrr_file_path'] = PgrrPath(bam)
+        # The data is written; what it took counts towards the target's write rate
+        Placer.release(bam,attempt and bam.status == "Staged" and bam.size - partial_bytes,elapsed_time)
+    rate_fields.update(done_fields)
+    Requests.update(bam.uuid,rate_fields)
+
+    job.final_location = final_location
+    job.start_time     = start_time
+
+
+def CopyStage(job):
+    # Copy a cached download into the final destination, hashing it on the way
+    bam            = job.bam
+    final_location = job.final_location
+
+    if (bam.status == "Cached" and not direct_mode):
+        if verbose:
+            print ("Downloaded files(s) will now be copied to %s") % final_location
+
+        # Copy the files
+        # Let's just copy the entire directory instead.  That way we don't have to worry about
+        # specific files inside it.  The MD5 of each file is computed as it is copied, so the
+        # data is only read once.
+        #
+        copy_src    = os.path.join(local_dir,bam.uuid)
+        copy_parent = '/'.join(os.path.split(os.path.dirname(final_location))[:-1])
+        if debug:
+            print ("DEBUG: Copying %s to %s") % (copy_src,copy_parent)
+            sys.stdout.flush()
+        with RunMetrics.span('copy',bam.uuid) as span:
+            try:
+                job.copy_digests,bam.copy_time,bam.hash_time = CopyTreeAndHash(copy_src,copy_parent)
+                span.bytes = bam.size
+                span.extra['hash_seconds'] = round(bam.hash_time,6)
+            except (IOError,OSError), err:
+                print ("ERROR: Failed to copy %s to %s: %s") % (copy_src,copy_parent,err)
+                sys.stdout.flush()
+                job.copy_digests = dict()
+                span.status = "failed"
+        bam.status = "Staged"
+        Requests.update(bam.uuid,{'status':         bam.status,
+                                  'pgrr_file_path': PgrrPath(bam)})
+        Placer.release(bam,span.status != "failed" and bam.size,bam.copy_time)
+        print (" --- Elapsed time for copy operation     = %s") % FormatElapsed(bam.copy_time)
+        sys.stdout.flush()
+    elif bam.status == "suppressed" and verbose:
+        print ("This file is not currenlty available from CGHub. Status = %s") % bam.status
+    elif (bam.status == "Finished" or bam.status == "Staged") and verbose:
+        print ("This file is already in the final destination directory. Status = %s") % bam.status
+    elif verbose:
+        print ("This location/availability of this file is unknown. Status = %s") % bam.status
+
+
+def CheckFiles(bam,digests,names=None):
+    # Compare digests (file name -> md5) with the BAM's manifest, reporting on
+    # each file.  Returns the names of the files that do not match.
+    bad = list()
+    for name,size,checksum in bam.manifest():
+        if names is not None and name not in names:
+            continue
+        my_md5 = digests.get(name,0)
+        if my_md5 != checksum:
+            print ("ERROR: Checksum of %s does not match!") % name
+            print ("ERROR:   - Reference  = %s") % checksum
+            print ("ERROR:   - Calculated = %s") % my_md5
+            bad.append(name)
+        elif verbose:
+            print ("Checksum passed for %s.") % name
+    sys.stdout.flush()
+    return bad
+
+
+def RefetchFiles(job,names):
+    # Fetch just the named files of a cached BAM again.  They are removed from
+    # the cache and the destination, and gtdownload is run over the UUID once
+    # more; the .gto is still there, so it keeps the good files and only
+    # transfers the missing ones.  Returns the digests of the new copies, or
+    # None if the download failed.
+    global total_download_size
+
+    bam        = job.bam
+    cache_dir  = os.path.join(local_dir,bam.uuid)
+    dest_dir   = os.path.dirname(job.final_location)
+    start_time = job.start_time
+    for name in names:
+        for filename in (os.path.join(cache_dir,name),os.path.join(dest_dir,name)):
+            if os.path.exists(filename):
+                os.remove(filename)
+    if Digests is not None:
+        Digests.evict([os.path.join(dest_dir,name) for name in names])
+    # The download stage counts the whole UUID again
+    with StatusLock:
+        total_download_size -= bam.size
+    bam.status = "Failed"
+    DownloadStage(job)
+    job.start_time = start_time
+    if bam.status != "Cached":
+        return None
+
+    with RunMetrics.span('copy',bam.uuid) as span:
+        try:
+            digests,copy_time,hash_time = CopyFiles([(os.path.join(cache_dir,name),os.path.join(dest_dir,name),name)
+                                                     for name in names])
+            bam.copy_time += copy_time
+            bam.hash_time += hash_time
+            span.bytes = ManifestBytes(bam,dest_dir)
+        except (IOError,OSError), err:
+            print ("ERROR: Failed to copy %s to %s: %s") % (cache_dir,dest_dir,err)
+            sys.stdout.flush()
+            digests = dict()
+            span.status = "failed"
+        span.extra['files'] = len(names)
+    bam.status = "Staged"
+    Requests.update(bam.uuid,{'status': bam.status})
+    return digests
+
+
+def RecopyFiles(job,names):
+    # Copy the named files of a cached BAM to the target directory again,
+    # for those whose copy in local_dir still matches the manifest.  Returns
+    # the digests of the new copies (of the bytes read, as with any copy);
+    # the other files have to be fetched.
+    bam      = job.bam
+    dest_dir = os.path.dirname(job.final_location)
+    pairs    = list()
+    for name in names:
+        cached_name = Staging.good_copy(bam,name)
+        if cached_name is not None:
+            pairs.append((cached_name,os.path.join(dest_dir,name),name))
+    if not pairs:
+        return dict()
+    print ("Copying %d of %d file(s) of %s again from %s") % (len(pairs),len(bam.manifest()),bam.uuid,local_dir)
+    sys.stdout.flush()
+    # The bad file may be a link shared with another analysis
+    for cached_name,dest_name,name in pairs:
+        if os.path.exists(dest_name):
+            os.remove(dest_name)
+    if Digests is not None:
+        Digests.evict([dest_name for cached_name,dest_name,name in pairs])
+    with RunMetrics.span('copy',bam.uuid) as span:
+        try:
+            digests,copy_time,hash_time = CopyFiles(pairs)
+            bam.copy_time += copy_time
+            bam.hash_time += hash_time
+            span.bytes = sum([os.path.getsize(dest_name) for cached_name,dest_name,name in pairs])
+        except (IOError,OSError), err:
+            print ("ERROR: Failed to copy %s to %s: %s") % (os.path.join(local_dir,bam.uuid),dest_dir,err)
+            sys.stdout.flush()
+            digests = dict()
+            span.status = "failed"
+        span.extra.update(files=len(pairs),recopy=1)
+    with Staging.changed:
+        Staging.recopies += len(digests)
+    return digests
+
+
+class VerifyPool:
+    # Background checksums for direct mode.  A download that has landed in
+    # the final destination is handed to these threads, so the next download
+    # starts straight away.  While gtdownload is running their reads are held
+    # to verify_rate MB/s so they don't starve its writes.  A BAM is only
+    # Finished once every file matches; the files that don't are removed and
+    # the BAM goes back on the download queue (see NextBAM).
+    def __init__(self,threads,rate):
+        self.jobs      = Queue.Queue()
+        self.budget    = IOBudget(rate,DownloadsRunning)
+        self.threads   = threads
+        self.workers   = list()
+        self.pending   = dict()
+        self.retries   = list()
+        self.refetches = dict()
+        self.changed   = threading.Condition()
+
+    def submit(self,job):
+        with self.changed:
+            self.pending[job.bam.uuid] = job
+        self.jobs.put(job)
+
+    def holds(self,uuid):
+        # True while uuid is being checked or is waiting to be fetched again
+        with self.changed:
+            return uuid in self.pending or uuid in [bam.uuid for bam_count,bam in self.retries]
+
+    def busy(self):
+        with self.changed:
+            return len(self.pending) > 0
+
+    def wait(self,timeout):
+        # Until a check finishes (or timeout seconds)
+        with self.changed:
+            if self.pending and not self.retries:
+                self.changed.wait(timeout)
+
+    def requeue(self,work_queue):
+        # Put the BAMs that failed their checksums back on work_queue; returns how many
+        with self.changed:
+            items = self.retries
+            self.retries = list()
+        for item in items:
+            work_queue.put(item)
+        return len(items)
+
+    def start(self):
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.run,name="verify%d" % (i+1))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def run(self):
+        while 1:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                retry = self.verify(job)
+            except Exception, err:
+                print ("ERROR: Checksum of %s died: %s") % (job.bam.uuid,err)
+                sys.stdout.flush()
+                job.bam.status = "Failed"
+                retry = 0
+            with self.changed:
+                del self.pending[job.bam.uuid]
+                if retry:
+                    self.retries.append((job.count,job.bam))
+                self.changed.notify_all()
+            if not retry:
+                ReleaseBAM(job.bam)
+
+    def verify(self,job):
+        # Check one download; returns 1 if it is to be fetched again
+        global exit_code, total_download_size
+
+        bam        = job.bam
+        parent_dir = os.path.dirname(job.final_location)
+        file_dir   = os.path.join(parent_dir,bam.uuid)
+        hash_start = time.time()
+        digests    = dict()
+        for name,size,checksum in bam.manifest():
+            with RunMetrics.span('md5',bam.uuid) as span:
+                span.extra.update(file=name,background=1)
+                try:
+                    digests[name] = CachedHashFile(os.path.join(file_dir,name),self.budget)
+                    span.bytes = os.path.getsize(os.path.join(file_dir,name))
+                except (IOError,OSError), err:
+                    print ("ERROR: Failed to read %s: %s") % (os.path.join(file_dir,name),err)
+                    sys.stdout.flush()
+                    span.status = "failed"
+        bam.hash_time = time.time() - hash_start
+        print (" --- MD5 checksum of %s (in the background) = %s") % (bam.uuid,FormatElapsed(bam.hash_time))
+        sys.stdout.flush()
+
+        bad = CheckFiles(bam,digests)
+        if bad:
+            bam.status = "Failed"
+        else:
+            bam.status = "Finished"
+        if History is not None and job.history_id is not None:
+            History.update(job.history_id,md5_s=bam.hash_time,status=bam.status)
+
+        if not bad:
+            fields = {'status': bam.status}
+            if Requests.get(bam.uuid,'bad_files'):
+                fields['bad_files'] = ""
+            Requests.update(bam.uuid,fields)
+            gto_name = os.path.join(parent_dir,bam.uuid + ".gto")
+            if os.path.exists(gto_name):
+                os.remove(gto_name)
+            IndexBAM(bam,file_dir)
+            LinkFarm(bam)
+            if verbose:
+                print ("Checksum passed.")
+                bam.bamprint()
+            return 0
+
+        # Keep the good files (and the .gto) so the next download only has to
+        # fetch the bad ones
+        with self.changed:
+            refetches = self.refetches.get(bam.uuid,0) + 1
+            self.refetches[bam.uuid] = refetches
+        if refetches <= MAX_REFETCHES:
+            print ("Fetching %d of %d file(s) of %s again (attempt %d of %d)") % \
+                  (len(bad),len(bam.manifest()),bam.uuid,refetches,MAX_REFETCHES)
+            sys.stdout.flush()
+            for name in bad:
+                if os.path.exists(os.path.join(file_dir,name)):
+                    os.remove(os.path.join(file_dir,name))
+            if Digests is not None:
+                Digests.evict([os.path.join(file_dir,name) for name in bad])
+            with StatusLock:
+                total_download_size -= bam.size
+            Requests.update(bam.uuid,{'status': bam.status, 'bad_files': ','.join(bad)})
+            return 1
+
+        Requests.update(bam.uuid,{'status': bam.status, 'end_time': "", 'bad_files': ','.join(bad)})
+        RemovePartial(bam,parent_dir)
+        PruneEmptyDirs(parent_dir)
+        with StatusLock:
+            exit_code = 5
+        return 0
+
+
+def VerifyStage(job):
+    # Compare the checksum of every file of a staged BAM against the requests
+    # file and the cgquery manifest.  Files that fail are fetched again on
+    # their own, up to MAX_REFETCHES times, before the BAM is marked Failed.
+    # In direct mode this is left to the VerifyPool.
+    global exit_code
+
+    bam            = job.bam
+    final_location = job.final_location
+    copy_digests   = job.copy_digests
+    start_time     = job.start_time
+
+    if (bam.status == "Staged" and direct_mode):
+        Verifier.submit(job)
+    elif (bam.status == "Staged" and not direct_mode):
+        job.verified = 1
+        # Compare the md5sum of each file to BAMinfo.  If we copied them just now
+        # the checksums were computed during the copy; otherwise read the staged
+        # files, several at a time.
+        if copy_digests is not None:
+            digests = copy_digests
+            # Hashed on the way through CopyStage
+            span = RunMetrics.span('md5',bam.uuid)
+            span.bytes = bam.size
+            span.extra['during_copy'] = 1
+            span.finish(bam.hash_time)
+        else:
+            if verbose:
+                print ("Checking md5sum of file(s) after copy.")
+                sys.stdout.flush()
+            hash_start = time.time()
+            digests = HashFiles(bam.uuid,os.path.dirname(final_location),
+                                [name for name,size,checksum in bam.manifest()])
+            bam.hash_time = time.time() - hash_start
+        print (" --- Elapsed time for MD5 checksum       = %s") % FormatElapsed(bam.hash_time)
+        sys.stdout.flush()
+
+        bad = CheckFiles(bam,digests)
+        # A file whose copy in the staging cache is sound is copied again
+        # rather than fetched from CGHub
+        if bad:
+            recopied = RecopyFiles(job,bad)
+            if recopied:
+                bad = [name for name in bad if name not in recopied] + \
+                      CheckFiles(bam,recopied,recopied.keys())
+        refetches = 0
+        while bad and refetches < MAX_REFETCHES:
+            refetches += 1
+            print ("Fetching %d of %d file(s) of %s again (attempt %d of %d)") % \
+                  (len(bad),len(bam.manifest()),bam.uuid,refetches,MAX_REFETCHES)
+            sys.stdout.flush()
+            digests = RefetchFiles(job,bad)
+            if digests is None:
+                break
+            bad = CheckFiles(bam,digests,bad)
+        md5_end = datetime.now()
+
+        if bad:
+            bam.status = "Failed"
+            Requests.update(bam.uuid,{'status': bam.status, 'end_time': "", 'bad_files': ','.join(bad)})
+            # Resuming on top of bad data would only reproduce it
+            RemovePartial(bam,local_dir)
+            with StatusLock:
+                exit_code = 5
+            sys.stdout.flush()
+            # sys.exit(exit_code)
+        else:
+            bam.status = "Finished"
+            elapsed_time = (md5_end - start_time).total_seconds()
+            if elapsed_time <= 0:
+                data_rate = 0
+            else:
+                data_rate = float(bam.size) / Bytes2MB / elapsed_time
+            job.data_rate = data_rate
+            download_speed = "%.2f" % data_rate
+            fields = {'status':              bam.status,
+                      'overall_rate_(MB/s)': download_speed}
+            # Clear the failures left by an earlier run
+            if Requests.get(bam.uuid,'bad_files'):
+                fields['bad_files'] = ""
+            Requests.update(bam.uuid,fields)
+            IndexBAM(bam,os.path.dirname(final_location))
+            LinkFarm(bam)
+            if verbose:
+                print ("Checksum passed.")
+                bam.bamprint()
+
+
+def CleanupStage(job):
+    # Drop the cached copy of a verified BAM, report on it, and prune any
+    # empty directories left behind by a failure
+    bam            = job.bam
+    final_location = job.final_location
+    start_time     = job.start_time
+
+    # The copy and checksum times belong to the last download attempt
+    if History is not None and job.history_id is not None:
+        History.update(job.history_id,copy_s=bam.copy_time,md5_s=bam.hash_time,status=bam.status)
+
+    # The cached copy of a verified BAM stays in the staging cache for as
+    # long as the budget allows
+    if job.verified and bam.status == "Finished":
+        Staging.finish(bam)
+    else:
+        Staging.release(bam)
+    Placer.release(bam)
+
+    if job.verified:
+        end_time = datetime.now()
+        elapsed_time = (end_time - start_time).total_seconds()
+        print (" --- Total time for dataset              = %s") % FormatElapsed(elapsed_time)
+        if bam.status != "Finished" or elapsed_time <= 0:
+            effective_data_rate = 0
+        else:
+            effective_data_rate = float(bam.size) / Bytes2MB / elapsed_time
+        print (" --- Effective data rate = %.1f MB/s") % effective_data_rate
+        print ("====================================================================================\n\n")
+        sys.stdout.flush()
+
+    with StatusLock:
+        ActiveDirs.discard(os.path.normpath(os.path.dirname(final_location)))
+
+    # Prune the directory tree to remove any empty directories if something failed
+    # NOTE: Olga requested this behavior
+    if not (bam.status == "Finished" or bam.status == "Staged"):
+        if debug:
+            print ("DEBUG: Problem with download of %s (status=%s)") % (bam.uuid,bam.status)
+            print ("DEBUG: Checking for empty directories above %s") % os.path.dirname(final_location)
+        PruneEmptyDirs(os.path.dirname(final_location))
+
+
+def PruneEmptyDirs(path):
+    # Walk up from path removing empty directories that this run created.  Stops
+    # at the first level that is not ours, is still in use, or is not empty, so
+    # the cost is the depth of the BAM's path rather than the size of the tree.
+    path = os.path.normpath(path)
+    with PruneLock, RunMetrics.span('prune') as span:
+        span.extra['path'] = path
+        while path in CreatedDirs and not InActiveDir(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            if debug:
+                print ("DEBUG: Removed empty directory %s") % path
+            CreatedDirs.discard(path)
+            path = os.path.dirname(path)
+
+
+def InActiveDir(path):
+    # True if path is, or lies above or below, a directory that a running job is using
+    with StatusLock:
+        for active in ActiveDirs:
+            if active.startswith(path) or path.startswith(active):
+                return 1
+    return 0
+
+
+def QueueDepth():
+    # BAMs not yet handed to a download job
+    if work_queue is not None:
+        return work_queue.qsize()
+    return num_bams - bam_count
 
 
+def BytesInFlight():
+    with StatusLock:
+        progress_list = ActiveProgress.values()
+    total = 0
+    for progress in progress_list:
+        sample = progress.latest()
+        if sample is not None:
+            total += sample[1]
+    return total
 
-def UpdateRequestsFile(filename,ref_col_index,ref_col_data,num_cols,col_index,newdata):
-    # A function for updating the .tsv file
-    import tempfile,shutil
 
-    BUFFER_SIZE = 10485760 # 10 MB should be enough (for now)
+def VerifyDepth():
+    # Downloads waiting for, or part way through, their background checksums
+    if Verifier is None:
+        return 0
+    with Verifier.changed:
+        return len(Verifier.pending)
 
-    tmp = tempfile.SpooledTemporaryFile(bufsize=BUFFER_SIZE)
-    f = open(filename,'r')
-    f.seek(0)
-    tmp.seek(0)
-    for line in f:
-        data = line.strip().split('\t')
-        if len(data) < num_cols:
-            for i in range(len(data),(num_cols+1)):
-                data.append("")
-        if data[ref_col_index] == ref_col_data:
-            if debug:
-                print ("DEBUG: from UpdateRequestsFile: Updating column %d in %s") % (col_index,filename)
-                print ("DEBUG: from UpdateRequestsFile: column heading = %s") % column_names[col_index]
-                print ("DEBUG: from UpdateRequestsFile: old value      = %s") % data[col_index]
-                print ("DEBUG: from UpdateRequestsFile: new value      = %s") % newdata
-            data[col_index] = newdata
-            line = '\t'.join(data)
-            line = line + '\n'
-        tmp.write(line)
-    f.close()
-    shutil.move(filename, os.path.join(os.path.dirname(filename),"." + os.path.basename(filename)))
-    tmp.seek(0)
-    f = open(filename,'w')
-    for line in tmp:
-        f.write(line)
-    # Use flush + fsync to ensure that we have committed the update to disk
-    f.flush()
-    os.fsync(f.fileno())
-    f.close()
-    tmp.close()
 
+def DownloadsRunning():
+    with StatusLock:
+        return len(ActiveProgress) > 0
 
-def disk_speedtest(target_dir):
-    if verbose:
-        print ("Running filesystem speed test for target directory (%s)") % target_dir
-        sys.stdout.flush()
-    speedcmd = "dd if=/dev/zero of=%s/GT_Download.speedtest bs=4k count=75000 conv=fdatasync" % target_dir
-    if debug:
-        print ("DEBUG: speedcmd = %s") % speedcmd
-        sys.stdout.flush()
-    cmd = subprocess.Popen(speedcmd, shell=True, bufsize=1,\
-                           stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    speedout,speederr = cmd.communicate()
-    os.remove(target_dir + "/GT_Download.speedtest")
-    if cmd.returncode != 0:
-        print ("ERROR: Failed on shell command '%s'") % mkdircmd
-        sys.stdout.flush()
-    else:
-        test_bandwidth = int(float(speederr.split()[len(speederr.split())-2]))
-        speed_units = speederr.split()[len(speederr.split())-1]
-        if speed_units == "GB/s":
-            test_bandwidth = test_bandwidth * 1000
-        if debug:
-            print ("DEBUG: speederr = %s") % speederr
-            print ("DEBUG: filesystem bandwidth = %s") % test_bandwidth
-    return test_bandwidth
+
+def ActiveChildren():
+    with StatusLock:
+        return sum([progress.children for progress in ActiveProgress.values()])
+
+
+def NextBAM(work_queue):
+    # Next (bam_count,bam) to work on, or None when there is nothing left.  In
+    # distributed mode an entry is only handed out once we hold its lease;
+    # entries leased by other runs are retried until those runs finish with
+    # them or their leases expire.
+    while 1:
+        try:
+            item = work_queue.get_nowait()
+        except Queue.Empty:
+            # Downloads that fail their background checksums go round again
+            if Verifier is not None:
+                if Verifier.requeue(work_queue):
+                    continue
+                if Verifier.busy():
+                    Verifier.wait(1)
+                    continue
+            if Leases is None or not Leases.deferred:
+                return None
+            time.sleep(min(10,Leases.lease_ttl / 4.0))
+            Leases.requeue(work_queue)
+            continue
+        if Leases is None:
+            return item
+        state = Leases.claim(item[1].uuid)
+        if state == "claimed":
+            return item
+        elif state == "busy":
+            Leases.defer(item)
+        else:
+            # Report what the other run made of it in our summary
+            item[1].status = Requests.get(item[1].uuid,'status') or item[1].status
+            if verbose:
+                print ("%s was handled by another run") % item[1].uuid
+                sys.stdout.flush()
+
+
+def ReleaseBAM(bam):
+    # Done with bam (whatever the outcome); let the other runs know.  A BAM
+    # that is still being checked in the background is released by the
+    # VerifyPool.
+    if Leases is not None and not (Verifier is not None and Verifier.holds(bam.uuid)):
+        Leases.release(bam.uuid)
+
+
+def DownloadWorker(work_queue):
+    # Pull BAMs off the shared work queue until it is empty
+    while 1:
+        item = NextBAM(work_queue)
+        if item is None:
+            return
+        bam_count,bam = item
+        try:
+            DownloadBAM(bam,bam_count)
+        except Exception, err:
+            print ("ERROR: Download job for %s died: %s") % (bam.uuid,err)
+            sys.stdout.flush()
+            bam.status = "Failed"
+        ReleaseBAM(bam)
+        work_queue.task_done()
+
+
+def CachedBytes(uuid):
+    # Bytes already written to local_dir for a UUID
+    total = 0
+    for current_dir,dirnames,filenames in os.walk(os.path.join(local_dir,uuid)):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(current_dir,filename))
+            except OSError:
+                pass
+    return total
+
+
+class StagingCache:
+    # local_dir as a staging cache of whole analyses, for cache mode (-D).
+    # A UUID is pinned from the time it is admitted until it has been
+    # verified in the target directory (or has failed), and is never removed
+    # while pinned.  A verified copy is kept as the source of any later
+    # re-copy until its space is wanted, least recently used first, within
+    # a budget of budget bytes for pinned and verified copies together.
+    # With no budget a verified copy is removed at once.  The verified
+    # copies are listed in .gt_staging in local_dir, so they outlive the run.
+    #
+    # A re-copy only helps when the target's copy has been read back: a
+    # fresh copy is checked against the MD5 of the bytes read from the cache
+    # (CopyAndHash), so a bad write during the copy itself is only caught
+    # when a later run checks the Staged or Finished file on disk.
+    def __init__(self,directory,budget):
+        self.directory = directory
+        self.budget    = budget
+        self.filename  = os.path.join(directory,".gt_staging")
+        self.changed   = threading.Condition()
+        self.pinned    = dict()         # uuid -> bytes reserved
+        self.verified  = dict()         # uuid -> [bytes,last used]
+        self.hits      = 0
+        self.recopies  = 0
+        self.evictions = 0
+        self.evicted   = 0
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.filename)
+            entries = json.load(f)
+            f.close()
+        except (IOError,ValueError):
+            return
+        for uuid,entry in entries.items():
+            uuid = str(uuid)
+            if os.path.isdir(os.path.join(self.directory,uuid)):
+                self.verified[uuid] = entry
+
+    def save(self):
+        # Called with self.changed held
+        if not self.verified and not os.path.exists(self.filename):
+            return
+        tmp_name = self.filename + ".tmp"
+        try:
+            f = open(tmp_name,'w')
+            json.dump(self.verified,f)
+            f.close()
+            os.rename(tmp_name,self.filename)
+        except (IOError,OSError), err:
+            print ("WARNING: Can't write %s: %s") % (self.filename,err)
+
+    def used(self):
+        return sum(self.pinned.values()) + sum([entry[0] for entry in self.verified.values()])
+
+    def fits(self,size):
+        # True if size more bytes fit in local_dir and in the budget.  A BAM
+        # larger than the budget is let in when the cache is otherwise empty.
+        fs = os.statvfs(self.directory)
+        free = fs.f_bavail * fs.f_frsize
+        still_to_come = 0
+        for uuid,reserved in self.pinned.items():
+            still_to_come += max(0,reserved - CachedBytes(uuid))
+        if free - still_to_come < size:
+            return 0
+        return self.budget <= 0 or self.used() + size <= self.budget or not (self.pinned or self.verified)
+
+    def make_room(self,size):
+        # Evict verified copies, oldest use first, until size bytes fit
+        evicted = 0
+        while not self.fits(size) and self.verified:
+            lru = min(self.verified.keys(),key=lambda uuid: self.verified[uuid][1])
+            self.evict(lru)
+            evicted = 1
+        if evicted:
+            self.save()
+        return self.fits(size)
+
+    def evict(self,uuid):
+        # Remove a copy and everything else of uuid's in local_dir.  Called
+        # with self.changed held.
+        import glob
+        import shutil
+        entry = self.verified.pop(uuid,None)
+        for name in glob.glob("%s/%s*" % (self.directory,uuid)):
+            try:
+                if os.path.isdir(name) and not os.path.islink(name):
+                    shutil.rmtree(name)
+                else:
+                    os.remove(name)
+            except OSError, err:
+                print ("ERROR: Failed to remove %s: %s") % (name,err)
+        if Digests is not None:
+            Digests.evict([os.path.join(self.directory,uuid)])
+        if entry is not None:
+            self.evictions += 1
+            self.evicted   += entry[0]
+            RunMetrics.event('cache_evict',uuid=uuid,bytes=entry[0],idle_s=round(time.time() - entry[1],1))
+            if verbose:
+                print ("Evicted %s (%.2f GB) from the staging cache") % (uuid,float(entry[0])/float(Bytes2GB))
+                sys.stdout.flush()
+
+    def admit(self,bam,wait=1):
+        # Pin the BAM, making room for it.  With wait, block until the BAM
+        # fits on top of the others that are pinned; returns 0 if it never
+        # can.  Without, it is pinned regardless.
+        with self.changed:
+            if bam.uuid in self.pinned:
+                return 1
+            reserved = bam.size
+            if bam.uuid in self.verified:
+                # Already here; reusing it takes no more space
+                reserved = 0
+            while not self.make_room(reserved) and wait:
+                if len(self.pinned) == 0:
+                    return 0
+                if verbose:
+                    print ("Waiting for %.2f GB of space in %s for %s") % \
+                          (float(bam.size)/float(Bytes2GB),self.directory,bam.uuid)
+                    sys.stdout.flush()
+                self.changed.wait(30)
+            entry = self.verified.pop(bam.uuid,None)
+            self.pinned[bam.uuid] = entry and entry[0] or bam.size
+            if entry is not None:
+                self.save()
+            return 1
+
+    def reuse(self,bam):
+        # True if a verified copy of the (pinned) BAM is here, whole, to be
+        # copied again instead of downloaded
+        cache_dir = os.path.join(self.directory,bam.uuid)
+        if not os.path.isdir(cache_dir) or MissingFiles(bam,cache_dir):
+            return 0
+        if ManifestBytes(bam,cache_dir) != sum([size for name,size,checksum in bam.manifest()]):
+            return 0
+        with self.changed:
+            self.hits += 1
+        return 1
+
+    def finish(self,bam):
+        # The BAM is verified in the target directory: keep its copy if
+        # the budget allows, or remove it
+        with self.changed:
+            self.pinned.pop(bam.uuid,None)
+            if self.budget > 0:
+                size = CachedBytes(bam.uuid)
+                self.verified[bam.uuid] = [size,time.time()]
+                self.make_room(0)
+                self.save()
+            else:
+                self.evict(bam.uuid)
+            self.changed.notify_all()
+
+    def release(self,bam):
+        # Unpin a BAM that did not make it; what is left of it is resume data
+        with self.changed:
+            if self.pinned.pop(bam.uuid,None) is not None:
+                self.changed.notify_all()
+
+    def good_copy(self,bam,name):
+        # Path of the cached copy of one of the BAM's files if it matches the
+        # manifest, or None.  The digest cache usually knows its MD5 from
+        # when it was copied, so this reads nothing.
+        cached_name = os.path.join(self.directory,bam.uuid,name)
+        checksum = [checksum for file_name,size,checksum in bam.manifest() if file_name == name]
+        try:
+            if checksum and CachedHashFile(cached_name) == checksum[0]:
+                return cached_name
+        except (IOError,OSError):
+            pass
+        return None
+
+
+def PipelineDownloadWorker(work_queue,copy_queue):
+    # Download stage of the pipeline: admit BAMs to the cache as space allows
+    # and hand each finished download on to the copy stage
+    while 1:
+        item = NextBAM(work_queue)
+        if item is None:
+            return
+        bam_count,bam = item
+        job = DownloadJob(bam,bam_count)
+        if bam.status not in ("Cached","Staged","Finished","Live") and not Staging.admit(bam):
+            print ("ERROR: %s (%.2f GB) will not fit in %s. Skipping this entry.") % \
+                  (bam.uuid,float(bam.size)/float(Bytes2GB),local_dir)
+            sys.stdout.flush()
+            ReleaseBAM(bam)
+            continue
+        try:
+            DownloadStage(job)
+        except Exception, err:
+            print ("ERROR: Download stage for %s died: %s") % (bam.uuid,err)
+            sys.stdout.flush()
+            bam.status = "Failed"
+        copy_queue.put(job)
+
+
+def PipelineWorker(stage,in_queue,out_queue):
+    # One of the copy, verify and cleanup stages of the pipeline.  A None on
+    # in_queue means the stage before us is done.
+    while 1:
+        job = in_queue.get()
+        if job is None:
+            if out_queue is not None:
+                out_queue.put(None)
+            return
+        try:
+            stage(job)
+        except Exception, err:
+            print ("ERROR: %s for %s died: %s") % (stage.__name__,job.bam.uuid,err)
+            sys.stdout.flush()
+            job.bam.status = "Failed"
+            if stage != CleanupStage:
+                job.verified = 0
+        if out_queue is not None:
+            out_queue.put(job)
+        else:
+            ReleaseBAM(job.bam)
 
 
 # Get the start time for the script
@@ -206,6 +4055,14 @@ for opt, arg in options:
         MAX_WAIT = int(arg)
     elif opt == '-n':
         num_children = int(arg)
+    elif opt == '-j':
+        num_jobs = int(arg)
+    elif opt == '-o':
+        queue_order = arg.split(',')
+        for policy in queue_order:
+            if policy not in OrderPolicies:
+                print "Unknown download order: %s" % policy
+                quit()
     elif opt == '-b':
         max_bandwidth = int(arg)
     elif opt == '-d':
@@ -213,11 +4070,93 @@ for opt, arg in options:
     elif opt == '-l':
         local_dir = os.path.abspath(arg)
     elif opt == '-t':
-        final_dest = os.path.abspath(arg)
+        dest_roots.extend([os.path.abspath(name) for name in arg.split(',') if name])
     elif opt == '-D':
         direct_mode = 0
+    elif opt == '--checkpoint-updates':
+        checkpoint_updates = int(arg)
+    elif opt == '--checkpoint-interval':
+        checkpoint_interval = int(arg)
+    elif opt == '--preflight-batch':
+        preflight_batch = int(arg)
+    elif opt == '--preflight-workers':
+        preflight_workers = max(1,int(arg))
+    elif opt == '--preflight-ttl':
+        preflight_ttl = int(arg)
+    elif opt == '--copy-buffer':
+        copy_buffer = max(1,int(arg)) * Bytes2MB
+    elif opt == '--readahead':
+        copy_readahead = max(0,int(arg))
+    elif opt == '--verify-workers':
+        verify_workers = int(arg)
+    elif opt == '--verify-rate':
+        verify_rate = max(0,int(arg))
+    elif opt == '--link-farm':
+        link_farm = os.path.abspath(arg)
+    elif opt == '--cgquery-timeout':
+        cgquery_timeout = max(0,int(arg))
     elif opt == '-S':
         do_speedtest = 1
+    elif opt == '-P':
+        pipeline_mode = 1
+    elif opt == '-A':
+        adaptive = 1
+    elif opt == '--adapt-interval':
+        adapt_interval = max(1,int(arg))
+    elif opt == '--probe-interval':
+        probe_interval = int(arg)
+    elif opt == '--probe-size':
+        probe_size = max(1,int(arg))
+    elif opt == '--history':
+        history_file = os.path.abspath(arg)
+    elif opt == '--no-history':
+        history_file = None
+    elif opt == '--job-logs':
+        job_log_dir = os.path.abspath(arg)
+    elif opt == '--no-job-logs':
+        job_log_dir = None
+    elif opt == '--progress-interval':
+        progress_interval = max(1,int(arg))
+    elif opt == '--report':
+        report_only = 1
+    elif opt == '--digest-cache':
+        digest_file = os.path.abspath(arg)
+    elif opt == '--no-digest-cache':
+        digest_file = None
+    elif opt == '--no-dedupe':
+        dedupe = 0
+    elif opt == '--cache-size':
+        cache_size = max(0,float(arg))
+    elif opt == '--audit':
+        audit_only = 1
+    elif opt == '--reconcile':
+        reconcile_only = 1
+    elif opt == '--ingest':
+        ingest_file = os.path.abspath(arg)
+    elif opt == '--refresh-metadata':
+        refresh_metadata = 1
+    elif opt == '--events':
+        events_file = os.path.abspath(arg)
+    elif opt == '--metrics-file':
+        metrics_file = os.path.abspath(arg)
+    elif opt == '--metrics-interval':
+        metrics_interval = max(1,int(arg))
+    elif opt == '--list':
+        list_only = 1
+    elif opt == '--distributed':
+        distributed = 1
+    elif opt == '--worker-id':
+        worker_id = arg
+    elif opt == '--lease-ttl':
+        lease_ttl = max(10,int(arg))
+    elif opt == '--pipeline-depth':
+        pipeline_depth = max(1,int(arg))
+    elif opt == '--stall-rate':
+        stall_rate = float(arg)
+    elif opt == '--stall-time':
+        stall_time = int(arg)
+    elif opt == '--stall-progress':
+        stall_progress = int(arg)
     elif opt == '-v':
         verbose = 1
     elif opt == '-h':
@@ -227,8 +4166,106 @@ for opt, arg in options:
         print "Unknown option: %s" % opt
         quit()
 
+if num_jobs < 1:
+    num_jobs = 1
+# The first target directory is the primary one: the digest cache lives there,
+# and with a single -t everything works as it always has
+if dest_roots:
+    dest_roots = [root for i,root in enumerate(dest_roots) if root not in dest_roots[:i]]
+    final_dest = dest_roots[0]
+else:
+    dest_roots = [final_dest]
+if verify_workers < 1:
+    from multiprocessing import cpu_count
+    verify_workers = cpu_count()
+if pipeline_mode and direct_mode:
+    print ("Pipeline mode (-P) needs cache mode (-D); ignoring -P.")
+    pipeline_mode = 0
+
+# Split the child process and bandwidth budgets across the concurrent jobs
+job_children  = max(1,num_children / num_jobs)
+job_bandwidth = max(1,max_bandwidth / num_jobs)
+
+# Shared state for the download jobs
+StatusLock       = threading.Lock()
+PruneLock        = threading.Lock()
+ActiveDirs       = set()
+CreatedDirs      = set()
+Staging          = StagingCache(local_dir,int(cache_size*Bytes2GB))
+ActiveProgress   = dict()
+Placer           = Placement(dest_roots)
+
 # Normalize the path to the requests file
 RequestsFileName = os.path.abspath(request_file_dir + '/' + request_file_name)
+CGQueryCacheName = os.path.join(os.path.dirname(RequestsFileName),".cgquery_cache")
+MetadataCacheName = os.path.join(os.path.dirname(RequestsFileName),".cgquery_metadata")
+if history_file == "":
+    history_file = os.path.join(os.path.dirname(RequestsFileName),"gt_history.db")
+if digest_file == "":
+    digest_file = os.path.join(final_dest,".gt_digests.db")
+if job_log_dir == "":
+    job_log_dir = os.path.join(os.path.dirname(RequestsFileName),"gt_logs")
+
+# Every child process (gtdownload, cgquery, dd) runs under the one supervisor
+Processes = Supervisor()
+Processes.start()
+
+# Phase timings, the event log and the Prometheus textfile
+RunMetrics = Metrics(events_file,metrics_file,metrics_interval)
+
+# The report only needs the history database
+if report_only:
+    if sqlite3 is None:
+        print ("The sqlite3 module is needed for --report")
+        sys.exit(10)
+    if not history_file or not os.path.isfile(history_file):
+        print ("No history database to report on (%s)") % history_file
+        sys.exit(10)
+    HistoryReport(history_file)
+    sys.exit(0)
+
+# Digests of the files already checked, so that unchanged files are not read again
+Digests = None
+if digest_file:
+    if sqlite3 is None:
+        print ("WARNING: No sqlite3 module; every file will be read to checksum it")
+    else:
+        try:
+            Digests = DigestCache(digest_file)
+        except sqlite3.Error, err:
+            print ("WARNING: Can't open the digest cache %s (%s); every file will be read to checksum it") % \
+                  (digest_file,err)
+
+# The audit only needs the requests file, the target directory and the digests
+if audit_only:
+    if not(os.path.isfile(RequestsFileName)):
+        print ("%s is not a file!") % RequestsFileName
+        sys.exit(10)
+    problems = AuditArchive(RequestsFileName)
+    if Digests is not None:
+        Digests.close()
+    sys.exit(problems and 5 or 0)
+
+# Reconciling only needs the requests file and the target directory
+if reconcile_only:
+    if not(os.path.isfile(RequestsFileName)):
+        print ("%s is not a file!") % RequestsFileName
+        sys.exit(10)
+    Requests = RequestTable(RequestsFileName,checkpoint_updates,checkpoint_interval,distributed)
+    ReconcileArchive(Requests)
+    Requests.close()
+    sys.exit(0)
+
+# Ingesting only needs cgquery and the requests file, which it may create
+if ingest_file:
+    if not(os.path.isfile(ingest_file)):
+        print ("%s is not a file!") % ingest_file
+        sys.exit(10)
+    if not(os.path.isfile(CGQueryExecutable)):
+        print ("%s is not a file!") % CGQueryExecutable
+        sys.exit(10)
+    missing = IngestManifest(ingest_file,RequestsFileName)
+    sys.exit(missing and 5 or 0)
 
 # Dump out the run options for verification
 print ("====================================================================================")
@@ -240,9 +4277,35 @@ print ("Credential file             = %s") % CredentialFile
 print ("BAM requests file           = %s") % RequestsFileName
 if not direct_mode:
     print ("Local directory for caching = %s") % local_dir
-print ("Target directory            = %s") % final_dest
+    if cache_size > 0:
+        print ("Staging cache size          = %g GB") % cache_size
+if len(dest_roots) > 1:
+    print ("Target directories          = %s") % ', '.join(dest_roots)
+else:
+    print ("Target directory            = %s") % final_dest
+if link_farm:
+    print ("Link farm                   = %s") % link_farm
 print ("Number of child processes   = %d") % num_children
 print ("Maximum network bandwidth   = %d MB/s") % max_bandwidth
+if num_jobs > 1:
+    print ("Concurrent download jobs    = %d (%d children, %d MB/s each)") % \
+          (num_jobs,job_children,job_bandwidth)
+if pipeline_mode:
+    print ("Pipeline depth              = %d") % pipeline_depth
+if adaptive:
+    print ("Adaptive limits             = on (sampling every %d s)") % adapt_interval
+if distributed:
+    print ("Distributed worker          = %s (lease TTL %d s)") % (worker_id,lease_ttl)
+if history_file:
+    print ("History database            = %s") % history_file
+if Digests is not None:
+    print ("Digest cache                = %s") % digest_file
+if job_log_dir:
+    print ("gtdownload logs             = %s") % job_log_dir
+if events_file:
+    print ("Event log                   = %s") % events_file
+if metrics_file:
+    print ("Prometheus metrics file     = %s (every %d s)") % (metrics_file,metrics_interval)
 if direct_mode:
     print ("Data transfer timeout       = %d min") % MAX_WAIT
     print ("Running in direct mode\n")
@@ -276,471 +4339,224 @@ if not(os.access(local_dir, os.W_OK)) :
     exit_code = 10
     sys.exit(exit_code)
 
-# Check that we can write to the final destination directory
-if not(os.access(final_dest, os.W_OK)):
-    print ("You do not have permission to write to %s") % \
-          final_dest
-    exit_code = 10
-    sys.exit(exit_code)
+# Check that we can write to the final destination directories
+for root in dest_roots:
+    if not(os.access(root, os.W_OK)):
+        print ("You do not have permission to write to %s") % \
+              root
+        exit_code = 10
+        sys.exit(exit_code)
 
 # If we're running in direct mode and the -S option is given, test the underlying
 # filesystem and reduce the download speed to match the filesystem
+# (with several target directories, their speeds add up)
 if direct_mode and do_speedtest:
-    disk_bandwidth = disk_speedtest(final_dest)
-    if disk_bandwidth < max_bandwidth:
+    disk_bandwidth = None
+    for root in dest_roots:
+        root_bandwidth = disk_speedtest(root)
+        if root_bandwidth is not None:
+            disk_bandwidth = (disk_bandwidth or 0) + root_bandwidth
+    if disk_bandwidth is not None and disk_bandwidth < max_bandwidth:
         if verbose:
             print ("Filesystem bandwidth is only %s MB/s. Lowering CGHub download bandwidth to match.") \
                 % disk_bandwidth
         max_bandwidth = disk_bandwidth
+        job_bandwidth = max(1,max_bandwidth / num_jobs)
 
 # Parse the requests file and build a list of the downloads to perform
-SourceList = list()
-RequestsFile = open(RequestsFileName,'r')
-RequestsFile.seek(0)
-column_names = RequestsFile.readline().strip().split('\t')
-num_columns = len(column_names)
-for line in RequestsFile:
-    data = line.strip().split('\t')
-    # Fix data for truncated lines
-    if len(data) < num_columns:
-        for i in range(len(data),(num_columns+1)):
-            data.append("")
-    if debug:
-        print "TSV Column Name       :"
-        print "------------------------------------------------------------------"
-        for i in range(len(column_names)):
-            print ("%-22s:  %s") % (column_names[i],data[i])
-        print ""
-    filename = data[column_names.index('filename')]
-    BAM_UUID = data[column_names.index('analysis_id')]
-    filesize = int(float(data[column_names.index('files_size')]))
-    bamsum = data[column_names.index('checksum')]
-    stime  = data[column_names.index('start_time')]
-    if stime != '':
-        stime = datetime.strptime(stime,TimeFormat)
-    else:
-        stime = datetime.now()
-    etime  = data[column_names.index('end_time')]
-    if etime != '':
-        etime = datetime.strptime(etime,TimeFormat)
-    else:
-        etime = datetime.now()
-    stat     = data[column_names.index('status')]
-    disease  = data[column_names.index('disease')]
-    barcode  = data[column_names.index('barcode')]
-    library  = data[column_names.index('library_type')]
-    platform = data[column_names.index('platform_name')]
-    current  = BAMinfo(filename,BAM_UUID,filesize,bamsum,stime,etime,stat,disease,barcode,library,platform)
-    if current.status == "Finished":
-        if verbose:
-            print "%-51s: downloaded on %s" % (current.name,str(current.end_time))
-    elif current.status == "Live":
-        if verbose:
-            print "%-51s: downloaded on %s and is now live." % (current.name,str(current.end_time))
-    elif current.status == "":
-        current.status = "Unknown"
-        SourceList.append(current)
-    else:
-        SourceList.append(current)
-RequestsFile.close()
+Requests = RequestTable(RequestsFileName,checkpoint_updates,checkpoint_interval,distributed)
+SourceList,HistoricalRates = LoadRequests(Requests)
 
-# Dump out the list of downloads to perform
+# Put the queue in the order asked for with -o
+SourceList = OrderQueue(SourceList,queue_order)
+
+# Dump out the list of downloads to perform.  The ETA for each file uses the
+# median of the past overall rates for its sequencing center (or for the
+# whole requests file when the center has no history).
 print ("\n\n                                 FILES TO DOWNLOAD")
-print ("%-71s %12s") % ('Name','Size (MB)')
+print ("%-61s %12s %9s") % ('Name','Size (MB)','ETA')
 print ("====================================================================================")
 total_download_size = 0
+total_eta = 0.0
 num_bams = len(SourceList)
+MedianRates = dict((center,Median(rates)) for center,rates in HistoricalRates.items())
 for bam in SourceList:
-    print ("%-71s %12d") % (bam.name,float(bam.size/Bytes2MB))
+    rate = MedianRates.get(bam.center,MedianRates.get(None))
+    if rate:
+        bam_eta = float(bam.size) / Bytes2MB / rate
+        total_eta += bam_eta
+        eta_str = FormatETA(bam_eta)
+    else:
+        eta_str = "?"
+    print ("%-61s %12d %9s") % (bam.name,float(bam.size/Bytes2MB),eta_str)
     total_download_size += bam.size
-print ("\nTotal anticipated download size = %.2f GB (%d UUIDs in all)\n") % \
+print ("\nTotal anticipated download size = %.2f GB (%d UUIDs in all)") % \
       (float(total_download_size)/float(Bytes2GB),num_bams)
-total_download_size = 0
-
-# Loop through the list of files to download
-bam_count = 0
-for bam in SourceList:
-    bam_count += 1
-    source_uuid = bam.uuid
-    # Where is this thing finally going to end up?
-    final_location = os.path.join(final_dest,bam.localname)
+if HistoricalRates:
+    print ("Estimated download time         = %s (h:mm at the historical median of %.1f MB/s%s)\n") % \
+          (FormatETA(total_eta / min(num_jobs,max(1,num_bams))),MedianRates[None],
+           num_jobs > 1 and ", %d jobs" % num_jobs or "")
+else:
+    print ("Estimated download time         = unknown (no past transfer rates in %s)\n") % RequestsFileName
+if list_only:
+    Requests.close()
+    sys.exit(exit_code)
 
-    # Create the gtdownload command
-    gt_command = "%s" % GeneTorrentExecutable
-    gt_command += " -t"             # Timestamp log messages
-    if verbose:
-        gt_command += " -v"
-    if gt_debug:
-        gt_command += " -l stdout:full" # Full logging to stdout
-        gt_command += " -vv"            # Detailed progress information
-    gt_command += " --max-children %d" % num_children
-    gt_command += " --rate-limit %d" % max_bandwidth
-    gt_command += " -k %d" % MAX_WAIT
-    gt_command += " -c %s" % CredentialFile
-    if direct_mode:
-        direct_mode_path = os.path.dirname(bam.localname)
-        direct_mode_path = os.path.join(os.path.split(direct_mode_path)[:1])[0]
-        direct_mode_path = os.path.join(final_dest,direct_mode_path)
-        if debug:
-            print "DEBUG: direct_mode_path = ",direct_mode_path
-        gt_command += " -p %s" % direct_mode_path
-        final_location = direct_mode_path + "/" + bam.name
+# Record each download attempt for --report
+History = None
+if history_file:
+    if sqlite3 is None:
+        print ("WARNING: No sqlite3 module; download attempts will not be recorded")
     else:
-        gt_command += " -p %s" % local_dir
-    gt_command += " -d %s" % source_uuid
-
-    if debug:
-        print ("DEBUG: final_location = %s") % final_location
+        History = RunHistory(history_file)
 
-    # Print the run parameters
-    print ("\nCurrent download (%d of %d): %s") % (bam_count,num_bams,bam.name)
-    print ("====================================================================================")
-    print ("CGHub data source = %s") % source_uuid
+# In adaptive mode, keep measuring the disk we write to and the network, and
+# let the controller pick the limits for each gtdownload launch
+Controller = None
+if adaptive:
     if direct_mode:
-        print ("Destination       = %s") % (os.path.dirname(final_location) + "/" + bam.uuid)
-    else:
-        print ("Destination       = %s") % os.path.dirname(final_location)
-    sys.stdout.flush()
-
-    # Check to see if the target directory exists and create if necessary
-    if not(os.path.exists(os.path.dirname(final_location))):
-        if verbose:
-            print ("Creating directory %s") % os.path.dirname(final_location)
-            sys.stdout.flush()
-        mkdircmd = "mkdir -p %s" % os.path.dirname(final_location)
-        cmd = subprocess.Popen(mkdircmd, shell=True)
-        cmd.wait()
-        if cmd.returncode != 0:
-            print ("ERROR: Failed on shell command '%s'") % mkdircmd
-            sys.stdout.flush()
-            # sys.exit(cmd.returncode)
-    else:
-        if verbose:
-            print ("Target directory (%s) exists.") % os.path.dirname(final_location)
-            sys.stdout.flush()
-
-    start_time = datetime.now()
-    do_download=1
-    attempt=0
-    MAX_ATTEMPTS=5
-
-    # If the status is Cached, Staged, Finished, or Live, skip this step
-    if (bam.status == "Cached" or bam.status == "Staged" or bam.status == "Finished" or bam.status == "Live"):
-        print ("This file has already been downloaded. Status = %s") % bam.status
-        do_download = 0
-
-    # Check that the source is downloadable on the CGHub side
-    cgquery_cmd = "%s \"analysis_id=%s\" -a" % (CGQueryExecutable,bam.uuid)
-    if debug:
-        print ("\n>>>>>> cgquery command = %s") % cgquery_cmd
-        sys.stdout.flush()
-    cgquery_process = subprocess.Popen(cgquery_cmd, shell=True, bufsize=1,\
-                                       stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    cgquery_out,cgquery_err = cgquery_process.communicate()
-    if gt_debug:
-        print (">>>>>> cgquery stdout:\n%s\n\ncgquery stderr:\n%s") % (cgquery_out,cgquery_err)
-    if cgquery_process.returncode != 0:
-        print ("ERROR: Failed on shell command '%s'") % cgquery_cmd
-        sys.stdout.flush()
-        # sys.exit(cgquery_process.returncode)
+        Controller = BandwidthController(dest_roots,num_children,max_bandwidth)
     else:
-        # Process the output here
-        success_string = "All matching objects are in a downloadable state."
-        if (cgquery_out.find(success_string) == -1):
-            print ("UUID %s is not in a downloadable state. Skipping this entry.") % bam.uuid
-            state_loc = cgquery_out.find("state_count")
-            bam.status = cgquery_out[state_loc:].split()[1]
-            if debug:
-                print ("DEBUG: bam.status = %s") % bam.status
-            UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                               column_names.index('status'),bam.status)
-            UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                               column_names.index('state'),bam.status)
-            do_download = 0
-        else:
-            UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                               column_names.index('state'),"Live")
-            if verbose:
-                print ("UUID %s is in a downloadable state.") % bam.uuid
-
-    # Dump some debugging output
-    if debug:
-        print ("DEBUG: Info after cgquery check")
-        bam.bamprint()
-        print ("DEBUG: do_download = %d") % do_download
-        sys.stdout.flush()
-
-    # Start the actual download here.  The do_download variable is used to
-    # short-circuit the download process if necessary (see above)
-    while (do_download and attempt < MAX_ATTEMPTS):
-        if debug:
-            print ("\nDEBUG: gtdownload command = %s\n") % gt_command
-            sys.stdout.flush()
-
-        attempt += 1
-        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                           column_names.index('download_attempt_num'),\
-                           str(attempt))
-        bam.status = "InProcess"
-        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                           column_names.index('status'),bam.status)
-        bam.start_time = datetime.now()
-        # A little user output for the log file
-        print (" --- Starting download at %s") % (bam.start_time.strftime(TimeFormat))
-        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                           column_names.index('start_time'),\
-                           bam.start_time.strftime(TimeFormat))
-        gt_process = subprocess.Popen(gt_command, shell=True, bufsize=1,\
-                                      stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-        if verbose:
-            print (">>>>>> %s output:") % GeneTorrentExecutable
-            # A little user output for the log file
-        while (gt_process.poll()  == None):
-            out = gt_process.stdout.readline()
-            if out == '':
-                if gt_process.poll() != None:
-                    if debug:
-                        print ("DEBUG: gt_process.poll() != None, the gtdownload process has terminated")
-                        sys.stdout.flush()
-                    if direct_mode:
-                        cached_name = final_dest
-                    else:
-                        cached_name = "%s/%s/%s" % (local_dir,bam.uuid,bam.name)
-                    if debug:
-                        print ("DEUBG: cached_name                 = %s") % cached_name
-                        print ("DEBUG: os.path.exists(cached_name) = %d") % os.path.exists(cached_name)
-                        print ("DEBUG: gt_process.returncode       = %d") % gt_process.returncode
-                        sys.stdout.flush()
-                    if (gt_process.returncode == 0 and os.path.exists(cached_name)):
-                        if debug:
-                            print ("DEBUG: The gtdownload process terminated normally and the file exists on disk")
-                        do_download = 0
-                        bam.end_time = datetime.now()
-                        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                                           column_names.index('end_time'),\
-                                           bam.end_time.strftime(TimeFormat))
-                        if direct_mode:
-                            bam.size = os.path.getsize(os.path.dirname(final_location) + \
-                                                       "/" + bam.uuid + "/" + bam.name)
-                            total_download_size += bam.size
-                            if debug:
-                                print ("DEBUG: Getting size of %s (%d)") % (os.path.dirname(final_location) + \
-                                                       "/" + bam.uuid + "/" + bam.name, bam.size)
-                        else:
-                            if debug:
-                                print ("DEBUG: Getting size of %s") % cached_name
-                            bam.size = os.path.getsize(cached_name)
-                            total_download_size += bam.size
-                        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                                           column_names.index('files_size'),\
-                                           str(bam.size))
-                        if direct_mode:
-                            bam.status = "Finished"
-                        else:
-                            bam.status = "Cached"
-                        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                                           column_names.index('status'),\
-                                           bam.status)
-                        break
-                    else:
-                        print ("\nERROR: Download process failed with exit code %d.  Retrying.  (Attempt %d of %d)\n\n") % \
-                              (gt_process.returncode,(attempt+1),MAX_ATTEMPTS)
-                        bam.end_time = datetime.now()
-                        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                                           column_names.index('end_time'),\
-                                           bam.end_time.strftime(TimeFormat))
-                        bam.status = "Failed"
-                        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                                           column_names.index('status'),\
-                                           bam.status)
-            else:
-                sys.stdout.write(">>>>>> " + out)
-                sys.stdout.flush()
-
-    # A little user output for the log file
-    print (" --- Finished download at %s") % (bam.end_time.strftime(TimeFormat))
-
-    # How long did this take?
-    elapsed = bam.end_time - bam.start_time
-    elapsed_time = elapsed.seconds
-    (elapsed_days,elapsed_hours) = divmod(elapsed_time,(3600 * 24))
-    (elapsed_hours,elapsed_minutes) = divmod(elapsed_hours,3600)
-    (elapsed_minutes,elapsed_seconds) = divmod(elapsed_minutes,60)
-    print (" --- Elapsed time for download operation = %d days %2d hours %2d minutes %4.1f seconds") % \
-          (elapsed_days,elapsed_hours,elapsed_minutes,elapsed_seconds)
-    sys.stdout.flush()
-
-    # Clean up the .gto file
-    if not (bam.status == "Failed" or bam.status == "suppressed"):
-        if direct_mode:
-            os.remove(direct_mode_path + "/" + bam.uuid + ".gto")
-        else:
-            os.remove(local_dir + "/" + bam.uuid + ".gto")
+        Controller = BandwidthController([local_dir],num_children,max_bandwidth)
+    Controller.start()
 
-    # What was our data rate?
-    if elapsed_time == 0:
-        data_rate = 0
-    else:
-        data_rate = float(bam.size/Bytes2MB) / (bam.end_time - bam.start_time).seconds
-    if verbose:
-        print (" --- Calculated data rate = %.1f MB/s") % data_rate
-    UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                       column_names.index('overall_rate_(MB/s)'),str(data_rate))
+total_download_size = 0
+total_bytes_saved   = 0
+total_bytes_linked  = 0
 
-    if (bam.status == "Cached" and not direct_mode):
-        if verbose:
-            print ("Downloaded files(s) will now be copied to %s") % final_location
+# In distributed mode, lease each UUID before working on it so that runs on
+# other nodes sharing the requests file leave it alone
+Leases = None
+if distributed:
+    Leases = LeaseTable(Requests,worker_id,lease_ttl)
+    Leases.start()
 
-        # Copy the file and to its final resting place
-        copy_start = datetime.now()
+# In direct mode, downloads are checked by a pool of background threads
+# while the next ones run
+Verifier = None
+if direct_mode:
+    Verifier = VerifyPool(verify_workers,verify_rate)
+    Verifier.start()
 
-        # Copy the files
-        # Let's just copy the entire directory instead.  That way we don't have to worry about
-        # specific files inside it.  This also makes using rsync more reasonable
-        #
-        copycmd = "rsync -rt"
-        if verbose:
-            copycmd += "v"
-        copycmd += " %s/%s %s" % (local_dir,bam.uuid,\
-                                 '/'.join(os.path.split(os.path.dirname(final_location))[:-1]))
-        if debug:
-            print ("DEBUG: Copy command = %s") % copycmd
-            sys.stdout.flush()
-        cmd = subprocess.Popen(copycmd, shell=True)
-        cmd.wait()
-        copy_end = datetime.now()
-        if cmd.returncode != 0:
-            print ("ERROR: Failed on shell command '%s'") % copycmd
-            sys.stdout.flush()
-        bam.status = "Staged"
-        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                           column_names.index('status'),bam.status)
-        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                           column_names.index('pgrr_file_path'),\
-                           os.path.dirname(bam.localname))
-        elapsed_copy = copy_end - copy_start
-        elapsed_time = elapsed_copy.seconds
-        (elapsed_days,elapsed_hours) = divmod(elapsed_time,(3600 * 24))
-        (elapsed_hours,elapsed_minutes) = divmod(elapsed_hours,3600)
-        (elapsed_minutes,elapsed_seconds) = divmod(elapsed_minutes,60)
-        print (" --- Elapsed time for copy operation     = %d days %2d hours %2d minutes %4.1f seconds") % \
-              (elapsed_days,elapsed_hours,elapsed_minutes,elapsed_seconds)
-        sys.stdout.flush()
-    elif bam.status == "suppressed" and verbose:
-        print ("This file is not currenlty available from CGHub. Status = %s") % bam.status
-    elif (bam.status == "Finished" or bam.status == "Staged") and verbose:
-        print ("This file is already in the final destination directory. Status = %s") % bam.status
-    elif verbose:
-        print ("This location/availability of this file is unknown. Status = %s") % bam.status
+# gtdownload's output goes to a gzipped log per UUID, and the console gets a
+# table of the running downloads every progress_interval seconds
+Progress = None
+if job_log_dir:
+    if not os.path.isdir(job_log_dir):
+        try:
+            os.makedirs(job_log_dir)
+        except OSError, err:
+            print ("WARNING: Can't create %s (%s); gtdownload output goes to the console") % (job_log_dir,err)
+            job_log_dir = None
+if job_log_dir:
+    Progress = ProgressTable(progress_interval)
+    Progress.start()
 
-    if direct_mode:
-        UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                           column_names.index('pgrr_file_path'),\
-                           os.path.dirname(bam.localname))
-    
-    if (bam.status == "Staged" and not direct_mode):
-        # Perform an md5sum on the file and compare to BAMinfo
-        if verbose:
-            print ("Checking md5sum of file after copy.")
-            sys.stdout.flush()
-        md5_start = datetime.now()
-        md5cmd = "md5sum %s" % final_location
-        md5_process = subprocess.Popen(md5cmd, shell=True, bufsize=1,\
-                                       stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        out,err = md5_process.communicate()
-        if md5_process.returncode != 0:
-            print ("ERROR: Failed on shell command '%s'") % md5cmd
-            my_md5 = 0
-            sys.stdout.flush()
-            # sys.exit(md5_process.returncode)
-        else:
-            my_md5 = out.split()[0]
-        md5_end = datetime.now()
-        elapsed_md5 = md5_end - md5_start
-        elapsed_time = elapsed_md5.seconds
-        (elapsed_days,elapsed_hours) = divmod(elapsed_time,(3600 * 24))
-        (elapsed_hours,elapsed_minutes) = divmod(elapsed_hours,3600)
-        (elapsed_minutes,elapsed_seconds) = divmod(elapsed_minutes,60)
-        print (" --- Elapsed time for MD5 checksum       = %d days %2d hours %2d minutes %4.1f seconds") % \
-              (elapsed_days,elapsed_hours,elapsed_minutes,elapsed_seconds)
-        sys.stdout.flush()
+# Live gauges for the Prometheus textfile
+work_queue = None
+bam_count  = 0
+RunMetrics.gauge('queue_depth','BAMs waiting to be started',QueueDepth)
+RunMetrics.gauge('bytes_in_flight','Bytes received so far by the running gtdownloads',BytesInFlight)
+RunMetrics.gauge('active_children','gtdownload --max-children summed over the running downloads',
+                 ActiveChildren)
+RunMetrics.gauge('verify_depth','Downloads waiting for their background checksums',VerifyDepth)
+RunMetrics.start()
+RunMetrics.event('run_start',worker=worker_id,bams=num_bams,bytes=sum([bam.size for bam in SourceList]),
+                 jobs=num_jobs,direct_mode=direct_mode,pipeline_mode=pipeline_mode)
 
-        if my_md5 != bam.checksum:
-            print ("ERROR: Checksum does not match!")
-            print ("ERROR:   - Reference  = %s") % bam.checksum
-            print ("ERROR:   - Calculated = %s") % my_md5
-            bam.status = "Failed"
-            UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                               column_names.index('status'),bam.status)
-            UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                               column_names.index('end_time'),"")
-            exit_code = 5
-            sys.stdout.flush()
-            # sys.exit(exit_code)
-        else:
-            bam.status = "Finished"
-            UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                               column_names.index('status'),bam.status)
-            data_rate = float((bam.size / (md5_end - start_time).seconds)/Bytes2MB)
-            download_speed = "%.2f" % data_rate
-            UpdateRequestsFile(RequestsFileName,column_names.index('analysis_id'),bam.uuid,num_columns,\
-                               column_names.index('overall_rate_(MB/s)'),\
-                               download_speed)
-            if verbose:
-                print ("Checksum passed.  Removing cached file.")
-                sys.stdout.flush()
-            # Remove the cached copy of the file
-            tempcmd = "rm -rf %s/%s*" % (local_dir,source_uuid)
-            temp = subprocess.Popen(tempcmd, shell=True)
-            temp.wait()
-            if temp.returncode != 0:
-                print ("ERROR: Failed on shell command '%s'") % tempcmd
+# Check the CGHub state of the whole queue up front, leaving out the
+# analyses that are already in the archive (they are linked, not fetched)
+if preflight_batch > 0 and num_bams > 0:
+    PreflightStates,PreflightManifests = CGQueryPreflight([bam.uuid for bam in SourceList
+                                                           if not FindDuplicate(bam)])
+    for bam in SourceList:
+        if bam.uuid in PreflightManifests:
+            bam.set_manifest(PreflightManifests[bam.uuid])
+else:
+    PreflightStates = dict()
 
-            if verbose:
-                bam.bamprint()
+# Loop through the list of files to download
+if pipeline_mode:
+    # Separate download, copy, verify and cleanup stages joined by bounded
+    # queues, so that the next BAM downloads while the last one is staged
+    work_queue = Queue.Queue()
+    bam_count = 0
+    for bam in SourceList:
+        bam_count += 1
+        work_queue.put((bam_count,bam))
+    copy_queue    = Queue.Queue(pipeline_depth)
+    verify_queue  = Queue.Queue(pipeline_depth)
+    cleanup_queue = Queue.Queue(pipeline_depth)
+    downloaders = list()
+    for i in range(min(num_jobs,max(1,num_bams))):
+        worker = threading.Thread(target=PipelineDownloadWorker,args=(work_queue,copy_queue),
+                                  name="download%d" % (i+1))
+        worker.daemon = True
+        worker.start()
+        downloaders.append(worker)
+    stages = list()
+    for stage,in_queue,out_queue in ((CopyStage,copy_queue,verify_queue),
+                                     (VerifyStage,verify_queue,cleanup_queue),
+                                     (CleanupStage,cleanup_queue,None)):
+        worker = threading.Thread(target=PipelineWorker,args=(stage,in_queue,out_queue),
+                                  name=stage.__name__)
+        worker.daemon = True
+        worker.start()
+        stages.append(worker)
+    # Join with a timeout so that Ctrl-C still reaches the main thread
+    for worker in downloaders:
+        while worker.is_alive():
+            worker.join(1)
+    copy_queue.put(None)
+    for worker in stages:
+        while worker.is_alive():
+            worker.join(1)
+elif num_jobs == 1 and Leases is None:
+    bam_count = 0
+    for bam in SourceList:
+        bam_count += 1
+        DownloadBAM(bam,bam_count)
+    # Downloads that fail their background checksums go round again
+    if Verifier is not None:
+        work_queue = Queue.Queue()
+        item = NextBAM(work_queue)
+        while item is not None:
+            DownloadBAM(item[1],item[0])
+            item = NextBAM(work_queue)
+else:
+    # Keep num_jobs gtdownload processes busy from a shared work queue.  Each
+    # job updates its BAMinfo in place, so the summary below sees the results.
+    work_queue = Queue.Queue()
+    bam_count = 0
+    for bam in SourceList:
+        bam_count += 1
+        work_queue.put((bam_count,bam))
+    workers = list()
+    for i in range(min(num_jobs,num_bams)):
+        worker = threading.Thread(target=DownloadWorker,args=(work_queue,),name="job%d" % (i+1))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    # Join with a timeout so that Ctrl-C still reaches the main thread
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)
 
-        end_time = datetime.now()
-        elapsed_time = (end_time - start_time).seconds
-        (elapsed_days,elapsed_hours) = divmod(elapsed_time,(3600 * 24))
-        (elapsed_hours,elapsed_minutes) = divmod(elapsed_hours,3600)
-        (elapsed_minutes,elapsed_seconds) = divmod(elapsed_minutes,60)
-        print (" --- Total time for dataset              = %d days %2d hours %2d minutes %4.1f seconds") % \
-              (elapsed_days,elapsed_hours,elapsed_minutes,elapsed_seconds)
-        if bam.status != "Finished":
-            effective_data_rate = 0
-        else:
-            effective_data_rate = float(bam.size/Bytes2MB) / elapsed_time
-        print (" --- Effective data rate = %.1f MB/s") % data_rate
-        print ("====================================================================================\n\n")
-        sys.stdout.flush()
+if Verifier is not None:
+    Verifier.stop()
+if Progress is not None:
+    Progress.stop()
+if Controller is not None:
+    Controller.stop()
+if Leases is not None:
+    Leases.stop()
+if History is not None:
+    History.close()
+if Digests is not None:
+    Digests.close()
 
-    # Prune the directory tree to remove any empty directories if something failed
-    # NOTE: Olga requested this behavior
-    if not (bam.status == "Finished" or bam.status == "Staged"):
-        if debug:
-            print ("DEBUG: Problem with download of %s (status=%s)") % (bam.uuid,bam.status)
-            print ("DEBUG: Checking for empty directories in %s") % final_dest
-        done = 0
-        while not done:
-            empty_dirs = list()
-            dirinfo = os.walk(final_dest)
-            for current_dir in dirinfo:
-                numdirs  = len(current_dir[1])
-                numfiles = len(current_dir[2])
-                if numdirs == 0 and numfiles == 0:
-                    empty_dirs.append(current_dir[0])
-            if len(empty_dirs) == 0:
-                done = 1
-            else:
-                if debug:
-                    print ("DEBUG: Empty directory list:")
-                    for i in empty_dirs:
-                        print ("DEBUG: ----> %s") % i
-                for empty_path in empty_dirs:
-                    import shutil
-                    if debug:
-                        print ("DEBUG: Removing empty directory %s") % empty_path
-                    shutil.rmtree(empty_path)
+# Flush the last of the status updates out to the requests file
+Requests.close()
 
 # Print some summary output
 StatusList = list()
@@ -762,12 +4578,24 @@ for name,count in StatusList:
     print ("%-15s  %7d") % (name,count)
 print ("------------------------")
 print ("%.2f GB total") % (float(total_download_size)/float(Bytes2GB))
+if total_bytes_saved > 0:
+    print ("%.2f GB re-used from partial downloads") % (float(total_bytes_saved)/float(Bytes2GB))
+if total_bytes_linked > 0:
+    print ("%.2f GB linked from identical files already in the archive") % (float(total_bytes_linked)/float(Bytes2GB))
+if not direct_mode and (Staging.hits or Staging.recopies or Staging.evictions or Staging.verified):
+    print ("Staging cache: %d BAM(s) reused, %d file(s) copied again, %d evicted (%.2f GB), %.2f GB kept in %s") % \
+          (Staging.hits,Staging.recopies,Staging.evictions,float(Staging.evicted)/float(Bytes2GB),
+           float(sum([entry[0] for entry in Staging.verified.values()]))/float(Bytes2GB),local_dir)
+print ("%s: %d updates, %d rewrites, %d fsyncs") % \
+      (os.path.basename(RequestsFileName),Requests.updates,Requests.checkpoints,Requests.fsyncs)
+if Digests is not None:
+    print ("%s: %d checksums reused, %d files read") % (os.path.basename(digest_file),Digests.hits,Digests.misses)
 
 end_time = datetime.now()
-elapsed_time = (end_time - script_start_time).seconds
-(elapsed_days,elapsed_hours) = divmod(elapsed_time,(3600 * 24))
-(elapsed_hours,elapsed_minutes) = divmod(elapsed_hours,3600)
-(elapsed_minutes,elapsed_seconds) = divmod(elapsed_minutes,60)
-print ("\nTotal walltime for GT_Download           = %d days %2d hours %2d minutes %4.1f seconds") % \
-      (elapsed_days,elapsed_hours,elapsed_minutes,elapsed_seconds)
+elapsed_time = (end_time - script_start_time).total_seconds()
+print ("\nTotal walltime for GT_Download           = %s") % FormatElapsed(elapsed_time)
 print ("====================================================================================\n")
+
+RunMetrics.event('run_end',worker=worker_id,seconds=round(elapsed_time,3),bytes=total_download_size,
+                 statuses=dict(StatusList))
+RunMetrics.stop()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Benchmark for "GT_Download.py --ingest".
+#
+# Writes a synthetic requests file of --rows BAMs and the label,uuid list for
+# it, then times --ingest of the list into a new requests file (every UUID
+# looked up with fake_cgquery.py) and again into that file (everything
+# already there), and a third time with --refresh-metadata.  The ingested
+# file has to match the original in the columns a download needs.
+#
+#   python bench/bench_ingest.py --rows 5000
+#
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from sheets import write_download_sheet
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT    = os.path.join(BENCH_DIR,'..','GT_Download.py')
+COLUMNS   = ('filename','files_size','checksum','disease','barcode','library_type','platform_name','study',
+             'center')
+
+looked_up_re = re.compile(r'^\s*(\d+) looked up with cgquery',re.M)
+
+
+def read_sheet(filename):
+    lines = open(filename).read().splitlines()
+    header = lines[0].split('\t')
+    rows = dict()
+    for line in lines[1:]:
+        data = line.split('\t')
+        data.extend([''] * (len(header) - len(data)))
+        row = dict(zip(header,data))
+        rows[row['analysis_id']] = row
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark for GT_Download.py --ingest')
+    parser.add_argument('--rows',type=int,default=5000)
+    parser.add_argument('--batch',type=int,default=50,help='GT_Download.py --preflight-batch')
+    parser.add_argument('--workers',type=int,default=4,help='GT_Download.py --preflight-workers')
+    parser.add_argument('--python',default='python2',help='interpreter for GT_Download.py')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_ingest.')
+    try:
+        state_dir = os.path.join(workdir,'state')
+        source = os.path.join(workdir,'source.tsv')
+        write_download_sheet(source,os.path.join(state_dir,'manifest'),args.rows,65536,1)
+        expected = read_sheet(source)
+        csv_name = os.path.join(workdir,'Files.csv')
+        f = open(csv_name,'w')
+        for i,uuid in enumerate(expected):
+            f.write('LABEL%d,%s\n' % (i + 1,uuid))
+        f.close()
+
+        env = dict(os.environ)
+        env['GT_BENCH_STATE'] = state_dir
+        command = [args.python,SCRIPT,'-e',os.path.join(BENCH_DIR,'fake_gtdownload.py'),
+                   '-q',os.path.join(BENCH_DIR,'fake_cgquery.py'),'-C','/dev/null','-d',workdir,
+                   '-l',workdir,'-t',workdir,'--preflight-batch=%d' % args.batch,
+                   '--preflight-workers=%d' % args.workers,'--ingest=%s' % csv_name]
+        print('%-28s %9s %10s %10s' % ('run','wall (s)','rows/s','looked up'))
+        for title,extra in (('new requests file',[]),('again (nothing to do)',[]),
+                            ('--refresh-metadata',['--refresh-metadata'])):
+            start = time.time()
+            process = subprocess.Popen(command + extra + ['ingested.tsv'],stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,env=env)
+            output = process.communicate()[0].decode('utf-8','replace')
+            wall = time.time() - start
+            if process.returncode != 0:
+                print(output[-3000:])
+                raise RuntimeError('--ingest failed (exit code %d)' % process.returncode)
+            match = looked_up_re.search(output)
+            print('%-28s %9.2f %10.0f %10s' % (title,wall,args.rows / wall,match and match.group(1) or '?'))
+            sys.stdout.flush()
+
+        ingested = read_sheet(os.path.join(workdir,'ingested.tsv'))
+        wrong = [uuid for uuid in expected if uuid not in ingested or
+                 [ingested[uuid][name] for name in COLUMNS] != [expected[uuid][name] for name in COLUMNS]]
+        if wrong or len(ingested) != len(expected):
+            print('MISMATCH: %d of %d rows differ from the source (%d rows ingested)' %
+                  (len(wrong),len(expected),len(ingested)))
+            return 1
+        print('All %d rows match the source requests file' % len(expected))
+        return 0
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Benchmark for the requests file loader in GT_Download.py.
+#
+# Writes a synthetic requests file of --rows rows (most of them already
+# Finished or Live, as in a long-running bam_status.tsv), then times
+# "GT_Download.py --list" on it, which loads the file, builds the queue and
+# prints it without downloading anything.
+#
+#   python bench/bench_loader.py --rows 100000 --pending 0.05 --repeat 5
+#
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import subprocess
+
+from sheets import write_history_sheet
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows',type=int,default=100000)
+    parser.add_argument('--pending',type=float,default=0.05,help='fraction of rows still to download')
+    parser.add_argument('--repeat',type=int,default=5)
+    parser.add_argument('--python',default='python2',help='interpreter for GT_Download.py')
+    args = parser.parse_args()
+
+    script  = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','GT_Download.py')
+    workdir = tempfile.mkdtemp(prefix='bench_loader.')
+    try:
+        sheet = os.path.join(workdir,'bench.tsv')
+        write_history_sheet(sheet,args.rows,args.pending)
+        command = [args.python,script,'--list','-e','/bin/true','-q','/bin/true','-C','/dev/null',
+                   '-d',workdir,'-l',workdir,'-t',workdir,os.path.basename(sheet)]
+        times = list()
+        devnull = open(os.devnull,'w')
+        for i in range(args.repeat):
+            start = time.time()
+            subprocess.check_call(command,stdout=devnull,stderr=subprocess.STDOUT)
+            times.append(time.time() - start)
+        devnull.close()
+        times.sort()
+        max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print('rows=%d pending=%.2f repeat=%d' % (args.rows,args.pending,args.repeat))
+        print('wall time: best %.3f s, median %.3f s (%.0f rows/s)' %
+              (times[0],times[len(times) // 2],args.rows / times[len(times) // 2]))
+        print('peak RSS:  %.1f MB' % (max_rss / 1024.0))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
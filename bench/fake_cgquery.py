@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Stand-in for cgquery, for benchmarking GT_Download.py offline (-q).
+#
+# Answers "analysis_id=..." and "analysis_id=(... OR ...)" queries from the
+# manifest in $GT_BENCH_STATE/manifest, in the layout of "cgquery -a", with
+# every file of each analysis.  With -o FILE the analyses are also written to
+# FILE as XML, with the rest of their metadata from $GT_BENCH_STATE/metadata.
+# $GT_BENCH_SUPPRESSED is the fraction of UUIDs to report as suppressed.
+#
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+from xml.sax.saxutils import escape
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from fake_gtdownload import selected
+from sheets import read_manifest
+
+
+def write_xml(filename,state_dir,results):
+    # The Result elements of cgquery -a -o for (uuid,state) pairs
+    out = open(filename,'w')
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<ResultSet date="2014-08-11 12:00:00">\n')
+    for i,(uuid,state) in enumerate(results):
+        row = dict()
+        metadata = os.path.join(state_dir,'metadata',uuid)
+        if os.path.exists(metadata):
+            row = json.load(open(metadata))
+        elements = [('analysis_id',uuid),('state',state),('last_modified','2013-05-16T20:41:04Z'),
+                    ('upload_date','2012-06-22T10:41:04Z'),('published_date','2012-06-22T10:41:04Z'),
+                    ('center_name',row.get('center','')),('study',row.get('study','')),
+                    ('legacy_sample_id',row.get('barcode','')),('disease_abbr',row.get('disease','')),
+                    ('library_strategy',row.get('library_type','')),
+                    ('platform',row.get('platform_name','').upper())]
+        out.write('  <Result id="%d">\n' % (i + 1))
+        for tag,value in elements:
+            out.write('    <%s>%s</%s>\n' % (tag,escape(value),tag))
+        out.write('    <files>\n')
+        for name,size,checksum,sparse in read_manifest(os.path.join(state_dir,'manifest',uuid)):
+            out.write('      <file>\n        <filename>%s</filename>\n        <filesize>%d</filesize>\n'
+                      '        <checksum type="MD5">%s</checksum>\n      </file>\n' % (escape(name),size,checksum))
+        out.write('    </files>\n  </Result>\n')
+    out.write('</ResultSet>\n')
+    out.close()
+
+
+def main():
+    args      = sys.argv[1:]
+    xml_name  = None
+    if '-o' in args:
+        xml_name = args[args.index('-o') + 1]
+        del args[args.index('-o'):args.index('-o') + 2]
+    query     = ' '.join(args)
+    state_dir = os.environ['GT_BENCH_STATE']
+    fraction  = float(os.environ.get('GT_BENCH_SUPPRESSED','0'))
+    uuids     = re.findall(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',query)
+
+    counts  = dict()
+    results = list()
+    print('Matching Objects           : %d' % len(uuids))
+    print('')
+    for i,uuid in enumerate(uuids):
+        manifest = os.path.join(state_dir,'manifest',uuid)
+        if not os.path.exists(manifest):
+            continue
+        state = selected(uuid,fraction) and 'suppressed' or 'live'
+        counts[state] = counts.get(state,0) + 1
+        results.append((uuid,state))
+        print('      Analysis %d' % (i + 1))
+        print('            analysis_id      : %s' % uuid)
+        print('            state            : %s' % state)
+        print('            files')
+        for name,size,checksum,sparse in read_manifest(manifest):
+            print('                  filename   : %s' % name)
+            print('                  filesize   : %d' % size)
+            print('                  checksum   : %s' % checksum)
+        print('')
+    print('      state_count')
+    for state in sorted(counts.keys()):
+        print('            %s : %d' % (state,counts[state]))
+    if counts and list(counts.keys()) == ['live']:
+        print('All matching objects are in a downloadable state.')
+    if xml_name is not None:
+        write_xml(xml_name,state_dir,results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Stand-in for gtdownload, for benchmarking GT_Download.py offline (-e).
+#
+# Writes the files listed in $GT_BENCH_STATE/manifest/<uuid> into the -p
+# directory while printing gtdownload-style "Status:" lines.  Like gtdownload,
+# a run that finds the .gto from an earlier one keeps the complete files that
+# are already there.  Behaviour is set through the environment:
+#
+#   GT_BENCH_STATE     directory holding the manifest (required)
+#   GT_BENCH_RATE      MB/s to simulate when not replaying a trace (default 100)
+#   GT_BENCH_TRACE     comma separated gtdownload logs (1.txt, numbers.log, ...)
+#                      whose Status lines are replayed, one download per file
+#                      chosen by the UUID, compressed into GT_BENCH_DURATION
+#   GT_BENCH_DURATION  seconds each replayed download takes (default 1)
+#   GT_BENCH_LINES     Status lines per download (default 20)
+#   GT_BENCH_FAIL      fraction of UUIDs whose first attempt fails (default 0)
+#   GT_BENCH_STALL     fraction of UUIDs whose first attempt stalls half way
+#                      until it is killed (default 0)
+#   GT_BENCH_CORRUPT   fraction of UUIDs whose first attempt leaves the last
+#                      file with bad data (default 0)
+#
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import hashlib
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from sheets import file_content,read_manifest
+
+status_re = re.compile(r'(\d\d):(\d\d):(\d\d)\.(\d+).*Status:\s*[\d.]+\s*\w+\s+downloaded\s+'
+                       r'\(([\d.]+)% complete\)\s+current rate:\s*(.*)$')
+
+
+def selected(uuid,fraction):
+    # Deterministically pick about fraction of all UUIDs
+    return int(hashlib.md5(uuid.encode('ascii')).hexdigest()[:8],16) < fraction * 0x100000000
+
+
+def first_attempt(state_dir,what,uuid):
+    # True the first time this is asked for a UUID
+    marker = os.path.join(state_dir,'%s.%s' % (what,uuid))
+    if os.path.exists(marker):
+        return 0
+    open(marker,'w').close()
+    return 1
+
+
+def format_bytes(count):
+    for unit,scale in (('GB',1 << 30),('MB',1 << 20),('kB',1 << 10)):
+        if count >= scale:
+            value = float(count) / scale
+            if value >= 100:
+                return '%4d %s' % (value,unit)
+            return '%.3g %s' % (value,unit)
+    return '%d bytes' % count
+
+
+def load_trace(filenames,uuid,lines):
+    # One download's worth of (seconds, percent, rate text) from the traces.
+    # A download ends where the percentage drops back.
+    downloads = list()
+    for filename in filenames:
+        current = list()
+        for line in open(filename):
+            match = status_re.search(line)
+            if match is None:
+                continue
+            seconds = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + int(match.group(3)) + \
+                      float('0.' + match.group(4))
+            if current and seconds < current[-1][0]:
+                # Past midnight
+                seconds += 86400
+            percent = float(match.group(5))
+            if current and percent < current[-1][1]:
+                downloads.append(current)
+                current = list()
+            current.append((seconds,percent,match.group(6).strip()))
+        if current:
+            downloads.append(current)
+    downloads = [samples for samples in downloads if len(samples) > 1]
+    if not downloads:
+        return None
+    samples = downloads[int(hashlib.md5(uuid.encode('ascii')).hexdigest()[:8],16) % len(downloads)]
+    step = max(1,len(samples) // lines)
+    return samples[::step]
+
+
+class Writer:
+    # Writes the files of a download in order, a given number of bytes in
+    def __init__(self,path,uuid,files):
+        self.pending = list()
+        for name,size,checksum,sparse in files:
+            content = not sparse and file_content(uuid,name,size)
+            self.pending.append([os.path.join(path,uuid,name),size,sparse,content])
+        self.out     = None
+        self.offset  = 0
+        self.written = 0
+
+    def write_to(self,target):
+        while self.written < target and self.pending:
+            name,size,sparse,content = self.pending[0]
+            if self.out is None:
+                self.out = open(name,'wb')
+                self.offset = 0
+            count = min(size - self.offset,target - self.written)
+            if sparse:
+                self.out.truncate(self.offset + count)
+                self.out.seek(self.offset + count)
+            else:
+                self.out.write(content[self.offset:self.offset + count])
+            self.offset  += count
+            self.written += count
+            if self.offset >= size:
+                self.out.close()
+                self.out = None
+                self.pending.pop(0)
+
+
+def main():
+    args      = sys.argv[1:]
+    path      = args[args.index('-p') + 1]
+    uuid      = args[args.index('-d') + 1]
+    state_dir = os.environ['GT_BENCH_STATE']
+    files     = read_manifest(os.path.join(state_dir,'manifest',uuid))
+
+    print('Welcome to gtdownload-3.8.3 (benchmark stand-in).')
+    if selected(uuid,float(os.environ.get('GT_BENCH_FAIL','0'))) and first_attempt(state_dir,'failed',uuid):
+        print('Error:  Failed to communicate with GT Executive (injected failure)')
+        sys.exit(3)
+    stall = selected(uuid,float(os.environ.get('GT_BENCH_STALL','0'))) and \
+            first_attempt(state_dir,'stalled',uuid)
+    corrupt = selected(uuid,float(os.environ.get('GT_BENCH_CORRUPT','0'))) and \
+              first_attempt(state_dir,'corrupt',uuid)
+
+    if not os.path.isdir(os.path.join(path,uuid)):
+        os.makedirs(os.path.join(path,uuid))
+    gto_name = os.path.join(path,uuid + '.gto')
+    if os.path.exists(gto_name):
+        # Resuming: keep the files that are already complete
+        files = [entry for entry in files if not (os.path.exists(os.path.join(path,uuid,entry[0])) and
+                                                  os.path.getsize(os.path.join(path,uuid,entry[0])) == entry[1])]
+    open(gto_name,'w').close()
+    size = sum([entry[1] for entry in files])
+
+    lines = int(os.environ.get('GT_BENCH_LINES','20'))
+    trace = None
+    if os.environ.get('GT_BENCH_TRACE'):
+        trace = load_trace(os.environ['GT_BENCH_TRACE'].split(','),uuid,lines)
+    if trace is not None:
+        duration = float(os.environ.get('GT_BENCH_DURATION','1'))
+        span = max(trace[-1][0] - trace[0][0],1e-3)
+        final = max(trace[-1][1],1e-3)
+        steps = [((seconds - trace[0][0]) / span * duration,percent / final,rate)
+                 for seconds,percent,rate in trace]
+    else:
+        rate = float(os.environ.get('GT_BENCH_RATE','100'))
+        duration = float(size) / 1048576 / rate
+        steps = [(duration * i / lines,float(i) / lines,'%.3g MB/s' % rate) for i in range(1,lines + 1)]
+
+    writer = Writer(path,uuid,files)
+    start = time.time()
+    written = 0
+    for offset,fraction,rate in steps:
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        target = min(size,int(size * fraction))
+        if stall and target >= size // 2:
+            # Hang on to the connection but stop moving data
+            frozen = time.strftime('%m/%d %H:%M:%S.000') + ' Normal:  Status: %s downloaded (%.3f%% complete)' \
+                     ' current rate:  0.01 kB/s' % (format_bytes(written),100.0 * written / max(size,1))
+            while 1:
+                print(frozen)
+                sys.stdout.flush()
+                time.sleep(0.2)
+        if target > written:
+            writer.write_to(target)
+            written = target
+        print(time.strftime('%m/%d %H:%M:%S.000') + ' Normal:  Status: %s downloaded (%.3f%% complete)'
+              ' current rate:  %s' % (format_bytes(written),100.0 * written / max(size,1),rate))
+        sys.stdout.flush()
+    writer.write_to(size)
+    if corrupt and files:
+        bad = open(os.path.join(path,uuid,files[-1][0]),'r+b')
+        bad.write(b'corrupt!')
+        bad.close()
+    print('Download complete: %s' % os.path.join(path,uuid))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# Offline benchmark suite for GT_Download.py.
+#
+# For each queue size, writes a requests file of pending BAMs and runs
+# GT_Download.py on it with fake_gtdownload.py and fake_cgquery.py in place
+# of the CGHub tools.  Reports the wall time, requests file updates,
+# rewrites and fsyncs, and read/write system calls per BAM, and compares
+# them with bench/baseline.json so that regressions fail the run.
+#
+# GT_Download.py runs in direct mode unless --args has -D.  The system call
+# counts include the fake gtdownload and cgquery processes.  Wall times
+# drift with the host, so before blaming a change for one, run it and its
+# parent one after the other a few times.
+#
+#   python bench/run_bench.py                          # 10,100,1000,10000 BAMs
+#   python bench/run_bench.py --sizes 10,100 --trace 1.txt,2.txt,3.txt
+#   python bench/run_bench.py --fail 0.1 --stall 0.05 --args "-D -P"
+#   python bench/run_bench.py --files 3 --corrupt 0.2 --args=-D
+#   python bench/run_bench.py --update-baseline
+#
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from sheets import write_download_sheet
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT    = os.path.join(BENCH_DIR,'..','GT_Download.py')
+BASELINE  = os.path.join(BENCH_DIR,'baseline.json')
+
+# Runs GT_Download.py and saves its /proc/self/io when it exits, for the
+# system call counts
+LAUNCHER = '''
+import sys, atexit
+def save_io():
+    try:
+        open(%r,'w').write(open('/proc/self/io').read())
+    except IOError:
+        pass
+atexit.register(save_io)
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+exec(compile(open(script).read(),script,'exec'),{'__name__': '__main__','__file__': script})
+'''
+
+summary_re = re.compile(r'^\S+: (\d+) updates, (\d+) rewrites, (\d+) fsyncs$',re.M)
+
+# Metrics compared with the baseline, and whether they are timings
+METRICS = (('wall_ms_per_bam',1),('updates_per_bam',0),('rewrites_per_bam',0),
+           ('fsyncs_per_bam',0),('syscalls_per_bam',0))
+
+
+def run_size(args,size):
+    workdir = tempfile.mkdtemp(prefix='gt_bench.')
+    try:
+        state_dir = os.path.join(workdir,'state')
+        for name in ('dest','cache','state'):
+            os.makedirs(os.path.join(workdir,name))
+        write_download_sheet(os.path.join(workdir,'bench.tsv'),os.path.join(state_dir,'manifest'),
+                             size,args.file_size * 1024,args.sparse,args.files)
+        io_name = os.path.join(workdir,'io')
+        launcher = os.path.join(workdir,'launch.py')
+        f = open(launcher,'w')
+        f.write(LAUNCHER % io_name)
+        f.close()
+
+        env = dict(os.environ)
+        env.update(GT_BENCH_STATE=state_dir,GT_BENCH_RATE=str(args.rate),GT_BENCH_FAIL=str(args.fail),
+                   GT_BENCH_STALL=str(args.stall),GT_BENCH_CORRUPT=str(args.corrupt),
+                   GT_BENCH_DURATION=str(args.duration),
+                   GT_BENCH_TRACE=','.join(os.path.abspath(name) for name in args.trace.split(',') if name))
+        command = [args.python,launcher,SCRIPT,
+                   '-e',os.path.join(BENCH_DIR,'fake_gtdownload.py'),
+                   '-q',os.path.join(BENCH_DIR,'fake_cgquery.py'),
+                   '-C','/dev/null','-d',workdir,'-l',os.path.join(workdir,'cache'),
+                   '-t',os.path.join(workdir,'dest'),'-j',str(args.jobs),'--no-history']
+        if args.stall > 0:
+            command.append('--stall-progress=2')
+        command += shlex.split(args.args) + ['bench.tsv']
+
+        log = open(os.path.join(workdir,'run.log'),'w')
+        start = time.time()
+        returncode = subprocess.call(command,stdout=log,stderr=subprocess.STDOUT,env=env)
+        wall = time.time() - start
+        log.close()
+        output = open(os.path.join(workdir,'run.log')).read()
+
+        match = summary_re.search(output)
+        if returncode != 0 or match is None:
+            print(output[-3000:])
+            raise RuntimeError('GT_Download.py failed with %d BAMs (exit code %d)' % (size,returncode))
+        updates,rewrites,fsyncs = [int(value) for value in match.groups()]
+        syscalls = None
+        if os.path.exists(io_name):
+            io = dict(line.split(': ') for line in open(io_name).read().splitlines())
+            syscalls = int(io['syscr']) + int(io['syscw'])
+
+        lines = open(os.path.join(workdir,'bench.tsv')).read().splitlines()
+        status_col = lines[0].split('\t').index('status')
+        unfinished = len([line for line in lines[1:] if line.split('\t')[status_col] != 'Finished'])
+
+        result = {'bams':             size,
+                  'wall_s':           wall,
+                  'wall_ms_per_bam':  1000.0 * wall / size,
+                  'updates_per_bam':  float(updates) / size,
+                  'rewrites_per_bam': float(rewrites) / size,
+                  'fsyncs_per_bam':   float(fsyncs) / size,
+                  'unfinished':       unfinished}
+        if syscalls is not None:
+            result['syscalls_per_bam'] = float(syscalls) / size
+        return result
+    finally:
+        if args.keep:
+            print('Kept %s' % workdir)
+        else:
+            shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for GT_Download.py')
+    parser.add_argument('--sizes',default='10,100,1000,10000',help='queue sizes to run')
+    parser.add_argument('--jobs',type=int,default=4,help='GT_Download.py -j')
+    parser.add_argument('--file-size',type=int,default=64,help='KB per BAM')
+    parser.add_argument('--sparse',action='store_true',help='write sparse files')
+    parser.add_argument('--rate',type=float,default=100,help='MB/s per fake download')
+    parser.add_argument('--trace',default='',help='gtdownload logs to replay, e.g. 1.txt,2.txt,3.txt')
+    parser.add_argument('--duration',type=float,default=0.2,help='seconds per replayed download')
+    parser.add_argument('--fail',type=float,default=0,help='fraction of first attempts that fail')
+    parser.add_argument('--stall',type=float,default=0,help='fraction of first attempts that stall')
+    parser.add_argument('--corrupt',type=float,default=0,
+                        help='fraction of first attempts that leave one bad file (needs --args=-D)')
+    parser.add_argument('--files',type=int,default=1,help='files per UUID')
+    parser.add_argument('--args',default='',help='extra GT_Download.py options')
+    parser.add_argument('--python',default='python2',help='interpreter for GT_Download.py')
+    parser.add_argument('--baseline',default=BASELINE)
+    parser.add_argument('--update-baseline',action='store_true')
+    parser.add_argument('--tolerance',type=float,default=0.1,help='allowed growth in the I/O counts')
+    parser.add_argument('--wall-tolerance',type=float,default=0.5,help='allowed growth in wall time')
+    parser.add_argument('--keep',action='store_true',help='keep the work directories')
+    args = parser.parse_args()
+
+    results = list()
+    print('%8s %9s %10s %9s %9s %9s %10s %10s' % ('BAMs','wall (s)','ms/BAM','upd/BAM','rw/BAM',
+                                                   'fsync/BAM','sysc/BAM','unfinished'))
+    for size in [int(value) for value in args.sizes.split(',')]:
+        result = run_size(args,size)
+        results.append(result)
+        print('%8d %9.2f %10.1f %9.2f %9.3f %9.2f %10s %10d' %
+              (size,result['wall_s'],result['wall_ms_per_bam'],result['updates_per_bam'],
+               result['rewrites_per_bam'],result['fsyncs_per_bam'],
+               '%.0f' % result['syscalls_per_bam'] if 'syscalls_per_bam' in result else 'n/a',
+               result['unfinished']))
+        sys.stdout.flush()
+
+    if args.update_baseline:
+        baseline = dict()
+        if os.path.exists(args.baseline):
+            baseline = json.load(open(args.baseline))
+        for result in results:
+            baseline[str(result['bams'])] = dict((name,round(result[name],3)) for name,timing in METRICS
+                                                 if name in result)
+        f = open(args.baseline,'w')
+        json.dump(baseline,f,indent=2,sort_keys=True)
+        f.write('\n')
+        f.close()
+        print('Updated %s' % args.baseline)
+        return 0
+
+    # Anything that did not finish, or grew past the baseline, is a regression
+    regressions = list()
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        baseline = json.load(open(args.baseline))
+    for result in results:
+        if result['unfinished']:
+            regressions.append('%d BAMs: %d did not finish' % (result['bams'],result['unfinished']))
+        expected = baseline.get(str(result['bams']),{})
+        for name,timing in METRICS:
+            if name not in expected or name not in result:
+                continue
+            limit = expected[name] * (1 + (timing and args.wall_tolerance or args.tolerance))
+            if result[name] > limit:
+                regressions.append('%d BAMs: %s = %.3f (baseline %.3f)' %
+                                   (result['bams'],name,result[name],expected[name]))
+    for regression in regressions:
+        print('REGRESSION: %s' % regression)
+    return regressions and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+#
+# Synthetic requests files for the benchmarks in this directory.
+#
+
+import os
+import random
+import hashlib
+
+HEADER = ['study','barcode','disease','disease_name','sample_type','sample_type_name','analyte_type',
+          'library_type','center','center_name','platform','platform_name','assembly','filename',
+          'files_size','checksum','analysis_id','aliquot_id','participant_id','sample_id','tss_id',
+          'sample_accession','published','uploaded','modified','state','side','start_time','end_time',
+          'download_attempt_num','status','overall_rate_(MB/s)','pgrr_file_path']
+CENTERS = ['BCCAGSC','UNC-LCCC','BI','WUGSC','BCM']
+
+
+def make_uuid(rng):
+    return '%08x-%04x-4%03x-8%03x-%012x' % (rng.getrandbits(32),rng.getrandbits(16),rng.getrandbits(12),
+                                            rng.getrandbits(12),rng.getrandbits(48))
+
+
+def make_row(rng,i,**fields):
+    barcode = 'TCGA-%02d-%04d-01A-01R-1568-13' % (i % 100,i % 10000)
+    row = dict.fromkeys(HEADER,'')
+    row.update(study='TCGA',barcode=barcode,disease='OV',library_type='RNA-Seq',
+               center=CENTERS[i % len(CENTERS)],platform_name='Illumina',
+               filename='%s_rnaseq.bam' % barcode,analysis_id=make_uuid(rng),state='Live')
+    row.update(fields)
+    return row
+
+
+def file_content(uuid,name,size):
+    # The bytes the fake gtdownload writes for a non-sparse file
+    pattern = ('%s/%s\n' % (uuid,name)).encode('ascii')
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def file_checksum(uuid,name,size,sparse):
+    md5 = hashlib.md5()
+    if sparse:
+        block = b'\0' * 1048576
+        while size > 0:
+            md5.update(block[:min(size,len(block))])
+            size -= len(block)
+    else:
+        md5.update(file_content(uuid,name,size))
+    return md5.hexdigest()
+
+
+def read_manifest(filename):
+    # [(name,size,checksum,sparse)] for each file of an analysis
+    files = list()
+    for line in open(filename).read().splitlines():
+        name,size,checksum,sparse = line.split('\t')
+        files.append((name,int(size),checksum,int(sparse)))
+    return files
+
+
+def write_history_sheet(filename,rows,pending):
+    # A long-running bam_status.tsv: most rows are already Finished or Live
+    rng = random.Random(42)
+    f = open(filename,'w')
+    f.write('\t'.join(HEADER) + '\n')
+    for i in range(rows):
+        row = make_row(rng,i,files_size=str(rng.randint(10**8,10**10)),
+                       checksum='%032x' % rng.getrandbits(128))
+        if rng.random() >= pending:
+            row.update({'status':               rng.choice(['Finished','Live']),
+                        'start_time':           '08/11/14 12:40 PM',
+                        'end_time':             '08/11/14 12:49 PM',
+                        'download_attempt_num': '1',
+                        'overall_rate_(MB/s)':  '%.1f' % rng.uniform(5,150)})
+        elif rng.random() < 0.3:
+            row.update(status='Failed',download_attempt_num='2')
+        f.write('\t'.join(row[name] for name in HEADER) + '\n')
+    f.close()
+
+
+def write_download_sheet(filename,manifest_dir,rows,file_size,sparse,files=1):
+    # A requests file of rows that all still need downloading, plus the
+    # manifest that tells fake_gtdownload.py and fake_cgquery.py about them.
+    # With files > 1 each analysis also has a .bai and further BAMs, which
+    # only the manifest (that is, cgquery) knows about.  The rest of each row
+    # goes into metadata/<uuid> beside the manifest, for fake_cgquery.py -o.
+    # (json is imported here, not at the top, as fake_gtdownload.py imports
+    # this module and its I/O counts towards GT_Download.py's system calls.)
+    import json
+
+    rng = random.Random(7)
+    metadata_dir = os.path.join(os.path.dirname(manifest_dir),'metadata')
+    for name in (manifest_dir,metadata_dir):
+        if not os.path.isdir(name):
+            os.makedirs(name)
+    zero_sum = sparse and file_checksum('','',file_size,1) or None
+    f = open(filename,'w')
+    f.write('\t'.join(HEADER) + '\n')
+    for i in range(rows):
+        row = make_row(rng,i,files_size=str(file_size))
+        uuid = row['analysis_id']
+        names = [row['filename'],row['filename'] + '.bai']
+        names += ['%s_%d.bam' % (row['filename'][:-4],n) for n in range(2,files)]
+        m = open(os.path.join(manifest_dir,uuid),'w')
+        for name in names[:files]:
+            checksum = zero_sum or file_checksum(uuid,name,file_size,0)
+            m.write('%s\t%d\t%s\t%d\n' % (name,file_size,checksum,sparse and 1 or 0))
+            if name == row['filename']:
+                row['checksum'] = checksum
+        m.close()
+        m = open(os.path.join(metadata_dir,uuid),'w')
+        json.dump(row,m)
+        m.close()
+        f.write('\t'.join(row[name] for name in HEADER) + '\n')
+    f.close()